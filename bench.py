@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+# Times syncs against mock_sharepoint.py, so that changes to the hot paths
+# can be measured without a real tenant.  Generates a local tree of the
+# requested shape and runs a series of syncs on it, reporting the wall time,
+# the number of requests made and the bytes moved for each.
+
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+
+from mock_sharepoint import MockSharePoint, serve
+from sharepoint import SharePoint
+from db import DB
+
+# name: (files, bytes per file, folders per folder, files per folder)
+presets = {
+    'small': (100000, 1024, 10, 100),
+    'huge': (4, 256 * 1024 * 1024, 1, 4),
+    'mixed': (10000, 16 * 1024, 10, 50),
+    'tiny': (200, 1024, 4, 10),
+}
+
+class Tally(io.TextIOBase):
+    # Stands in for stdout during a sync, counting the errors it reports
+    def __init__(self):
+        self.reported = 0
+
+    def write(self, s):
+        self.reported += s.count('*** Error')
+        return len(s)
+
+def make_tree(root, files, size, fanout, per_folder, seed=0):
+    # Fills root with files of size bytes, per_folder to a folder, in a tree
+    # of folders fanout wide.  Returns the paths of the files, relative to
+    # root.
+    rnd = random.Random(seed)
+    block = bytes(rnd.getrandbits(8) for i in range(min(size, 1024 * 1024)))
+    paths = []
+    folders = ['']
+    next_folder = 0
+    while len(paths) < files:
+        folder = folders[next_folder % len(folders)]
+        next_folder += 1
+        for i in range(fanout):
+            folders.append(os.path.join(folder, 'd{}'.format(len(folders))))
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+        for i in range(min(per_folder, files - len(paths))):
+            path = os.path.join(folder, 'f{}.bin'.format(len(paths)))
+            write_file(os.path.join(root, path), block, size, len(paths))
+            paths.append(path)
+    return paths
+
+def write_file(path, block, size, salt):
+    # Each file starts differently, so no two have the same content
+    with open(path, 'wb') as f:
+        f.write(salt.to_bytes(8, 'big'))
+        left = size - 8
+        while left > 0:
+            f.write(block[:left])
+            left -= len(block)
+
+def count_files(root):
+    # Files in root, leaving out the sync's own
+    return sum(1 for folder, dirs, files in os.walk(root) for name in files
+                 if not name.startswith('.sync.db') and not name.endswith('.obsync-part'))
+
+def run(name, mock, sp, local_path, remote_path, results, jobs):
+    # With errors injected a sync may fail, which counts as one more error.
+    # Nothing the benchmark does should cost a local file, whatever fails.
+    mock.reset_stats()
+    tally = Tally()
+    before = count_files(local_path) if os.path.exists(local_path) else 0
+    start = time.time()
+    with redirect_stdout(tally):
+        try:
+            DB(local_path, sp.get_folder(remote_path), None, jobs=jobs, quiet=True).sync()
+        except Exception as e:
+            print(' *** Error: {}'.format(e))
+    elapsed = time.time() - start
+    lost = max(0, before - count_files(local_path))
+    # Timestamps only go to the second, so changes made in the same second
+    # as a sync are indistinguishable from it
+    time.sleep(1.1)
+    results.append((name, elapsed, sum(mock.requests.values()), mock.bytes_in, mock.bytes_out,
+                    tally.reported, lost, dict(mock.requests)))
+
+def report(results, out, verbose):
+    out.write('{:<18} {:>9} {:>9} {:>10} {:>10} {:>7} {:>7}\n'.format(
+                'sync', 'seconds', 'requests', 'MB sent', 'MB recvd', 'errors', 'lost'))
+    for name, elapsed, requests, sent, received, errors, lost, kinds in results:
+        out.write('{:<18} {:>9.2f} {:>9} {:>10.2f} {:>10.2f} {:>7} {:>7}\n'.format(
+                    name, elapsed, requests, sent / 1048576.0, received / 1048576.0, errors, lost))
+        if verbose:
+            for kind, count in sorted(kinds.items(), key=lambda k: -k[1]):
+                out.write('    {:<30} {:>9}\n'.format(kind, count))
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--preset', choices=sorted(presets), default='mixed',
+                        help='Shape of the tree to sync')
+    parser.add_argument('--files', type=int, help='Number of files')
+    parser.add_argument('--size', type=int, help='Bytes per file')
+    parser.add_argument('--fanout', type=int, help='Subfolders per folder')
+    parser.add_argument('--per-folder', type=int, help='Files per folder')
+    parser.add_argument('--changes', type=int, default=100,
+                        help='Files changed for each incremental sync')
+    parser.add_argument('--jobs', '-j', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds added to every request')
+    parser.add_argument('--throttle', type=float, default=0, help='Fraction of requests to throttle')
+    parser.add_argument('--errors', type=float, default=0, help='Fraction of requests to fail')
+    parser.add_argument('--store', action='store_true',
+                        help='Keep the mock server\'s files on disk rather than in memory')
+    parser.add_argument('--output', '-o', help='Append the results to this file too')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Break requests down by kind')
+    args = parser.parse_args()
+
+    files, size, fanout, per_folder = presets[args.preset]
+    files = args.files or files
+    size = args.size or size
+    fanout = args.fanout or fanout
+    per_folder = args.per_folder or per_folder
+
+    work = tempfile.mkdtemp(prefix='obsync-bench-')
+    try:
+        store = os.path.join(work, 'server')
+        if args.store:
+            os.mkdir(store)
+        mock = MockSharePoint(store=store if args.store else None, latency=args.latency / 1000.0,
+                              throttle=args.throttle, errors=args.errors, seed=1)
+        server, url = serve(mock)
+        sp = SharePoint(url, 'bench', 'bench', token={ 'Authorization': 'Bearer bench' }, pool_size=args.jobs)
+        local = os.path.join(work, 'local')
+        print('Making {} files of {} bytes in {}'.format(files, size, local))
+        paths = make_tree(local, files, size, fanout, per_folder)
+        changed = random.Random(2).sample(paths, min(args.changes, len(paths)))
+        results = []
+
+        run('cold upload', mock, sp, local, mock.root, results, args.jobs)
+        run('no-op', mock, sp, local, mock.root, results, args.jobs)
+
+        for i, path in enumerate(changed):
+            with open(os.path.join(local, path), 'r+b') as f:
+                f.write('local {:08}'.format(i).encode('ascii'))
+        run('local edits', mock, sp, local, mock.root, results, args.jobs)
+
+        for i, path in enumerate(changed):
+            node = mock.nodes.get(mock.root + '/' + path.replace(os.sep, '/'))
+            if node is None:
+                # Its upload failed, with errors injected
+                continue
+            mock.add(node.path, False, 'remote {:07}'.format(i).encode('ascii') + mock.read(node)[14:])
+        run('remote edits', mock, sp, local, mock.root, results, args.jobs)
+
+        top = sorted(p for p in os.listdir(local) if p.startswith('d'))
+        if top:
+            os.rename(os.path.join(local, top[0]), os.path.join(local, top[0] + '-renamed'))
+            run('local rename', mock, sp, local, mock.root, results, args.jobs)
+
+        run('cold download', mock, sp, os.path.join(work, 'fresh'), mock.root, results, args.jobs)
+        server.shutdown()
+
+        out = io.StringIO()
+        out.write('{} files of {} bytes, {} jobs, {}ms latency, {} throttled, {} errors\n'.format(
+                    files, size, args.jobs, args.latency, args.throttle, args.errors))
+        report(results, out, args.verbose)
+        sys.stdout.write(out.getvalue())
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(out.getvalue() + '\n')
+        # Losing local files is a failure, however fast
+        return 1 if any(r[6] for r in results) else 0
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,108 @@
+import os
+import json
+import time
+import calendar
+import hashlib
+import stat
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from pathlib import Path
-from moment import Moment, unix
+from uuid import uuid4
 from shutil import rmtree
-from datetime import datetime
+from sharepoint import CHANGE_DELETE, CHANGE_MOVE_AWAY, BATCH_LIMIT, LIST_PAGE_SIZE, Changed
+from watch import Watcher
+from prefetch import Prefetch
+from rules import Rules
+
+# Downloads are written to a file with this suffix next to their destination
+# and renamed over it once complete.
+PARTIAL_SUFFIX = '.obsync-part'
+
+# Files at least this big are copied on the server from a synced file with
+# the same content, if there is one, rather than uploaded.  Smaller ones
+# aren't worth the extra request.
+COPY_MIN_SIZE = 1024 * 1024
+
+# Each item changed on the server is fetched with a request of its own,
+# where listing everything takes one per LIST_PAGE_SIZE items.  With more
+# changed items than this, or than the listing would take requests,
+# everything is listed instead.
+CHANGES_LIMIT = 100
+
+# Transfers inside folders waiting to be created in a batch are held back
+# until it is sent, but the batch is sent early once this many are waiting
+HELD_LIMIT = 1000
+
+# Progress through a sync is committed at least this often, in seconds
+CHECKPOINT_INTERVAL = 5
+
+# In watch mode, a round that fails is tried again after WATCH_BACKOFF
+# seconds, doubling each time it fails again up to WATCH_MAX_BACKOFF
+WATCH_BACKOFF = 10
+WATCH_MAX_BACKOFF = 600
+
+# What to do about a path that has changed on both sides:
+#   keep-both  rename the local copy out of the way and sync both
+#   newest     take whichever copy was changed last
+#   remote     take the remote copy
+#   local      take the local copy
+#   defer      leave both alone until `obsync.py conflicts` settles it
+# A file on one side and a folder on the other are always kept both, unless
+# deferred.
+CONFLICT_POLICIES = ('keep-both', 'newest', 'remote', 'local', 'defer')
+
+# Timestamps in the database are integer nanoseconds since the epoch, UTC
+NS = 1000000000
+
+def epoch_ns(timestamp):
+    # SharePoint's timestamps look like 2018-03-01T12:34:56Z
+    return calendar.timegm((int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                            int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]))) * NS
+
+def now_ns():
+    return int(time.time() * NS)
+
+class Relisted(dict):
+    # A plan row with some of its columns replaced, indexed by position or
+    # name like the sqlite3.Row it came from
+    def __init__(self, row, **columns):
+        self.columns = list(row.keys())
+        super().__init__((key, row[key]) for key in self.columns)
+        self.update(columns)
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            key = self.columns[key]
+        return super().__getitem__(key)
+
+class Hashing():
+    # A file being uploaded, which hashes what is read from it.  Going back
+    # to the start to send it again starts the hash again.
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.hash.update(data)
+        return data
+
+    def tell(self):
+        return self.f.tell()
+
+    def seek(self, offset, whence=0):
+        self.hash = hashlib.sha256()
+        return self.f.seek(offset, whence)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+def merge_changes(a, b):
+    # Sets of changed paths, None meaning everything
+    if a is None or b is None:
+        return None
+    return a | b
 
 def params(path):
     try:
@@ -16,52 +116,295 @@ def params(path):
         conn.close()
     return None
 
+def saved_token(path):
+    # The authentication headers kept from the last run, if there was one
+    db_path = Path(path) / '.sync.db'
+    if not db_path.exists():
+        return None
+    conn = sqlite3.connect(str(db_path))
+    try:
+        r = conn.execute("SELECT value FROM state WHERE key = 'auth_token'").fetchone()
+        return json.loads(r[0]) if r and r[0] else None
+    except sqlite3.OperationalError:
+        # A database from before the state table
+        return None
+    finally:
+        conn.close()
+
+def deferred_conflicts(path):
+    # The conflicts left for later, without connecting to the server
+    db_path = Path(path) / '.sync.db'
+    if not db_path.exists():
+        raise FileNotFoundError(db_path)
+    conn = sqlite3.connect(str(db_path))
+    try:
+        conn.row_factory = sqlite3.Row
+        return conn.execute('SELECT * FROM conflicts ORDER BY file_path').fetchall()
+    except sqlite3.OperationalError:
+        # A database from before the conflicts table
+        return []
+    finally:
+        conn.close()
+
 # Sqlite3 doesn't support full outer join or right joins, so this emulates
 # a full outer join between the three tables by using three left joins and
 # selecting only rows that haven't been returned by a previous query.
+# {filter} is empty, or restricts the query to the paths in the dirty table.
+#
+# Each row comes out with the action it needs:
+#   resume         an interrupted upload, to be finished first, the remote
+#                  file being as it was when the upload began
+#   to_remote      the local copy is new or newer
+#   to_local       the remote copy is new or newer
+#   compare        a file that has turned up on both sides, maybe the same one
+#   adopt          a folder that has turned up on both sides
+#   new_conflict   something different has turned up on both sides
+#   conflict       both sides have changed since the last sync
+#   delete_remote  deleted locally, so delete it from the server; or the
+#                  empty file an abandoned upload made, left untouched
+#   delete_local   deleted from the server, so delete it locally
+#   forget         deleted from both sides
+#   metadata       only the remote file's metadata has changed
+#   up_to_date     nothing has changed
 sync_query = '''
-select sync.file_path as fp, sync.is_folder, sync.last_sync,
-       sp.is_folder, sp.tstamp,
-       fs.is_folder, fs.tstamp
-from sync
-left join sp using(file_path)
-left join fs using(file_path)
-where sync.file_path is not null
-
-union all
-
-select sp.file_path as fp, sync.is_folder, sync.last_sync,
-       sp.is_folder, sp.tstamp,
-       fs.is_folder, fs.tstamp
-from sp
-left join sync using(file_path)
-left join fs using(file_path)
-where sync.file_path is null
-and sp.file_path is not null
-
-union all
-
-select fs.file_path as fp, sync.is_folder, sync.last_sync,
-       sp.is_folder, sp.tstamp,
-       fs.is_folder, fs.tstamp
-from fs
-left join sp using(file_path)
-left join sync using(file_path)
-where sync.file_path is null and sp.file_path is null
-and fs.file_path is not null
-;
+select *,
+    case
+        when fs_folder is not null and exists (select 1 from uploads
+                                               where uploads.file_path = fp and uploads.ctag = sp_ctag) then
+            -- Only if the remote file is still what the upload started from
+            'resume'
+        when sync_folder is null and fs_folder is null and exists (select 1 from uploads
+                                               where uploads.file_path = fp and uploads.placeholder
+                                               and uploads.ctag = sp_ctag) then
+            -- The local file went before its upload was finished
+            'delete_remote'
+        when sync_folder is null then
+            case
+                when sp_folder is null then 'to_remote'
+                when fs_folder is null then 'to_local'
+                when not sp_folder and not fs_folder and sp_size = fs_size then 'compare'
+                when sp_folder and fs_folder then 'adopt'
+                else 'new_conflict'
+            end
+        when sp_folder is null and fs_folder is null then 'forget'
+        when sp_folder is null and not fs_folder and fs_tstamp > last_sync then
+            -- Deleted on the server but edited locally since; keep the edit
+            'to_remote'
+        when sp_folder is null then 'delete_local'
+        when fs_folder is null and not sp_folder and sp_tstamp > last_sync and sp_hash is null then
+            -- Deleted locally but edited on the server since; keep the edit
+            'to_local'
+        when fs_folder is null then 'delete_remote'
+        when last_sync >= sp_tstamp and last_sync >= fs_tstamp then 'up_to_date'
+        when sp_folder and fs_folder then 'up_to_date'
+        when sp_tstamp > last_sync and fs_tstamp > last_sync then
+            -- If the remote content is what we last synced, only the local
+            -- copy has really changed.
+            case when sp_hash is not null then 'to_remote' else 'conflict' end
+        when sp_tstamp >= fs_tstamp then
+            case when sp_hash is not null then 'metadata' else 'to_local' end
+        else 'to_remote'
+    end as action
+from (
+    select sync.file_path as fp, sync.is_folder as sync_folder, sync.last_sync as last_sync,
+           sp.is_folder as sp_folder, sp.tstamp as sp_tstamp,
+           fs.is_folder as fs_folder, fs.tstamp as fs_tstamp,
+           sync.size as sync_size, sync.hash as sync_hash, sync.ctag as sync_ctag,
+           sp.size as sp_size, sp.hash as sp_hash, sp.ctag as sp_ctag,
+           fs.size as fs_size, sp.url as sp_url, sp.etag as sp_etag, sp.unique_id as sp_unique_id
+    from sync
+    left join sp using(file_path)
+    left join fs using(file_path)
+    where sync.file_path is not null {filter}
+
+    union all
+
+    select sp.file_path as fp, sync.is_folder, sync.last_sync,
+           sp.is_folder, sp.tstamp,
+           fs.is_folder, fs.tstamp,
+           sync.size, sync.hash, sync.ctag,
+           sp.size, sp.hash, sp.ctag,
+           fs.size, sp.url, sp.etag, sp.unique_id
+    from sp
+    left join sync using(file_path)
+    left join fs using(file_path)
+    where sync.file_path is null
+    and sp.file_path is not null {filter}
+
+    union all
+
+    select fs.file_path as fp, sync.is_folder, sync.last_sync,
+           sp.is_folder, sp.tstamp,
+           fs.is_folder, fs.tstamp,
+           sync.size, sync.hash, sync.ctag,
+           sp.size, sp.hash, sp.ctag,
+           fs.size, sp.url, sp.etag, sp.unique_id
+    from fs
+    left join sp using(file_path)
+    left join sync using(file_path)
+    where sync.file_path is null and sp.file_path is null
+    and fs.file_path is not null {filter}
+)
+order by fp
 '''
 
+# Items that have gone from where they were last synced on one side, and
+# turned up somewhere new on the same side: locally the same inode (and for
+# files, size and mtime), remotely the same UniqueId.  The other side still
+# has them at the old path and nothing at the new one.
+local_moves_query = '''
+select sync.file_path, fs.file_path, sync.is_folder from sync
+join fs on fs.inode = sync.inode and fs.is_folder = sync.is_folder
+where sync.file_path not in (select file_path from fs)
+and sync.file_path in (select file_path from sp)
+and fs.file_path not in (select file_path from sync)
+and fs.file_path not in (select file_path from sp)
+and (sync.is_folder or (fs.size = sync.size and fs.tstamp = sync.mtime))
+order by sync.file_path
+'''
+
+remote_moves_query = '''
+select sync.file_path, sp.file_path, sync.is_folder from sync
+join sp on sp.unique_id = sync.unique_id
+where sync.file_path not in (select file_path from sp)
+and sync.file_path in (select file_path from fs)
+and sp.file_path not in (select file_path from sync)
+and sp.file_path not in (select file_path from fs)
+order by sync.file_path
+'''
+
+# Files edited on the server, and only there, since they were last synced,
+# and still where they were on both sides.  Nothing else the listings turn up
+# changes that they are to be downloaded, so the downloads can start before
+# the remote listing has finished.
+early_downloads_query = '''
+select sp.file_path, sp.url, sp.etag, sp.tstamp from sp
+join sync using(file_path)
+join fs using(file_path)
+where not sp.is_folder and not sync.is_folder and not fs.is_folder
+and sp.unique_id = sync.unique_id and sp.tstamp > sync.last_sync and sp.hash is null
+and fs.inode = sync.inode and fs.size = sync.size and fs.tstamp = sync.mtime
+and sync.last_sync >= fs.tstamp
+and sp.file_path not in (select file_path from uploads)
+and sp.file_path not in (select file_path from downloads)
+and sp.file_path not in (select file_path from conflicts)
+{filter}
+'''
+
+# The latest layout of each table
+SCHEMA_VERSION = 9
+tables = (
+    # inode and mtime are the local item's, and unique_id the remote one's,
+    # as last seen.  They are how moves are recognised.  etag is the remote
+    # file's as synced, so it can be copied while it still has that content.
+    ('sync', '''file_path text primary key,
+                is_folder boolean,
+                synced boolean,
+                last_sync integer,
+                size integer,
+                hash text,
+                ctag text,
+                inode integer,
+                mtime integer,
+                unique_id text,
+                etag text'''),
+    # Everything needed to fetch or delete a remote item without looking it
+    # up first.  url is the server-relative URL, and etag and version change
+    # whenever the item does.
+    ('sp', '''file_path text primary key,
+              is_folder boolean,
+              tstamp integer,
+              item_id integer,
+              size integer,
+              hash text,
+              ctag text,
+              url text,
+              unique_id text,
+              etag text,
+              version text'''),
+    ('fs', '''file_path text primary key,
+              is_folder boolean,
+              tstamp integer,
+              size integer,
+              inode integer,
+              hash text'''),
+    ('state', '''key text primary key,
+                 value text'''),
+    # ctag is the remote file's when the upload began: the file it replaces,
+    # or the empty one made to upload into, in which case placeholder is set
+    ('uploads', '''file_path text primary key,
+                   upload_id text,
+                   offset integer,
+                   size integer,
+                   mtime integer,
+                   ctag text,
+                   placeholder boolean'''),
+    ('downloads', '''file_path text primary key,
+                     tstamp integer'''),
+    # Content hashes of local files, good for as long as the file's inode,
+    # size and mtime stay the same
+    ('hashes', '''file_path text primary key,
+                  inode integer,
+                  size integer,
+                  mtime integer,
+                  hash text'''),
+    # Patterns for what to leave out of the sync, in order
+    ('rules', '''position integer primary key,
+                 pattern text'''),
+    # Paths changed on both sides that were left for later.  resolution is
+    # the policy to settle each one with, once someone has chosen.
+    ('conflicts', '''file_path text primary key,
+                     found integer,
+                     local_tstamp integer,
+                     local_size integer,
+                     local_folder boolean,
+                     remote_tstamp integer,
+                     remote_size integer,
+                     remote_folder boolean,
+                     resolution text'''),
+)
+indexes = (
+    'CREATE INDEX IF NOT EXISTS sp_item_id ON sp (item_id)',
+    'CREATE INDEX IF NOT EXISTS sp_unique_id ON sp (unique_id)',
+    'CREATE INDEX IF NOT EXISTS fs_inode ON fs (inode)',
+    'CREATE INDEX IF NOT EXISTS sync_hash ON sync (hash, size)',
+)
+
 class DB():
-    def __init__(self, path, sp_f, dry_run):
+    def __init__(self, path, sp_f, dry_run, jobs=1, chunk_size=10 * 1024 * 1024,
+                 buffer_size=1024 * 1024, quick_scan=False, quiet=False, stats_json=None, prometheus=None,
+                 executor=None, prefix='', conflicts='keep-both'):
         self.dry_run = dry_run
+        self.jobs = jobs
+        # Files bigger than this are uploaded in pieces of this size
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.quick_scan = quick_scan
+        # Say nothing about each path, only about errors
+        self.quiet = quiet
+        # Where to write the stats after each sync, if anywhere
+        self.stats_json = stats_json
+        self.prometheus = prometheus
+        self.stats = sp_f.sp.stats
+        # Transfers run on this pool if given, which may be shared with other
+        # roots, and otherwise on one of our own for each sync
+        self.shared_executor = executor
+        # Put in front of everything printed, to tell roots apart
+        self.prefix = prefix
+        if conflicts not in CONFLICT_POLICIES:
+            raise ValueError('Unknown conflict policy {}'.format(conflicts))
+        self.conflicts = conflicts
+        # Transfers run on worker threads, which share this connection.  All
+        # writes to it go through this lock.
+        self.lock = threading.Lock()
         self.path = Path(path)
         self.db_path = self.path / '.sync.db'
         self.sp_f = sp_f
+        self.change_token = None
         if not self.path.exists():
             self.path.mkdir(parents=True)
         if not self.db_path.exists():
-            self.conn = sqlite3.connect(str(self.db_path))
+            self.conn = self.connect()
             c = self.conn.cursor()
             c.execute('''CREATE TABLE params (
                 server_url text,
@@ -71,112 +414,989 @@ class DB():
             )''')
             c.execute('''INSERT INTO params (server_url, remote_path, username, password) VALUES (?, ?, ?, ?)''',
                         (str(sp_f.sp.site_url), str(sp_f.path), sp_f.sp.username, sp_f.sp.password))
-            c.execute('''CREATE TABLE sync (
-                file_path text primary key,
-                is_folder boolean,
-                synced boolean,
-                last_sync timestamp
-            )''')
-            c.execute('''CREATE TABLE sp (
-                file_path text primary key,
-                is_folder boolean,
-                tstamp timestamp
-            )''')
-            c.execute('''CREATE TABLE fs (
-                file_path text primary key,
-                is_folder boolean,
-                tstamp timestamp
-            )''')
+            for table, columns in tables:
+                c.execute('CREATE TABLE {} ({})'.format(table, columns))
+            for index in indexes:
+                c.execute(index)
+            c.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
             self.conn.commit()
         else:
-            self.conn = sqlite3.connect(str(self.db_path))
+            self.conn = self.connect()
+        self.migrate()
+        self.load_rules()
+
+    def say(self, message):
+        print(self.prefix + message)
+
+    def note(self, message):
+        if not self.quiet:
+            self.say(message)
 
-    def from_sp(self):
+    def connect(self):
+        conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        # With a write-ahead log, the many small commits made while syncing
+        # don't each rewrite the database, and a crash can't corrupt it.
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def migrate(self):
+        # Brings a database written by an older version up to date, one step
+        # at a time.  Each step is a transaction of its own, and the schema
+        # version is kept in user_version.
         c = self.conn.cursor()
-        c.execute('DELETE FROM sp')
-        def log_obj(ff):
-            rel_path = ff.relative_to(self.sp_f)
-            c.execute('INSERT INTO sp (file_path, is_folder, tstamp) VALUES (?, ?, ?)',
-                        (str(rel_path), ff.is_folder, Moment(ff.timestamp).done()))
-            if ff.is_folder:
-                for fff in ff:
-                    log_obj(fff)
-        for file in self.sp_f:
-            log_obj(file)
+        version = c.execute('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise ValueError('{} was written by a newer version of this tool'.format(self.db_path))
+        steps = (self.migrate_1, self.migrate_2, self.migrate_3, self.migrate_4, self.migrate_5,
+                 self.migrate_6, self.migrate_7, self.migrate_8, self.migrate_9)
+        while version < SCHEMA_VERSION:
+            c.execute('BEGIN')
+            steps[version](c)
+            version += 1
+            c.execute('PRAGMA user_version = {}'.format(version))
+            self.conn.commit()
+
+    def migrate_1(self, c):
+        # The tables and columns added before the schema had a version
+        c.execute('''CREATE TABLE IF NOT EXISTS state (
+            key text primary key,
+            value text
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS uploads (
+            file_path text primary key,
+            upload_id text,
+            offset integer,
+            size integer,
+            mtime real
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS downloads (
+            file_path text primary key,
+            tstamp text
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS hashes (
+            file_path text primary key,
+            inode integer,
+            size integer,
+            mtime real,
+            hash text
+        )''')
+        self.add_columns(c, (('sp', 'item_id', 'integer'),
+                             ('sync', 'size', 'integer'), ('sync', 'hash', 'text'), ('sync', 'ctag', 'text'),
+                             ('sp', 'size', 'integer'), ('sp', 'hash', 'text'), ('sp', 'ctag', 'text'),
+                             ('fs', 'size', 'integer'), ('fs', 'inode', 'integer'), ('fs', 'hash', 'text')))
+
+    def add_columns(self, c, columns):
+        for table, column, kind in columns:
+            if column not in [r[1] for r in c.execute('PRAGMA table_info({})'.format(table))]:
+                c.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, kind))
+
+    def migrate_2(self, c):
+        # Timestamps become integer nanoseconds.  They used to be text: the
+        # server's time in UTC for sp and downloads, and the local time for
+        # sync.  Local file times were float seconds.
+        from_text = ("(CAST(strftime('%s', {0}) AS INTEGER) * 1000000000 + "
+                     "CAST(round(strftime('%f', {0}) * 1000) AS INTEGER) % 1000 * 1000000)")
+        from_local_text = from_text.replace("{0})", "{0}, 'utc')")
+        from_seconds = "CAST(round({} * 1000000000) AS INTEGER)"
+        conversions = {
+            'sync': {'last_sync': from_local_text},
+            'sp': {'tstamp': from_text},
+            'fs': {'tstamp': from_seconds},
+            'uploads': {'mtime': from_seconds},
+            'downloads': {'tstamp': from_text},
+            'hashes': {'mtime': from_seconds},
+        }
+        for table, columns in tables:
+            if table not in conversions:
+                continue
+            names = [r[1] for r in c.execute('PRAGMA table_info({})'.format(table))]
+            c.execute('CREATE TABLE {}_new ({})'.format(table, columns))
+            c.execute('INSERT INTO {0}_new ({1}) SELECT {2} FROM {0}'.format(
+                        table, ', '.join(names),
+                        ', '.join(conversions[table].get(n, '{}').format(n) for n in names)))
+            c.execute('DROP TABLE {}'.format(table))
+            c.execute('ALTER TABLE {0}_new RENAME TO {0}'.format(table))
+        for index in indexes:
+            c.execute(index)
+
+    def migrate_3(self, c):
+        # The remote item's URL, ids and version.  Rows listed before this
+        # don't have them, so list everything afresh next time.
+        self.add_columns(c, (('sp', 'url', 'text'), ('sp', 'unique_id', 'text'),
+                             ('sp', 'etag', 'text'), ('sp', 'version', 'text')))
+        c.execute("DELETE FROM state WHERE key = 'change_token'")
+
+    def migrate_4(self, c):
+        # What moves are recognised by
+        self.add_columns(c, (('sync', 'inode', 'integer'), ('sync', 'mtime', 'integer'),
+                             ('sync', 'unique_id', 'text')))
+        for index in indexes:
+            c.execute(index)
+
+    def migrate_5(self, c):
+        # Selective sync
+        c.execute('CREATE TABLE IF NOT EXISTS rules (position integer primary key, pattern text)')
+
+    def migrate_6(self, c):
+        # Conflicts left for later
+        c.execute('CREATE TABLE IF NOT EXISTS conflicts ({})'.format(dict(tables)['conflicts']))
+
+    def migrate_7(self, c):
+        # What uploads can be copied from.  Where the server still has what
+        # was synced, its ETag will do.
+        self.add_columns(c, (('sync', 'etag', 'text'),))
+        c.execute('''UPDATE sync SET etag = (SELECT etag FROM sp WHERE sp.file_path = sync.file_path
+                                                                 AND sp.ctag = sync.ctag)''')
+        for index in indexes:
+            c.execute(index)
+
+    def migrate_8(self, c):
+        # Uploads only carry on if the remote file hasn't changed.  Older
+        # ones can't tell, so are started again.
+        self.add_columns(c, (('uploads', 'ctag', 'text'),))
+
+    def migrate_9(self, c):
+        # Which uploads made the remote file they upload into, so that it can
+        # be taken away again if the upload is abandoned
+        self.add_columns(c, (('uploads', 'placeholder', 'boolean'),))
+
+    def load_rules(self):
+        self.rules = Rules(r[0] for r in self.conn.execute('SELECT pattern FROM rules ORDER BY position'))
+        max_size = self.get_state('max_size')
+        self.max_size = int(max_size) if max_size else None
+        self.conn.create_function('excluded', 2, lambda rel_path, is_folder: self.rules.excluded(rel_path, is_folder))
+
+    def change_rules(self, patterns=(), clear=False, max_size=None):
+        # Adds patterns to the end of the rules, after taking the old ones
+        # away if clear is set.  max_size, if given, is the biggest file to
+        # sync in bytes, or 0 for no limit.
+        c = self.conn.cursor()
+        if clear:
+            c.execute('DELETE FROM rules')
+        for pattern in patterns:
+            c.execute('INSERT INTO rules (pattern) VALUES (?)', (pattern,))
+        if max_size is not None:
+            self.set_state('max_size', max_size or None)
+        if clear or patterns or max_size is not None:
+            # What was left out before hasn't been looked at, so the next
+            # sync has to look at everything again
+            c.execute("DELETE FROM state WHERE key = 'change_token'")
+            c.execute('DELETE FROM fs')
         self.conn.commit()
+        self.load_rules()
 
-    def from_fs(self):
+    def forget_excluded(self):
+        # Paths left out by the rules, or too big, are taken out of the sync
+        # altogether, on both sides, so that they don't look deleted.
         c = self.conn.cursor()
-        c.execute('DELETE FROM fs')
-        def log_file(pp):
-            if pp.is_dir():
-                tstamp = pp.stat().st_ctime
+        if self.rules.rules:
+            for table in ('sync', 'sp', 'fs'):
+                c.execute('DELETE FROM {} WHERE excluded(file_path, is_folder)'.format(table))
+        if self.max_size is not None:
+            c.execute('CREATE TEMP TABLE IF NOT EXISTS too_big (file_path text primary key)')
+            c.execute('DELETE FROM too_big')
+            c.execute('''INSERT OR IGNORE INTO too_big (file_path)
+                            SELECT file_path FROM fs WHERE size > ? UNION SELECT file_path FROM sp WHERE size > ?''',
+                        (self.max_size, self.max_size))
+            for table in ('sync', 'sp', 'fs'):
+                c.execute('DELETE FROM {} WHERE file_path IN (SELECT file_path FROM too_big)'.format(table))
+        self.conn.commit()
+
+    def get_state(self, key):
+        c = self.conn.cursor()
+        c.execute('SELECT value FROM state WHERE key = ?', (key,))
+        r = c.fetchone()
+        return r[0] if r else None
+
+    def set_state(self, key, value):
+        c = self.conn.cursor()
+        c.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value))
+
+    def list_remote(self, token=None):
+        # Starts fetching what is on the server, or what has changed there
+        # since the last sync, on a thread of its own so that it overlaps
+        # the local scan.  store_remote records what it finds.
+        #
+        # The new token is taken before looking at the server so that changes
+        # made while we work are picked up next time.  It is only saved once
+        # the sync has finished.  If token is given, changes since then are
+        # fetched rather than since the last sync.
+        sp = self.sp_f.sp
+        list_id = self.get_state('list_id')
+        token = token or self.get_state('change_token')
+        self.remote_changed = set()
+        known = self.conn.execute('SELECT count(*) FROM sp').fetchone()[0]
+        changes_limit = max(CHANGES_LIMIT, known // LIST_PAGE_SIZE + 1)
+        def fetch():
+            if list_id and token:
+                try:
+                    new_token = sp.change_token(list_id)
+                    changes = {}
+                    for change_type, item_id in sp.get_changes(list_id, token):
+                        changes[item_id] = change_type
+                except ValueError as e:
+                    yield 'note', 'Change token rejected ({}), rescanning'.format(e)
+                else:
+                    to_fetch = sum(1 for change_type in changes.values()
+                                   if change_type not in (CHANGE_DELETE, CHANGE_MOVE_AWAY))
+                    if to_fetch <= changes_limit:
+                        yield 'changes', new_token
+                        yield from self.fetch_changes(list_id, changes)
+                        return
+                    # Quicker to list everything
+            try:
+                new_list_id = sp.list_id(self.sp_f.path)
+                yield 'list', new_list_id, sp.change_token(new_list_id)
+                for ff in self.sp_f.list_items():
+                    if not self.rules.excluded(ff.relative_to(self.sp_f), ff.is_folder):
+                        yield 'item', ff
+            except ValueError as e:
+                # Some libraries refuse the list query; walk them folder by folder instead.
+                yield 'note', 'List query failed ({}), enumerating folders'.format(e)
+                yield 'list', None, None
+                for ff in self.sp_f.crawl(lambda ff: self.rules.excluded(ff.relative_to(self.sp_f), ff.is_folder),
+                                          self.jobs):
+                    yield 'item', ff
+        return Prefetch(fetch())
+
+    def fetch_changes(self, list_id, changes):
+        # Fetches the items that have changed, several at once, and yields
+        # them in the order they changed in.  Only an item the server says
+        # doesn't exist, or one now outside the synced folder, counts as
+        # gone; any other failure is raised, ending the sync before the new
+        # change token is saved, so the changes are fetched again next time.
+        sp = self.sp_f.sp
+        def fetch(change):
+            item_id, change_type = change
+            if change_type in (CHANGE_DELETE, CHANGE_MOVE_AWAY):
+                return None
+            try:
+                ff = sp.get_list_item(list_id, item_id)
+            except FileNotFoundError:
+                # Gone again since the change
+                return None
+            try:
+                rel_path = ff.relative_to(self.sp_f)
+            except ValueError:
+                # Moved out of the synced folder
+                return None
+            if self.rules.excluded(rel_path, ff.is_folder):
+                # As good as gone
+                return None
+            return ff, rel_path
+        changes = list(changes.items())
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for i in range(0, len(changes), 1000):
+                batch = changes[i:i + 1000]
+                for (item_id, change_type), fetched in zip(batch, executor.map(fetch, batch)):
+                    yield 'change', item_id, fetched
+
+    def from_sp(self, remote):
+        # Stores the rest of what list_remote finds.  Returns the paths that
+        # have changed since the last sync, or None if everything was listed
+        # afresh.  The local scan is done by now, so files that are sure to
+        # be downloaded start downloading as they are found.
+        c = self.conn.cursor()
+        self.fetch_early(c.execute(early_downloads_query.format(filter='')).fetchall())
+        for event in remote:
+            self.store_remote(c, event)
+            if event[0] == 'item':
+                rel_path = event[1].relative_to(self.sp_f)
+            elif event[0] == 'change' and event[2] is not None:
+                rel_path = event[2][1]
             else:
-                tstamp = pp.stat().st_mtime
-            c.execute('INSERT INTO fs(file_path, is_folder, tstamp) VALUES (?, ?, ?)',
-                        (str(pp.relative_to(p.parent)), pp.is_dir(), tstamp))
-            if pp.is_dir():
-                for ppp in pp.iterdir():
-                    log_file(ppp)
-        for p in self.path.iterdir():
-            if (p.relative_to(self.path) == Path('.sync.db') or
-                p.relative_to(self.path) == Path('.sync.db-journal')):
-                # Skip our own database files
                 continue
-            log_file(p)
+            self.fetch_early(c.execute(early_downloads_query.format(filter='and sp.file_path = ?'),
+                                       (rel_path,)).fetchall())
         self.conn.commit()
+        return self.remote_changed
 
-    def sync_to_sp(self, row):
-        print(' < + Sync to Remote: {}'.format(row[0]))
+    def fetch_early(self, rows):
+        # Downloads each file to its partial download file, leaving the rest
+        # to download() once the sync gets to it.  Nothing is recorded in the
+        # database, which is in the middle of storing the listing.
         if self.dry_run:
             return
+        for rel_path, url, etag, tstamp in rows:
+            if rel_path in self.early:
+                continue
+            if self.transfers_started is None:
+                self.transfers_started = time.time()
+            self.early[rel_path] = self.executor.submit(self.fetch_part, rel_path, url, etag, tstamp)
+
+    def fetch_part(self, rel_path, url, etag, tstamp):
+        part_p = self.path / (rel_path + PARTIAL_SUFFIX)
+        with self.sp_f.sp.open_file(url, 0, etag) as response:
+            with part_p.open('wb') as f:
+                for chunk in response.iter_content(chunk_size=self.buffer_size):
+                    f.write(chunk)
+                    self.stats.transferred('down', len(chunk))
+        return tstamp
+
+    def fetched_early(self, rel_path, tstamp):
+        # Whether rel_path was downloaded as it was at tstamp while the server
+        # was being listed
+        future = self.early.pop(rel_path, None)
+        if future is None:
+            return False
+        try:
+            return future.result() == tstamp
+        except Exception:
+            return False
+
+    def forget_early(self):
+        # Throws away downloads started early that the sync didn't use
+        early, self.early = self.early, {}
+        for rel_path, future in early.items():
+            future.cancel()
+            wait((future,))
+            part_p = self.path / (rel_path + PARTIAL_SUFFIX)
+            if part_p.exists():
+                part_p.unlink()
+
+    def store_remote(self, c, event):
+        kind = event[0]
+        if kind == 'note':
+            self.say(event[1])
+        elif kind == 'changes':
+            self.change_token = event[1]
+            # The paths apply_change has written in this change set
+            c.execute('CREATE TEMP TABLE IF NOT EXISTS written (file_path text primary key)')
+            c.execute('DELETE FROM written')
+        elif kind == 'list':
+            # Until the new listing is complete, the old change token is no
+            # good for what is in sp
+            c.execute('DELETE FROM sp')
+            c.execute("DELETE FROM state WHERE key = 'change_token'")
+            if event[1] is not None:
+                self.set_state('list_id', event[1])
+            self.change_token = event[2]
+            self.remote_changed = None
+        elif kind == 'item':
+            self.log_sp(c, event[1])
+        else:
+            self.apply_change(c, event[1], event[2])
+
+    def log_sp(self, c, ff):
+        # SharePoint doesn't give out content hashes, but if the content
+        # tag is the one we last synced, the content is what we synced.
+        rel_path = ff.relative_to(self.sp_f)
+        c.execute('''INSERT OR REPLACE INTO sp (file_path, is_folder, tstamp, item_id, size, ctag,
+                                                url, unique_id, etag, version, hash)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                                (SELECT hash FROM sync WHERE file_path = ? AND ctag = ?))''',
+                    (rel_path, ff.is_folder, epoch_ns(ff.timestamp), ff.item_id,
+                     None if ff.is_folder else ff.length, ff.content_tag,
+                     ff.path, ff.unique_id, ff.etag, ff.version, rel_path, ff.content_tag))
+
+    def apply_change(self, c, item_id, fetched):
+        # fetched is the item as it is now and its path, or None if it has
+        # gone from the synced folder
+        changed = self.remote_changed
+        c.execute('SELECT file_path, is_folder FROM sp WHERE item_id = ?', (item_id,))
+        old = c.fetchone()
+        ff, new_path = fetched or (None, None)
+        if old is not None:
+            changed.add(old[0])
+        if ff is not None:
+            changed.add(new_path)
+        if old is not None and (ff is None or old[0] != new_path):
+            # Renaming or deleting a folder is only reported for the
+            # folder itself, so carry its contents along with it.
+            if ff is None:
+                c.execute('DELETE FROM sp WHERE file_path = ?', (old[0],))
+                c.execute('DELETE FROM sp WHERE substr(file_path, 1, ?) = ?',
+                            (len(old[0]) + 1, old[0] + '/'))
+            else:
+                # Items changed before their folder moved are already where
+                # they are now
+                self.rename_rows(c, 'sp', old[0], new_path, keep_written=True)
+        if ff is not None:
+            self.log_sp(c, ff)
+            c.execute('INSERT OR IGNORE INTO written (file_path) VALUES (?)', (new_path,))
+
+    def rename_rows(self, c, table, old, new, keep_written=False):
+        # Moves a row and everything under it to a new path.  If keep_written
+        # is set, rows in the written table stay as they are, and the rows
+        # that would have been moved onto them are dropped instead.
+        extra = ', url = NULL' if table == 'sp' else ''
+        keep = ' AND file_path NOT IN (SELECT file_path FROM written)' if keep_written else ''
+        c.execute('DELETE FROM {} WHERE (file_path = ? OR substr(file_path, 1, ?) = ?){}'.format(table, keep),
+                    (new, len(new) + 1, new + '/'))
+        if keep_written:
+            c.execute('''DELETE FROM {} WHERE substr(file_path, 1, ?) = ?
+                            AND ? || substr(file_path, ?) IN (SELECT file_path FROM written)'''.format(table),
+                        (len(old) + 1, old + '/', new, len(old) + 1))
+        c.execute('UPDATE {} SET file_path = ?{} WHERE file_path = ?'.format(table, extra), (new, old))
+        c.execute('''UPDATE {} SET file_path = ? || substr(file_path, ?){}
+                        WHERE substr(file_path, 1, ?) = ?'''.format(table, extra),
+                    (new, len(old) + 1, len(old) + 1, old + '/'))
+
+    def find_moves(self):
+        # Things moved or renamed on one side since the last sync are moved
+        # on the other side too, rather than deleted there and copied again.
+        # Returns the paths involved.
+        c = self.conn.cursor()
+        # Keep what moves are recognised by up to date for everything that
+        # is still where it was
+        c.execute('''UPDATE sync SET inode = (SELECT inode FROM fs WHERE fs.file_path = sync.file_path),
+                                     mtime = (SELECT tstamp FROM fs WHERE fs.file_path = sync.file_path)
+                        WHERE EXISTS (SELECT 1 FROM fs WHERE fs.file_path = sync.file_path
+                                      AND (fs.inode IS NOT sync.inode OR fs.tstamp IS NOT sync.mtime))''')
+        c.execute('''UPDATE sync SET unique_id = (SELECT unique_id FROM sp WHERE sp.file_path = sync.file_path)
+                        WHERE EXISTS (SELECT 1 FROM sp WHERE sp.file_path = sync.file_path
+                                      AND sp.unique_id IS NOT NULL AND sp.unique_id IS NOT sync.unique_id)''')
+        moved = set()
+        failed = set()
+        while True:
+            # Moving a folder takes its contents with it, and may turn up
+            # more moves within it, so go round until nothing is left.
+            found = False
+            for query, move in ((local_moves_query, self.move_remote), (remote_moves_query, self.move_local)):
+                for old, new, is_folder in c.execute(query).fetchall():
+                    if (old in failed or
+                            c.execute('SELECT 1 FROM sync WHERE file_path = ?', (old,)).fetchone() is None or
+                            c.execute('SELECT 1 FROM sync WHERE file_path = ?', (new,)).fetchone() is not None):
+                        # Dealt with already, or no longer a move
+                        continue
+                    found = True
+                    moved.update((old, new))
+                    if self.dry_run:
+                        failed.add(old)
+                    try:
+                        move(c, old, new, is_folder)
+                    except (IOError, OSError, ValueError) as e:
+                        self.say(' *** Error: moving {} to {}: {}'.format(old, new, e))
+                        failed.add(old)
+            if not found:
+                break
+        self.conn.commit()
+        return moved
+
+    def move_remote(self, c, old, new, is_folder):
+        self.note(' < ~ Moved Locally: {} -> {}'.format(old, new))
+        if self.dry_run:
+            return
+        sp = self.sp_f.sp
+        # The folder it has gone into may be new
+        parents = []
+        p = Path(new).parent
+        while p != Path('.') and c.execute('SELECT 1 FROM sp WHERE file_path = ?', (str(p),)).fetchone() is None:
+            parents.insert(0, p)
+            p = p.parent
+        for p in parents:
+            if sp.create_folder(self.sp_f.path / p).status_code >= 300:
+                raise IOError('cannot create folder {}'.format(p))
+            c.execute('INSERT OR REPLACE INTO sp (file_path, is_folder, tstamp) VALUES (?, 1, ?)',
+                        (str(p), now_ns()))
+        url = c.execute('SELECT url FROM sp WHERE file_path = ?', (old,)).fetchone()[0]
+        sp.move(url or str(self.sp_f.path / old), str(self.sp_f.path / new), is_folder)
+        for table in ('sync', 'sp', 'hashes'):
+            self.rename_rows(c, table, old, new)
+        self.conn.commit()
+
+    def move_local(self, c, old, new, is_folder):
+        self.note(' > ~ Moved on Remote: {} -> {}'.format(old, new))
+        if self.dry_run:
+            return
+        new_p = self.path / new
+        if not new_p.parent.exists():
+            new_p.parent.mkdir(parents=True)
+        os.rename(str(self.path / old), str(new_p))
+        for table in ('sync', 'fs', 'hashes'):
+            self.rename_rows(c, table, old, new)
+        # The listing didn't know the moved files were the ones synced
+        c.execute('''UPDATE sp SET hash = (SELECT hash FROM sync WHERE sync.file_path = sp.file_path
+                                                                  AND sync.ctag = sp.ctag)
+                        WHERE hash IS NULL AND (file_path = ? OR substr(file_path, 1, ?) = ?)''',
+                    (new, len(new) + 1, new + '/'))
+        self.conn.commit()
+
+    def from_fs(self, paths=None, remote=None):
+        # Walks the tree with os.scandir, which gets each entry's type from
+        # the directory listing, so each entry costs at most one stat.  If
+        # paths is given, only those paths are looked at again; the contents
+        # of a folder that has appeared must be among them.  Whatever the
+        # remote listing has found meanwhile is stored as we go, but not
+        # committed.
+        c = self.conn.cursor()
+        sp_c = self.conn.cursor()
+        quick_scan = self.quick_scan and paths is None
+        if paths is not None:
+            for rel_path in paths:
+                try:
+                    st = os.stat(str(self.path / rel_path))
+                    is_dir = stat.S_ISDIR(st.st_mode)
+                except OSError:
+                    # Deleted
+                    st, is_dir = None, False
+                if self.rules.excluded(rel_path, is_dir):
+                    continue
+                if not is_dir:
+                    c.execute('DELETE FROM fs WHERE file_path > ? AND file_path < ?',
+                                (rel_path + '/', rel_path + '0'))
+                if st is None:
+                    c.execute('DELETE FROM fs WHERE file_path = ?', (rel_path,))
+                else:
+                    c.execute('''INSERT OR REPLACE INTO fs (file_path, is_folder, tstamp, size, inode)
+                                    VALUES (?, ?, ?, ?, ?)''',
+                                (rel_path, is_dir, st.st_ctime_ns if is_dir else st.st_mtime_ns,
+                                 None if is_dir else st.st_size, st.st_ino))
+        elif quick_scan:
+            # A directory whose ctime hasn't changed since the last scan has
+            # had nothing added, removed or renamed in it, so its files are
+            # copied from the last scan instead of being stat'ed again.
+            c.execute('DROP TABLE IF EXISTS temp.fs_prev')
+            c.execute('CREATE TEMP TABLE fs_prev AS SELECT * FROM fs')
+            c.execute('CREATE INDEX temp.fs_prev_path ON fs_prev (file_path)')
+        if paths is None:
+            c.execute('DELETE FROM fs')
+            dirs = [('', None)]
+        else:
+            dirs = []
+        rows = []
+        def log(row):
+            rows.append(row)
+            if len(rows) >= 1000:
+                c.executemany('''INSERT OR REPLACE INTO fs (file_path, is_folder, tstamp, size, inode)
+                                    VALUES (?, ?, ?, ?, ?)''', rows)
+                del rows[:]
+                if remote is not None:
+                    for event in remote.ready():
+                        self.store_remote(sp_c, event)
+        while dirs:
+            rel_dir, tstamp = dirs.pop()
+            prefix = rel_dir + '/' if rel_dir else ''
+            if quick_scan and tstamp is not None:
+                c.execute('SELECT tstamp FROM fs_prev WHERE file_path = ? AND is_folder', (rel_dir,))
+                r = c.fetchone()
+                if r is not None and r[0] == tstamp:
+                    # Children of rel_dir from the last scan.  '0' is the
+                    # character after '/', so this is a range scan of the index.
+                    c.execute('''SELECT file_path, is_folder, tstamp, size, inode FROM fs_prev
+                                    WHERE file_path > ? AND file_path < ?
+                                    AND instr(substr(file_path, ?), '/') = 0''',
+                                (prefix, rel_dir + '0', len(prefix) + 1))
+                    for r in c.fetchall():
+                        if not r[1]:
+                            log(r)
+                            continue
+                        # Subdirectories may have changed even if this one hasn't
+                        try:
+                            dir_st = os.stat(str(self.path / r[0]))
+                        except OSError:
+                            continue
+                        dir_tstamp = dir_st.st_ctime_ns
+                        log((r[0], True, dir_tstamp, None, dir_st.st_ino))
+                        dirs.append((r[0], dir_tstamp))
+                    continue
+            try:
+                entries = os.scandir(str(self.path / rel_dir))
+            except OSError as e:
+                self.say(' *** Error: cannot read {}: {}'.format(rel_dir, e))
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.name.endswith(PARTIAL_SUFFIX):
+                        # An unfinished download
+                        continue
+                    if not rel_dir and entry.name.startswith('.sync.db'):
+                        # Skip our own database files
+                        continue
+                    try:
+                        is_dir = entry.is_dir()
+                        if self.rules.excluded(prefix + entry.name, is_dir):
+                            continue
+                        st = entry.stat()
+                    except OSError:
+                        # Broken symlinks and the like
+                        continue
+                    tstamp = st.st_ctime_ns if is_dir else st.st_mtime_ns
+                    log((prefix + entry.name, is_dir, tstamp, None if is_dir else st.st_size, st.st_ino))
+                    if is_dir:
+                        dirs.append((prefix + entry.name, tstamp))
+        c.executemany('''INSERT OR REPLACE INTO fs (file_path, is_folder, tstamp, size, inode)
+                            VALUES (?, ?, ?, ?, ?)''', rows)
+        c.execute('''UPDATE fs SET hash = (SELECT hash FROM hashes h WHERE h.file_path = fs.file_path
+                                        AND h.inode = fs.inode AND h.size = fs.size AND h.mtime = fs.tstamp)
+                        WHERE hash IS NULL AND NOT is_folder''')
+        if remote is None:
+            # Otherwise some of the remote listing has been stored too, and
+            # is only committed by from_sp once the listing is complete
+            self.conn.commit()
+
+    def local_hash(self, rel_path):
+        local_p = self.path / rel_path
+        st = local_p.stat()
+        with self.lock:
+            r = self.conn.execute('''SELECT hash FROM hashes
+                                        WHERE file_path = ? AND inode = ? AND size = ? AND mtime = ?''',
+                                    (rel_path, st.st_ino, st.st_size, st.st_mtime_ns)).fetchone()
+        if r is not None:
+            return r[0]
+        h = hashlib.sha256()
+        with local_p.open('rb') as f:
+            for chunk in iter(lambda: f.read(self.buffer_size), b''):
+                h.update(chunk)
+        self.save_hash(rel_path, st, h.hexdigest())
+        return h.hexdigest()
+
+    def save_hash(self, rel_path, st, hash):
+        with self.lock:
+            self.conn.execute('''INSERT OR REPLACE INTO hashes (file_path, inode, size, mtime, hash)
+                                    VALUES (?, ?, ?, ?, ?)''',
+                                (rel_path, st.st_ino, st.st_size, st.st_mtime_ns, hash))
+
+    def same_as_synced(self, row):
+        # Whether the local file's content is what was last synced
+        return (row['sync_hash'] is not None and row['fs_size'] == row['sync_size'] and
+                self.local_hash(row[0]) == row['sync_hash'])
+
+    def sync_to_sp(self, row):
         local_p = self.path / row[0]
+        if not row[5] and row[0] not in self.resuming and self.same_as_synced(row):
+            if row[3] is None:
+                # Deleted on the server, and only touched here since
+                self.unlink_from_fs(row)
+                return
+            # Touched, or restored from a backup, but no different
+            self.note('     Up to Date (same content): {}'.format(row[0]))
+            if not self.dry_run:
+                self.update_sync(row, row['sync_size'], row['sync_hash'], row['sp_ctag'], row['sp_etag'])
+            return
+        self.note(' < + Sync to Remote: {}'.format(row[0]))
+        if self.dry_run:
+            return
         if local_p.is_dir():
             self.sp_f.sp.create_folder(self.sp_f.path / row[0])
+            self.update_sync(row)
+        else:
+            st = local_p.stat()
+            size = st.st_size
+            # Only a copy needs the hash first; otherwise it is worked out
+            # from what is read for the upload
+            hash = self.local_hash(row[0]) if size >= COPY_MIN_SIZE else None
+            data = self.copy_synced(row, hash, size) if hash is not None else None
+            if data is not None:
+                self.stats.transferred('copied', size, files=1)
+            else:
+                try:
+                    if size > self.chunk_size:
+                        data, sent = self.upload_chunked(row, local_p)
+                    else:
+                        with local_p.open('rb') as f:
+                            f = Hashing(f)
+                            data = self.sp_f.sp.create_file(self.sp_f.path / row[0], f, size,
+                                                            self.remote_etag(row))
+                            sent = f.hexdigest()
+                        self.stats.transferred('up', size)
+                except Changed as e:
+                    self.note('       {}'.format(e))
+                    self.changed_remotely(row)
+                    return
+                self.stats.transferred('up', 0, files=1)
+                if hash is None:
+                    hash = sent
+                    self.save_hash(row[0], st, hash)
+            self.update_sync(row, size, hash, data.get('ContentTag'), data.get('ETag'))
+
+    def remote_etag(self, row):
+        # What the remote file must still have for an upload to replace it.
+        # Rows listed before ETags were recorded only ask that it's there.
+        if row[3] is None:
+            return None
+        return row['sp_etag'] or '*'
+
+    def changed_remotely(self, row):
+        # An upload was refused because the remote file has changed since it
+        # was listed.  Looks at it again and settles it as a conflict.
+        with self.lock:
+            self.conn.execute('DELETE FROM uploads WHERE file_path = ?', (row[0],))
+        try:
+            ff = self.sp_f.sp.get_file(self.sp_f.path / row[0])
+        except FileNotFoundError:
+            # Deleted there instead; the local copy goes back up
+            self.sync_to_sp(Relisted(row, sp_folder=None, sp_tstamp=None, sp_size=None, sp_hash=None,
+                                     sp_ctag=None, sp_url=None, sp_etag=None, sp_unique_id=None))
+            return
+        row = Relisted(row, sp_folder=False, sp_tstamp=epoch_ns(ff.timestamp), sp_size=int(ff.length),
+                       sp_hash=None, sp_ctag=ff.content_tag, sp_url=str(ff.path), sp_etag=ff.etag,
+                       sp_unique_id=ff.unique_id)
+        self.resolve(row, self.conflict_policy(row))
+
+    def copy_synced(self, row, hash, size):
+        # If a file already synced has the same content, copies it on the
+        # server instead of uploading this one.  The copy is refused if the
+        # original has changed there since it was synced.  Returns the new
+        # file's properties, or None if there was nothing to copy.
+        with self.lock:
+            originals = self.conn.execute('''SELECT file_path, etag FROM sync
+                                                WHERE hash = ? AND size = ? AND etag IS NOT NULL
+                                                AND file_path != ? LIMIT 3''',
+                                            (hash, size, row[0])).fetchall()
+        for original, etag in originals:
+            try:
+                f = self.sp_f.sp.copy(self.sp_f.path / original, self.sp_f.path / row[0], etag)
+            except (IOError, ValueError) as e:
+                self.note('       Not copying {}: {}'.format(original, e))
+                continue
+            self.note('       Copied on the server from {}'.format(original))
+            if row[0] in self.resuming:
+                # No need to finish the upload now
+                with self.lock:
+                    self.conn.execute('DELETE FROM uploads WHERE file_path = ?', (row[0],))
+            return f
+        return None
+
+    def upload_chunked(self, row, local_p):
+        # The upload session and how far it got are committed to the database
+        # after every chunk, so an interrupted upload carries on from there
+        # next time as long as the local file hasn't changed in between.
+        # Returns the new file's properties and the hash of what was sent.
+        sp = self.sp_f.sp
+        remote_p = self.sp_f.path / row[0]
+        st = local_p.stat()
+        with self.lock:
+            r = self.conn.execute('''SELECT upload_id, offset, size, mtime, placeholder FROM uploads
+                                        WHERE file_path = ?''', (row[0],)).fetchone()
+        ctag, etag = row['sp_ctag'], self.remote_etag(row)
+        # Whether the remote file is the empty one made for this upload
+        placeholder = r is not None and bool(r[4])
+        if r is not None and r[2] == st.st_size and r[3] == st.st_mtime_ns:
+            upload_id, offset = r[0], r[1]
+            self.note('       Resuming upload at {} of {} bytes'.format(offset, st.st_size))
         else:
-            result = self.sp_f.sp.create_file(self.sp_f.path / row[0], local_p.open('rb'), local_p.stat().st_size)
-        self.update_sync(row)
+            upload_id, offset = None, 0
+        # The hash of the first hashed bytes of the file
+        h, hashed = hashlib.sha256(), 0
+        with local_p.open('rb') as f:
+            while True:
+                if upload_id is None:
+                    upload_id, offset = str(uuid4()), 0
+                    if row[3] is None:
+                        # Upload sessions need a file to upload into
+                        data = sp.create_file(remote_p, b'', 0)
+                        ctag, etag = data.get('ContentTag'), data.get('ETag')
+                        placeholder = True
+                    self.save_upload(row, upload_id, offset, st, ctag, placeholder)
+                if offset < hashed:
+                    h, hashed = hashlib.sha256(), 0
+                # What an earlier sync sent still counts
+                f.seek(hashed)
+                for block in iter(lambda: f.read(min(self.buffer_size, offset - hashed)), b''):
+                    h.update(block)
+                    hashed += len(block)
+                chunk = f.read(self.chunk_size)
+                h.update(chunk)
+                hashed += len(chunk)
+                try:
+                    if offset + len(chunk) >= st.st_size:
+                        data = sp.upload_chunk(remote_p, 'FinishUpload', upload_id, offset, chunk, etag)
+                        self.stats.transferred('up', len(chunk))
+                        break
+                    offset = sp.upload_chunk(remote_p, 'StartUpload' if offset == 0 else 'ContinueUpload',
+                                             upload_id, offset, chunk, etag)
+                    self.stats.transferred('up', len(chunk))
+                except ValueError as e:
+                    if r is None:
+                        raise
+                    # The session we were resuming has expired; start again.
+                    self.note('       Upload session lost ({}), restarting'.format(e))
+                    r = upload_id = None
+                    continue
+                self.save_upload(row, upload_id, offset, st, ctag, placeholder)
+        with self.lock:
+            self.conn.execute('DELETE FROM uploads WHERE file_path = ?', (row[0],))
+        return data, h.hexdigest()
+
+    def save_upload(self, row, upload_id, offset, st, ctag, placeholder):
+        with self.lock:
+            self.conn.execute('''INSERT OR REPLACE INTO uploads (file_path, upload_id, offset, size, mtime, ctag,
+                                                                 placeholder)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                                (row[0], upload_id, offset, st.st_size, st.st_mtime_ns, ctag, placeholder))
+            self.conn.commit()
 
     def sync_to_fs(self, row):
-        print(' > + Sync to Local: {}'.format(row[0]))
+        # Works from what the listing recorded about the remote item rather
+        # than asking the server again.
+        self.note(' > + Sync to Local: {}'.format(row[0]))
         if self.dry_run:
             return
         local_p = self.path / row[0]
-        try:
-            file = self.sp_f.sp.get_file(self.sp_f.path / row[0])
-        except ValueError:
-            file = self.sp_f.sp.get_folder(self.sp_f.path / row[0])
-        download = False
-        if local_p.exists():
-            if local_p.is_dir():
-                if file.is_folder:
-                    # Both folders - do nothing
-                    pass
-                else:
-                    rmtree(local_p)
-                    download=True
-            else:
-                if file.is_folder:
-                    local_p.unlink()
-                    local_p.mkdir(parents=True)
-                else:
-                    download=True
-        else:
-            if file.is_folder:
+        if row[3]:
+            if local_p.exists() and not local_p.is_dir():
+                local_p.unlink()
+            if not local_p.exists():
                 local_p.mkdir(parents=True)
-            else:
-                download=True
+            self.update_sync(row)
+        else:
+            hash = self.download(row, local_p)
+            self.update_sync(row, row['sp_size'], hash, row['sp_ctag'], row['sp_etag'])
 
-        if download:
-            size = file.length
-            with local_p.open('wb') as f:
-                for chunk in file.read():
-                    f.write(chunk)
+    def compare(self, row):
+        # The file has turned up, or changed, on both sides since the last
+        # sync.  Fetch the remote copy to see whether it is the same as the
+        # local one.
+        self.note('     Comparing: {}'.format(row[0]))
+        if self.dry_run:
+            return
+        hash = self.download(row, self.path / row[0], replace=False)
+        if hash == self.local_hash(row[0]):
+            self.note('     Up to Date (same content): {}'.format(row[0]))
+            self.update_sync(row, row['sp_size'], hash, row['sp_ctag'], row['sp_etag'])
+        else:
+            self.resolve(row, self.conflict_policy(row))
+
+    def conflict_policy(self, row):
+        # How to settle a path changed on both sides: 'keep-both', 'remote',
+        # 'local' or 'defer'.  A choice made with `obsync.py conflicts` comes
+        # before the policy for the sync.
+        policy = self.resolutions.get(row[0]) or self.conflicts
+        if policy == 'newest':
+            policy = 'remote' if (row['sp_tstamp'] or 0) >= (row['fs_tstamp'] or 0) else 'local'
+        if policy in ('remote', 'local') and bool(row[3]) != bool(row[5]):
+            # A file on one side can't just replace a folder on the other
+            policy = 'keep-both'
+        return policy
 
-        self.update_sync(row)
+    def resolve(self, row, policy):
+        if policy == 'defer':
+            self.defer(row)
+        elif policy == 'keep-both':
+            self.keep_both(row)
+        elif policy == 'local':
+            self.note('  !  Conflict, taking the local copy: {}'.format(row[0]))
+            self.sync_to_sp(row)
+        else:
+            self.note('  !  Conflict, taking the remote copy: {}'.format(row[0]))
+            self.sync_to_fs(row)
+
+    def keep_both(self, row):
+        # The local copy is renamed out of the way, to be uploaded under its
+        # new name once the plan is done, and the remote one takes its place
+        rel_path = Path(row[0])
+        if row[5]:
+            name, suffix = rel_path.name, ''
+        else:
+            name, suffix = rel_path.stem, rel_path.suffix
+        stamp = time.strftime('%Y-%m-%d %H%M%S')
+        new = rel_path.with_name('{} (conflict {}){}'.format(name, stamp, suffix))
+        n = 1
+        while (self.path / new).exists():
+            n += 1
+            new = rel_path.with_name('{} (conflict {} {}){}'.format(name, stamp, n, suffix))
+        self.note('  !  Conflict, keeping both: {} (local copy now {})'.format(row[0], new))
+        if not self.dry_run:
+            os.rename(str(self.path / rel_path), str(self.path / new))
+            with self.lock:
+                c = self.conn.cursor()
+                for table in ('fs', 'hashes'):
+                    self.rename_rows(c, table, row[0], str(new))
+                self.kept.add(str(new))
+        self.sync_to_fs(row)
+
+    def defer(self, row):
+        self.say('  !  Conflict, left for later: {}'.format(row[0]))
+        if self.dry_run:
+            return
+        with self.lock:
+            self.conn.execute('''INSERT OR REPLACE INTO conflicts (file_path, found, local_tstamp, local_size,
+                                                                   local_folder, remote_tstamp, remote_size,
+                                                                   remote_folder)
+                                    VALUES (?, coalesce((SELECT found FROM conflicts WHERE file_path = ?), ?),
+                                            ?, ?, ?, ?, ?, ?)''',
+                                (row[0], row[0], now_ns(), row['fs_tstamp'], row['fs_size'], row[5],
+                                 row['sp_tstamp'], row['sp_size'], row[3]))
+
+    def resolve_later(self, paths, policy):
+        # Settles the deferred conflicts at paths, or all of them, with policy
+        # the next time each is synced.  Returns the paths.
+        c = self.conn.cursor()
+        if paths:
+            known = set(r[0] for r in c.execute('SELECT file_path FROM conflicts'))
+            for rel_path in paths:
+                if rel_path not in known:
+                    raise ValueError('{} is not a conflict left for later'.format(rel_path))
+        else:
+            paths = [r[0] for r in c.execute('SELECT file_path FROM conflicts')]
+        c.executemany('UPDATE conflicts SET resolution = ? WHERE file_path = ?',
+                        [(policy, rel_path) for rel_path in paths])
+        self.conn.commit()
+        return set(paths)
+
+    def remote_url(self, row):
+        # Rows listed before URLs were recorded don't have one
+        return row['sp_url'] or str(self.sp_f.path / row[0])
+
+    def download(self, row, local_p, replace=True):
+        # The local copy is only replaced once the whole file has arrived.  A
+        # partial download is kept and continued next time, provided the
+        # remote file hasn't changed since.  Returns the hash of the content;
+        # if replace is False, the download is thrown away once hashed.  The
+        # server refuses the download if the file has changed since it was
+        # listed.
+        part_p = local_p.with_name(local_p.name + PARTIAL_SUFFIX)
+        tstamp = row['sp_tstamp']
+        early = self.fetched_early(row[0], tstamp)
+        with self.lock:
+            r = self.conn.execute('SELECT tstamp FROM downloads WHERE file_path = ?', (row[0],)).fetchone()
+            if early and part_p.exists() and part_p.stat().st_size == row['sp_size']:
+                # Downloaded while the server was being listed
+                offset = row['sp_size']
+            elif (r is not None and r[0] == tstamp and part_p.exists() and
+                    part_p.stat().st_size <= row['sp_size']):
+                offset = part_p.stat().st_size
+                self.note('       Resuming download at {} of {} bytes'.format(offset, row['sp_size']))
+            else:
+                offset = 0
+            if r is None or r[0] != tstamp or not offset:
+                self.conn.execute('INSERT OR REPLACE INTO downloads (file_path, tstamp) VALUES (?, ?)',
+                                    (row[0], tstamp))
+                self.conn.commit()
+        h = hashlib.sha256()
+        if offset and offset == row['sp_size']:
+            # It has all arrived already; asking for the rest would be refused
+            response = None
+        else:
+            response = self.sp_f.sp.open_file(self.remote_url(row), offset, row['sp_etag'])
+        try:
+            if response is not None and response.status_code != 206:
+                # The server sent the whole file
+                offset = 0
+            if offset:
+                with part_p.open('rb') as f:
+                    for chunk in iter(lambda: f.read(self.buffer_size), b''):
+                        h.update(chunk)
+            if response is not None:
+                with part_p.open('ab' if offset else 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=self.buffer_size):
+                        h.update(chunk)
+                        f.write(chunk)
+                        self.stats.transferred('down', len(chunk))
+        finally:
+            if response is not None:
+                response.close()
+        self.stats.transferred('down', 0, files=1)
+        if part_p.stat().st_size != row['sp_size']:
+            raise IOError('Download of {} incomplete'.format(row[0]))
+        if not replace:
+            part_p.unlink()
+            with self.lock:
+                self.conn.execute('DELETE FROM downloads WHERE file_path = ?', (row[0],))
+            return h.hexdigest()
+        os.utime(str(part_p), ns=(tstamp, tstamp))
+        if local_p.is_dir():
+            rmtree(local_p)
+        os.replace(str(part_p), str(local_p))
+        self.save_hash(row[0], local_p.stat(), h.hexdigest())
+        with self.lock:
+            self.conn.execute('DELETE FROM downloads WHERE file_path = ?', (row[0],))
+        return h.hexdigest()
 
     def unlink_from_fs(self, row):
-        print(' > - Deleted from Remote: {}'.format(row[0]))
+        self.note(' > - Deleted from Remote: {}'.format(row[0]))
         if self.dry_run:
             return
         local_p = self.path / row[0]
@@ -186,101 +1406,506 @@ class DB():
             else:
                 local_p.unlink()
         else:
-            print('       Already gone')
+            self.note('       Already gone')
         self.remove_from_sync(row)
 
-    def unlink_from_sp(self, row):
-        print(' < - Deleted from Local: {}'.format(row[0]))
-        if self.dry_run:
-            return
+    def update_sync(self, row, size=None, hash=None, ctag=None, etag=None):
+        tstamp = now_ns()
         try:
-            if row[3]:
-                file = self.sp_f.sp.get_folder(self.sp_f.path / row[0])
-            else:
-                file = self.sp_f.sp.get_file(self.sp_f.path / row[0])
-            file.delete()
-        except ValueError:
-            # File already missing from remote side
-            print('       Already gone')
-            pass
-        self.remove_from_sync(row)
-
-    def update_sync(self, row):
-        c = self.conn.cursor()
-        tstamp = datetime.now()
-        c.execute('''INSERT OR REPLACE INTO sync (file_path, is_folder, synced, last_sync)
-                        VALUES (?, ?, ?, ?)''',
+            st = os.lstat(str(self.path / row[0]))
+            inode, mtime = st.st_ino, st.st_mtime_ns
+        except OSError:
+            inode = mtime = None
+        with self.lock:
+            self.conn.execute('''INSERT OR REPLACE INTO sync (file_path, is_folder, synced, last_sync, size, hash, ctag,
+                                                              inode, mtime, unique_id, etag)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
                     # The 'not not' here forces 'None' to evaluate to a real boolean value.
                     # max(x or y, y or x) will give the maximum, treating None as the minimumest
                     # possible value.
-                    (row[0], row[3] or not not row[5], True, tstamp))
+                    (row[0], row[3] or not not row[5], True, tstamp, size, hash, ctag,
+                     inode, mtime, row['sp_unique_id'], etag))
+            self.settled(row)
 
     def remove_from_sync(self, row):
-        c = self.conn.cursor()
-        c.execute('DELETE FROM sync WHERE file_path = ?', (row[0],))
+        with self.lock:
+            self.conn.execute('DELETE FROM sync WHERE file_path = ?', (row[0],))
+            self.settled(row)
 
-    def sync(self):
-        self.from_fs()
-        self.from_sp()
+    def settled(self, row):
+        # However a conflict left for later has come to be in sync, it's over
+        if row[0] in self.open_conflicts:
+            self.conn.execute('DELETE FROM conflicts WHERE file_path = ?', (row[0],))
 
-        c = self.conn.cursor()
-        c.execute(sync_query)
-
-        for row in c.fetchall():
-            sync = (row[1], Moment(row[2]).locale('UTC') if row[2] else None)
-            sp = (row[3], Moment(row[4]) if row[4] else None)
-            fs = (row[5], unix(row[6], utc=True) if row[6] else None)
-            # Figure out which version is newest and sync that version to the other
-            local_p = self.path / row[0]
-#            print(row[0], sync, sp, fs)
-            if sync[0] is None:
-                if sp[0] is None and fs[0] is not None:
-                    # The file only exists on the FS and hasn't previously been seen
-                    # so sync it to the server
-                    self.sync_to_sp(row)
-                elif sp[0] is not None and fs[0] is None:
-                    # The file only exists on the server and hasn't previously been seen.
-                    # Sync it to the FS
-                    self.sync_to_fs(row)
-                elif sp[0] is not None and fs[0] is not None:
-                    # The file has appeared on both sides since the last sync.
-                    print(' *** Error: file {} conflict'.format(row[0]))
-                else:
-                    # The file has been deleted on both sides since the last sync.
-                    print(' --- Deleted from Both: {}'.format(row[0]))
-                    self.remove_from_sync(row)
+    def mark_dirty(self, c, paths):
+        # Fills the dirty table with paths and everything under them
+        c.execute('CREATE TEMP TABLE IF NOT EXISTS dirty (file_path text primary key)')
+        c.execute('DELETE FROM dirty')
+        for rel_path in paths:
+            c.execute('INSERT OR IGNORE INTO dirty (file_path) VALUES (?)', (rel_path,))
+            for table in ('sync', 'sp', 'fs'):
+                c.execute('''INSERT OR IGNORE INTO dirty (file_path)
+                                SELECT file_path FROM {} WHERE file_path > ? AND file_path < ?'''.format(table),
+                            (rel_path + '/', rel_path + '0'))
+
+    def plan(self, filter):
+        # Works out what to do with every path in one query, into the plan
+        # table.  Each row is marked done once it has been dealt with, and the
+        # plan and its progress are committed as the sync goes, so that an
+        # interrupted sync can carry on where it stopped.  plan_token is the
+        # change token from before the plan was made; while it is set, the
+        # plan is unfinished.  A dry run's plan is a temporary table, which
+        # hides any unfinished one without touching it.
+        with self.lock:
+            if self.dry_run:
+                self.conn.execute('DROP TABLE IF EXISTS temp.plan')
+                self.conn.execute('CREATE TEMP TABLE plan AS ' + sync_query.format(filter=filter))
             else:
-                if sp[0] is None or fs[0] is None:
-                    if sp[0] is not None:
-                        self.unlink_from_sp(row)
-                    if fs[0] is not None:
-                        self.unlink_from_fs(row)
-                    if sp[0] is None and fs[0] is None:
-                        print(' --- Deleted from Both: {}'.format(row[0]))
-                    self.remove_from_sync(row)
+                self.conn.execute('DROP TABLE IF EXISTS plan')
+                self.conn.execute('CREATE TABLE plan AS ' + sync_query.format(filter=filter))
+            self.conn.execute('ALTER TABLE plan ADD COLUMN done boolean DEFAULT 0')
+            self.conn.execute('CREATE INDEX plan_fp ON plan (fp)')
+            if not self.dry_run:
+                # An upload the remote file has changed under is abandoned,
+                # and the path synced like any other
+                self.conn.execute('''DELETE FROM uploads WHERE file_path IN
+                                        (SELECT fp FROM plan WHERE action != 'resume')''')
+                self.set_state('plan_token', self.change_token or '')
+            self.conn.commit()
+        self.last_commit = time.time()
+
+    def unfinished(self):
+        # The paths left to deal with by a sync that was interrupted, or None
+        if self.get_state('plan_token') is None:
+            return None
+        try:
+            return set(r[0] for r in self.conn.execute('SELECT fp FROM plan WHERE NOT done'))
+        except sqlite3.OperationalError:
+            return None
+
+    def mark_done(self, row):
+        if self.dry_run:
+            return
+        with self.lock:
+            self.conn.execute('UPDATE plan SET done = 1 WHERE rowid = ?', (row['rowid'],))
+            if time.time() - self.last_commit > CHECKPOINT_INTERVAL:
+                self.conn.commit()
+                self.last_commit = time.time()
+
+    def planned(self, batch=1000):
+        # Hands out the plan's rows a batch at a time so the whole tree is
+        # never in memory at once.  Workers commit as they go, so no
+        # statement is left open between batches.
+        last = 0
+        while True:
+            with self.lock:
+                c = self.conn.cursor()
+                c.row_factory = sqlite3.Row
+                rows = c.execute('SELECT *, rowid FROM plan WHERE rowid > ? AND NOT done ORDER BY rowid LIMIT ?',
+                                    (last, batch)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row
+            last = rows[-1]['rowid']
+
+    def watch(self, interval, stop=None):
+        # Syncs, then keeps syncing whatever changes locally as it happens,
+        # and whatever has changed on the server every interval seconds,
+        # until stop (a threading.Event) is set.  A sync under way when it is
+        # set is finished first.  Folders left out of the sync aren't even
+        # watched
+        if stop is None:
+            stop = threading.Event()
+        watcher = Watcher(self.path, lambda rel_path: (rel_path.startswith('.sync.db') or
+                                                       rel_path.endswith(PARTIAL_SUFFIX) or
+                                                       self.rules.excluded(rel_path, (self.path / rel_path).is_dir())))
+        # The paths to look at in the next round, None for everything
+        changes = None
+        failures = 0
+        try:
+            while not stop.is_set():
+                try:
+                    if self.sync(changes) and changes is None:
+                        # Only the interrupted sync was finished
+                        continue
+                except Exception as e:
+                    # Try the same paths again later, along with whatever
+                    # changes in the meantime
+                    delay = min(WATCH_MAX_BACKOFF, WATCH_BACKOFF * 2 ** failures)
+                    failures += 1
+                    self.say(' *** Error: {}; trying again in {}s'.format(e, delay))
+                    stop.wait(delay)
+                    changes = merge_changes(changes, watcher.wait(0))
+                    continue
+                failures = 0
+                # Whatever failed to transfer is tried again next round
+                changes = merge_changes(self.failed, watcher.wait(interval, stop=stop))
+        finally:
+            watcher.close()
+
+    def parent_task(self, rel_path):
+        # The task for the nearest folder above rel_path, if there is one
+        p = Path(rel_path).parent
+        while p != Path('.'):
+            task = self.folder_tasks.get(str(p))
+            if task is not None:
+                return task
+            p = p.parent
+        return None
+
+    def submit(self, action, row):
+        # Anything inside a folder waits for whatever is being done to the
+        # folder itself.  Rows arrive sorted by path, so the folder's task was
+        # queued first and has already started by the time this one does.
+        # If the folder is in a batch that hasn't been sent yet, or is held
+        # back itself, this is held back until the batch is sent, so that
+        # the batch can fill up first.
+        parent = self.parent_task(row[0])
+        if parent in self.batched or parent in self.held_tasks:
+            future = Future()
+            self.held.append((action, row, parent, future))
+            self.held_tasks.add(future)
+        else:
+            future = self.start(action, row, parent)
+        future.file_path = row[0]
+        if row[1] or row[3] or row[5]:
+            self.folder_tasks[row[0]] = future
+        if len(self.held) >= HELD_LIMIT:
+            self.flush()
+
+    def start(self, action, row, parent, held=None):
+        # Runs action on row once parent is done.  held, if given, is the
+        # future that stood in for this while it was held back, and gets
+        # the same result.
+        def run():
+            if parent is not None:
+                parent.result()
+            action(row)
+            self.mark_done(row)
+        future = self.executor.submit(run)
+        future.file_path = row[0]
+        if held is not None:
+            def settle(future):
+                if held.done():
+                    # Cancelled while the sync was being stopped
+                    return
+                if future.cancelled():
+                    held.cancel()
+                elif future.exception() is not None:
+                    held.set_exception(future.exception())
                 else:
-                    if sync[1] >= sp[1] and sync[1] >= fs[1]:
-                        # Both sides are older than the last sync
-                        if sp[0]:
-                            print('     Up to Date Folder: {}'.format(row[0]))
-                        else:
-                            print('     Up to Date: {}'.format(row[0]))
-                    elif sp[0] and fs[0]:
-                        # Both sides are folders.  Leave them be.
-                        print('     Up to Date Folder: {}'.format(row[0]))
-                    elif sync[1] < sp[1] and sync[1] < fs[1]:
-                        print(' *** Error: file {} conflict'.format(row[0]))
-                        resp = ''
-                        while len(resp) == 0 or (resp[0] != 'r' and resp[0] != 'l'):
-                            resp = input('     Take [R]emote or [L]ocal? ').lower()
-                        if resp[0] == 'l':
-                            self.sync_to_sp(row)
-                        else:
-                            self.sync_to_fs(row)
-                    elif sp[1] >= sync[1] and sp[1] >= fs[1]:
-                        # SP version is newer
-                        self.sync_to_fs(row)
-                    elif fs[1] >= sync[1] and fs[1] >= sp[1]:
-                        # Local version is newer
-                        self.sync_to_sp(row)
+                    held.set_result(None)
+            future.add_done_callback(settle)
+        self.pending.add(future)
+        if len(self.pending) >= self.jobs * 4:
+            done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+            self.finished(done)
+        return future
+
+    def queue(self, kind, row):
+        # Folder creates ('mkdir') and remote deletes ('delete') are sent to
+        # the server in batches, in the order they arrive, so parents are
+        # created before their contents.  Deleting something inside a folder
+        # that is being deleted takes no request at all ('forget').
+        self.note(' < + Sync to Remote: {}'.format(row[0]) if kind == 'mkdir' else
+              ' < - Deleted from Local: {}'.format(row[0]))
+        if self.dry_run:
+            return
+        parent = self.parent_task(row[0])
+        if parent in self.held_tasks:
+            # What this waits for has to be under way before the batch it
+            # goes in is sent
+            self.flush()
+        if kind == 'delete' and getattr(parent, 'kind', None) in ('delete', 'forget'):
+            kind = 'forget'
+        future = Future()
+        future.file_path = row[0]
+        future.kind = kind
+        if row[1] or row[3] or row[5]:
+            self.folder_tasks[row[0]] = future
+        self.batch.append((kind, row, future, parent))
+        self.batched.add(future)
+        if len(self.batch) >= BATCH_LIMIT:
+            self.flush()
+
+    def flush(self):
+        # Sends the batch, then starts what was held back for it.  Workers
+        # take tasks in the order they are submitted, so nothing started here
+        # can keep the batch waiting.
+        batch, self.batch = self.batch, []
+        self.batched = set()
+        if batch:
+            self.executor.submit(self.send_batch, batch)
+            self.pending.update(entry[2] for entry in batch)
+        held, self.held = self.held, []
+        self.held_tasks = set()
+        for action, row, parent, future in held:
+            self.start(action, row, parent, future)
+
+    def send_batch(self, batch):
+        # Each entry's future gets its own result, so one failed operation
+        # doesn't fail the others.
+        own = set(entry[2] for entry in batch)
+        sp = self.sp_f.sp
+        try:
+            sending = []
+            for kind, row, future, parent in batch:
+                if parent is not None and parent not in own:
+                    # Waiting on something outside the batch
+                    try:
+                        parent.result()
+                    except Exception as e:
+                        future.set_exception(e)
+                        continue
+                if kind != 'forget':
+                    sending.append(future)
+            ops = [sp.folder_op(self.sp_f.path / row[0]) if kind == 'mkdir' else
+                   sp.delete_op(self.remote_url(row), row[3], row['sp_etag'])
+                   for kind, row, future, parent in batch if future in sending]
+            results = dict(zip(sending, sp.batch(ops)))
+            for kind, row, future, parent in batch:
+                if future.done():
+                    continue
+                try:
+                    if parent in own:
+                        # Earlier in the batch, so already settled
+                        parent.result()
+                    self.batch_result(kind, row, results.get(future))
+                    self.mark_done(row)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(None)
+        except Exception as e:
+            for kind, row, future, parent in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def batch_result(self, kind, row, result):
+        status = result[0] if result else None
+        if kind == 'mkdir':
+            if status not in (200, 201):
+                raise IOError('Creating folder failed with status {}'.format(status))
+            self.update_sync(row)
+            return
+        if kind == 'delete':
+            if status == 404:
+                self.note('       Already gone: {}'.format(row[0]))
+            elif status == 412:
+                raise IOError('{} has changed on the server since it was listed'.format(row[0]))
+            elif status is None or status >= 300:
+                raise IOError('Delete failed with status {}'.format(status))
+        self.remove_from_sync(row)
+
+    def finished(self, futures):
+        for future in futures:
+            if future.exception() is not None:
+                self.say(' *** Error: {}: {}'.format(future.file_path, future.exception()))
+                self.failed.add(future.file_path)
+
+    def sync(self, local_changes=None):
+        # local_changes, if given, is the set of local paths that have
+        # changed since the last sync.  Only those and whatever has changed
+        # on the server are looked at.  If the last sync was interrupted,
+        # this one only finishes it, looking again at what it had left to do
+        # and what has changed on the server since it started; returns True
+        # if so.
+        start = time.time()
+        # Paths whose transfers failed
+        self.failed = set()
+        unfinished = self.unfinished()
+        token = None
+        if unfinished is not None:
+            self.say('Carrying on with an interrupted sync, {} paths left'.format(len(unfinished)))
+            local_changes = unfinished | (local_changes or set())
+            token = self.get_state('plan_token')
+        remote = self.list_remote(token)
+        # Transfers, the early downloads among them, run on the shared pool
+        # if there is one, so that they count against the same limit
+        self.executor = self.shared_executor or ThreadPoolExecutor(max_workers=self.jobs)
+        # Downloads started while the server is being listed, and when the
+        # first of them was
+        self.early = {}
+        self.transfers_started = None
+        try:
+            try:
+                with self.stats.phase('from_fs'):
+                    self.from_fs(local_changes, remote)
+                with self.stats.phase('from_sp'):
+                    remote_changes = self.from_sp(remote)
+            except BaseException:
+                # Keep nothing of a listing that didn't finish
+                self.conn.rollback()
+                raise
+            finally:
+                remote.close()
+            if remote_changes is None and local_changes is not None:
+                # Everything is to be looked at again, but only the paths in
+                # local_changes were scanned; whatever else changed locally,
+                # an interrupted sync's downloads among it, is missing from fs
+                with self.stats.phase('from_fs'):
+                    self.from_fs()
+            self.forget_excluded()
+            with self.stats.phase('find_moves'):
+                moved = self.find_moves()
+
+            with self.stats.phase('plan'):
+                if local_changes is None or remote_changes is None:
+                    self.plan('')
+                else:
+                    self.mark_dirty(self.conn.cursor(), local_changes | remote_changes | moved)
+                    self.plan('and fp in (select file_path from dirty)')
+            # Early downloads are transfers too, so the phase starts with
+            # them, overlapping the listing
+            with self.stats.phase('transfers', self.transfers_started):
+                self.run_plan()
+                if self.kept:
+                    # Upload the local copies that conflicts moved out of the way
+                    kept = self.kept
+                    self.from_fs(kept)
+                    self.mark_dirty(self.conn.cursor(), kept)
+                    self.plan('and fp in (select file_path from dirty)')
+                    self.run_plan()
+        finally:
+            self.forget_early()
+            if self.shared_executor is None:
+                self.executor.shutdown()
+        scheduler = self.sp_f.sp.scheduler
+        # With a shared pool the figures are for every root, and reported
+        # once they have all finished
+        if self.shared_executor is None and (scheduler.throttled or scheduler.retries):
+            self.say('{} requests, {} throttled, {} retried'.format(
+                    scheduler.requests, scheduler.throttled, scheduler.retries))
+        self.set_state('auth_token', json.dumps(self.sp_f.sp.token))
+        if self.dry_run:
+            # Nothing was done, so the next sync starts from the same place
+            self.conn.execute('DROP TABLE temp.plan')
+        else:
+            self.set_state('change_token', self.change_token)
+            self.conn.execute("DELETE FROM state WHERE key = 'plan_token'")
+            self.conn.execute('DROP TABLE plan')
         self.conn.commit()
+        self.stats.synced(start)
+        if self.stats_json:
+            self.stats.write_json(self.stats_json, scheduler)
+        if self.prometheus:
+            self.stats.write_prometheus(self.prometheus, scheduler)
+        return unfinished is not None
+
+    def run_plan(self):
+        # Carries out the plan, transfers on worker threads
+        self.folder_tasks = {}
+        self.pending = set()
+        self.batch = []
+        self.batched = set()
+        self.held = []
+        self.held_tasks = set()
+        self.resuming = set(r[0] for r in self.conn.execute('SELECT file_path FROM uploads'))
+        self.open_conflicts = set()
+        self.resolutions = {}
+        for rel_path, resolution in self.conn.execute('SELECT file_path, resolution FROM conflicts'):
+            self.open_conflicts.add(rel_path)
+            if resolution:
+                self.resolutions[rel_path] = resolution
+        # Local copies renamed out of the way of conflicts, and folders whose
+        # contents are left alone for now
+        self.kept = set()
+        self.set_aside = set()
+        transfers = {
+            'resume': self.sync_to_sp,
+            'to_remote': self.sync_to_sp,
+            'to_local': self.sync_to_fs,
+            'compare': self.compare,
+            'delete_local': self.unlink_from_fs,
+        }
+        try:
+            self.run_rows(transfers)
+        except BaseException:
+            # Start nothing more, but let what is under way finish, so that
+            # it is recorded as done
+            for future in self.pending | self.batched | self.held_tasks:
+                future.cancel()
+            raise
+        finally:
+            wait(self.pending)
+            with self.lock:
+                self.conn.commit()
+        self.finished(self.pending)
+
+    def run_rows(self, transfers):
+        for row in self.planned():
+            action = row['action']
+            self.stats.action(action)
+            if self.set_aside and self.is_set_aside(row[0]):
+                self.mark_done(row)
+            elif action == 'to_remote' and row[5]:
+                self.queue('mkdir', row)
+            elif action == 'delete_remote' and row[3] and self.changed_inside(row[0], action):
+                # Deleting the folder would take what changed with it
+                self.note('  !  Keeping folder deleted locally, its contents changed on the server: {}'
+                          .format(row[0]))
+                self.submit(self.sync_to_fs, row)
+            elif action == 'delete_local' and row[5] and self.changed_inside(row[0], action):
+                self.note('  !  Keeping folder deleted on the server, its contents changed locally: {}'
+                          .format(row[0]))
+                self.queue('mkdir', row)
+            elif action == 'delete_remote':
+                self.queue('delete', row)
+            elif action in transfers:
+                self.submit(transfers[action], row)
+            elif action == 'up_to_date':
+                if row[3]:
+                    self.note('     Up to Date Folder: {}'.format(row[0]))
+                else:
+                    self.note('     Up to Date: {}'.format(row[0]))
+                self.mark_done(row)
+            elif action == 'metadata':
+                # Only the remote file's metadata has changed
+                self.note('     Up to Date (same content): {}'.format(row[0]))
+                if not self.dry_run:
+                    self.update_sync(row, row['sync_size'], row['sync_hash'], row['sp_ctag'], row['sp_etag'])
+                self.mark_done(row)
+            elif action == 'forget':
+                self.note(' --- Deleted from Both: {}'.format(row[0]))
+                self.remove_from_sync(row)
+                self.mark_done(row)
+            elif action == 'adopt':
+                self.note('     Up to Date Folder: {}'.format(row[0]))
+                if not self.dry_run:
+                    self.update_sync(row)
+                self.mark_done(row)
+            elif action == 'conflict' and self.same_as_synced(row):
+                # Both sides have changed, but the local content is what we
+                # last synced, so only the remote copy has really changed.
+                self.submit(self.sync_to_fs, row)
+            elif (action == 'conflict' and not row[3] and not row[5] and row['sp_size'] == row['fs_size'] and
+                    not (row[0] in self.open_conflicts and self.conflict_policy(row) == 'defer')):
+                # Both copies may have been changed the same way.  One already
+                # left for later was compared when it was deferred, and isn't
+                # downloaded again every sync while it waits.
+                self.submit(self.compare, row)
+            else:
+                # Changed on both sides.  Nothing waits for anyone to decide.
+                policy = self.conflict_policy(row)
+                if policy == 'defer' or (policy == 'keep-both' and row[5]):
+                    # Whatever is inside stays where it is
+                    self.set_aside.add(row[0])
+                self.submit(lambda row, policy=policy: self.resolve(row, policy), row)
+        self.flush()
+
+    def changed_inside(self, rel_path, delete):
+        # Whether anything in the folder rel_path is to be kept rather than
+        # deleted along with it by delete, 'delete_remote' or 'delete_local'
+        with self.lock:
+            return self.conn.execute('''SELECT 1 FROM plan WHERE fp > ? AND fp < ?
+                                           AND action NOT IN (?, 'forget') LIMIT 1''',
+                                        (rel_path + '/', rel_path + '0', delete)).fetchone() is not None
+
+    def is_set_aside(self, rel_path):
+        p = Path(rel_path).parent
+        while p != Path('.'):
+            if str(p) in self.set_aside:
+                return True
+            p = p.parent
+        return False
@@ -0,0 +1,567 @@
+#!/usr/bin/env python3
+
+# A stand-in for the parts of SharePoint's REST API that sharepoint.py uses,
+# for benchmarking and trying things out without a real tenant.  The tree is
+# kept in memory, or with file contents in a directory if given one.
+# Latency, throttling and errors can be injected.  There is no logging in:
+# hand SharePoint() any token and it is taken, unless the mock has been given
+# a token of its own to insist on.  Form digests are checked, and can be
+# made to expire.
+
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from datetime import datetime, timezone
+from http.client import HTTPMessage
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, unquote, parse_qs
+from uuid import uuid4
+
+# SP.ChangeType
+CHANGE_ADD = 1
+CHANGE_UPDATE = 2
+CHANGE_DELETE = 3
+CHANGE_RENAME = 4
+
+STATUS_TEXT = { 200: 'OK', 201: 'Created', 204: 'No Content', 206: 'Partial Content', 400: 'Bad Request',
+                404: 'Not Found', 409: 'Conflict', 412: 'Precondition Failed', 429: 'Too Many Requests',
+                500: 'Internal Server Error', 503: 'Service Unavailable' }
+
+# A quoted path in a URL, with quotes inside it doubled
+QUOTED = r"'((?:[^']|'')*)'"
+
+routes = [(re.compile(pattern + '$'), name) for pattern, name in (
+    (r"GetFolderByServerRelativeUrl\({}\)/Properties".format(QUOTED), 'properties'),
+    (r"GetFolderByServerRelativeUrl\({}\)/Files/add\(url={}, *overwrite=(\w+)\)".format(QUOTED, QUOTED), 'add_file'),
+    (r"GetFolderByServerRelativeUrl\({}\)/moveto\(newurl={}\)".format(QUOTED, QUOTED), 'move'),
+    (r"GetFolderByServerRelativeUrl\({}\)".format(QUOTED), 'folder'),
+    (r"GetFileByServerRelativeUrl\({}\)/\$value".format(QUOTED), 'value'),
+    (r"GetFileByServerRelativeUrl\({}\)/(StartUpload|ContinueUpload|FinishUpload)"
+     r"\(uploadId=guid'([^']*)'(?:,fileOffset=(\d+))?\)".format(QUOTED), 'upload'),
+    (r"GetFileByServerRelativeUrl\({}\)/moveto\(newurl={},flags=\d+\)".format(QUOTED, QUOTED), 'move'),
+    (r"GetFileByServerRelativeUrl\({}\)/copyTo\(strNewUrl={},bOverWrite=(\w+)\)".format(QUOTED, QUOTED), 'copy'),
+    (r"GetFileByServerRelativeUrl\({}\)".format(QUOTED), 'file'),
+    (r"folders", 'add_folder'),
+    (r"lists\(guid'([^']*)'\)/items\((\d+)\)", 'item'),
+    (r"lists\(guid'([^']*)'\)/items", 'items'),
+    (r"lists\(guid'([^']*)'\)/GetChanges", 'changes'),
+    (r"lists\(guid'([^']*)'\)", 'list'),
+)]
+
+REQUEST_LINE = re.compile(r'^(GET|POST|PUT|PATCH|MERGE|DELETE) (\S+) HTTP/1\.1$')
+
+def now():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def unquote_path(s):
+    return s.replace("''", "'")
+
+def error(status, message):
+    return status, {}, { 'odata.error': { 'code': str(status), 'message': { 'lang': 'en-US', 'value': message }}}
+
+class Node():
+    def __init__(self, path, is_folder, item_id):
+        self.path = path
+        self.is_folder = is_folder
+        self.item_id = item_id
+        self.unique_id = str(uuid4())
+        self.version = 1
+        self.modified = now()
+        self.content = b''
+        self.length = 0
+        self.uploads = {}
+
+    @property
+    def name(self):
+        return self.path.rsplit('/', 1)[-1]
+
+    @property
+    def etag(self):
+        return '"{{{}}},{}"'.format(self.unique_id.upper(), self.version)
+
+    @property
+    def content_tag(self):
+        return '{{{}}},{},1'.format(self.unique_id.upper(), self.version)
+
+class MockSharePoint():
+    def __init__(self, site='/sites/bench', library='Shared Documents', store=None,
+                 latency=0, throttle=0, errors=0, retry_after=0, page_size=None, seed=None):
+        self.site = site.rstrip('/')
+        self.root = self.site + '/' + library
+        # If given, file contents are kept in files in this directory
+        self.store = store
+        # Seconds added to every request, and the fraction of requests that
+        # are throttled (429) or fail (500)
+        self.latency = latency
+        self.throttle = throttle
+        self.errors = errors
+        self.retry_after = retry_after
+        # The most items sent in one page of a list query, if fewer than
+        # were asked for
+        self.page_size = page_size
+        # If set, the only bearer token accepted
+        self.token = None
+        # The form digests handed out that are still good
+        self.digests = set()
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.list_id = str(uuid4())
+        self.next_id = 1
+        self.nodes = {}
+        self.children = {}
+        self.changes = []
+        self.add(self.root, True)
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = Counter()
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    # The tree
+
+    def add(self, path, is_folder, data=b''):
+        with self.lock:
+            node = self.nodes.get(path)
+            if node is None:
+                node = Node(path, is_folder, self.next_id)
+                self.next_id += 1
+                self.nodes[path] = node
+                if is_folder:
+                    self.children[path] = set()
+                parent = path.rsplit('/', 1)[0]
+                if parent in self.children:
+                    self.children[parent].add(path)
+                self.change(CHANGE_ADD, node)
+            elif not is_folder:
+                node.version += 1
+                node.modified = now()
+                self.change(CHANGE_UPDATE, node)
+            if not is_folder:
+                self.write(node, data)
+            return node
+
+    def put(self, path, data=b''):
+        # Adds a file, and any folders it needs
+        parts = path[len(self.root) + 1:].split('/')
+        for i in range(1, len(parts)):
+            self.add('/'.join([self.root] + parts[:i]), True)
+        return self.add(path, False, data)
+
+    def remove(self, path):
+        with self.lock:
+            node = self.nodes.pop(path)
+            for child in list(self.children.pop(path, ())):
+                self.remove(child)
+            parent = path.rsplit('/', 1)[0]
+            if parent in self.children:
+                self.children[parent].discard(path)
+            if self.store and not node.is_folder:
+                try:
+                    os.unlink(self.content_path(node))
+                except OSError:
+                    pass
+            return node
+
+    def move(self, path, new_path):
+        with self.lock:
+            node = self.nodes[path]
+            self.change(CHANGE_RENAME, node)
+            for old in sorted(p for p in self.nodes if p == path or p.startswith(path + '/')):
+                moved = self.nodes.pop(old)
+                moved.path = new_path + old[len(path):]
+                self.nodes[moved.path] = moved
+                if old in self.children:
+                    self.children[moved.path] = set(new_path + p[len(path):] for p in self.children.pop(old))
+            self.children[path.rsplit('/', 1)[0]].discard(path)
+            self.children[new_path.rsplit('/', 1)[0]].add(new_path)
+            node.modified = now()
+
+    def change(self, change_type, node):
+        self.changes.append((change_type, node.item_id))
+
+    @property
+    def change_token(self):
+        return '1;3;{};{};-1'.format(self.list_id, len(self.changes))
+
+    def content_path(self, node):
+        return os.path.join(self.store, node.unique_id)
+
+    def write(self, node, data):
+        if self.store:
+            with open(self.content_path(node), 'wb') as f:
+                f.write(data)
+        else:
+            node.content = data
+        node.length = len(data)
+
+    def read(self, node, offset=0):
+        if self.store:
+            with open(self.content_path(node), 'rb') as f:
+                f.seek(offset)
+                return f.read()
+        return node.content[offset:]
+
+    def resolve(self, path):
+        # Paths may be given relative to the site
+        path = unquote_path(path).rstrip('/')
+        if not path.startswith('/'):
+            path = self.site + '/' + path
+        return path
+
+    # JSON for the things in the tree
+
+    def folder_json(self, node):
+        return { 'Name': node.name, 'ServerRelativeUrl': node.path, 'TimeLastModified': node.modified,
+                 'ItemCount': len(self.children.get(node.path, ())), 'UniqueId': node.unique_id }
+
+    def file_json(self, node):
+        # Length is an Edm.Int64, which comes as a string
+        return { 'Name': node.name, 'ServerRelativeUrl': node.path, 'TimeLastModified': node.modified,
+                 'Length': str(node.length), 'UniqueId': node.unique_id, 'ETag': node.etag,
+                 'ContentTag': node.content_tag, 'UIVersionLabel': '{}.0'.format(node.version) }
+
+    def item_json(self, node):
+        return { 'Id': node.item_id, 'FileRef': node.path, 'FSObjType': 1 if node.is_folder else 0,
+                 'File': None if node.is_folder else self.file_json(node),
+                 'Folder': self.folder_json(node) if node.is_folder else None }
+
+    # Requests
+
+    def request(self, method, url, headers, body):
+        # Returns (status, headers, body bytes) for one HTTP request
+        with self.lock:
+            self.bytes_in += len(body)
+        if self.latency:
+            time.sleep(self.latency)
+        roll = self.random.random()
+        if roll < self.throttle:
+            kind, result = 'throttled', (429, { 'Retry-After': str(self.retry_after) }, b'')
+        elif roll < self.throttle + self.errors:
+            kind, result = 'failed', error(500, 'Injected error')
+        else:
+            kind, result = self.refuse(method, url, headers) or self.dispatch(method, url, headers, body)
+        status, response_headers, data = result
+        if not isinstance(data, bytes):
+            data = json.dumps(data).encode('utf-8')
+            response_headers = dict(response_headers, **{ 'Content-Type': 'application/json' })
+        with self.lock:
+            self.requests[kind] += 1
+            self.bytes_out += len(data)
+        return status, response_headers, data
+
+    def refuse(self, method, url, headers):
+        # Turns the request down the way SharePoint does when its token or
+        # form digest has expired, or returns None
+        if self.token is not None and headers.get('Authorization') != 'Bearer ' + self.token:
+            return 'unauthorized', error(401, 'Invalid token')
+        if (method == 'POST' and not urlsplit(url).path.endswith('/_api/contextinfo') and
+                headers.get('X-RequestDigest') not in self.digests):
+            return 'stale digest', (403, {}, { 'odata.error': {
+                'code': '-2130575251, Microsoft.SharePoint.SPException',
+                'message': { 'lang': 'en-US', 'value': 'The security validation for this page is invalid.' }}})
+        return None
+
+    def expire_digests(self):
+        with self.lock:
+            self.digests = set()
+
+    def dispatch(self, method, url, headers, body):
+        # Returns the kind of request, for counting, and its result
+        parts = urlsplit(url)
+        path = unquote(parts.path)
+        query = parse_qs(parts.query)
+        api = self.site + '/_api/'
+        if not path.startswith(api):
+            return 'unknown', error(404, 'Not found')
+        path = path[len(api):]
+        if path == 'contextinfo':
+            with self.lock:
+                digest = 'mock-digest-{}'.format(uuid4())
+                self.digests.add(digest)
+            return 'contextinfo', (200, {}, { 'd': { 'GetContextWebInformation': {
+                'FormDigestValue': digest, 'FormDigestTimeoutSeconds': 1800 }}})
+        if path == '$batch':
+            return '$batch', self.batch(headers, body)
+        if not path.startswith('web/'):
+            return 'unknown', error(404, 'Not found')
+        path = path[len('web/'):]
+        method = headers.get('X-HTTP-Method', method)
+        for pattern, name in routes:
+            m = pattern.match(path)
+            if m:
+                try:
+                    with self.lock:
+                        result = getattr(self, 'do_' + name)(method, m.groups(), query, headers, body)
+                except Exception as e:
+                    result = error(500, '{}: {}'.format(type(e).__name__, e))
+                return '{} {}'.format(method, name), result
+        return 'unknown', error(404, 'No route for {}'.format(path))
+
+    def do_properties(self, method, groups, query, headers, body):
+        path = self.resolve(groups[0])
+        if path not in self.children or not (path + '/').startswith(self.root + '/'):
+            return error(404, 'Folder not found')
+        return 200, {}, { 'vti_x005f_listname': '{{{}}}'.format(self.list_id.upper()) }
+
+    def do_folder(self, method, groups, query, headers, body):
+        path = self.resolve(groups[0])
+        node = self.nodes.get(path)
+        if node is None or not node.is_folder:
+            return error(404, 'File Not Found.')
+        if method == 'DELETE':
+            self.change(CHANGE_DELETE, self.remove(path))
+            return 200, {}, b''
+        data = self.folder_json(node)
+        if 'Folders' in query.get('$expand', [''])[0]:
+            children = [self.nodes[p] for p in sorted(self.children[path])]
+            data['Folders'] = [self.folder_json(n) for n in children if n.is_folder]
+            data['Files'] = [self.file_json(n) for n in children if not n.is_folder]
+        return 200, {}, data
+
+    def do_file(self, method, groups, query, headers, body):
+        path = self.resolve(groups[0])
+        node = self.nodes.get(path)
+        if node is None or node.is_folder:
+            return error(404, 'File Not Found.')
+        if method == 'DELETE':
+            etag = headers.get('If-Match', '*')
+            if etag != '*' and etag != node.etag:
+                return error(412, 'The file has been modified')
+            self.change(CHANGE_DELETE, self.remove(path))
+            return 200, {}, b''
+        data = self.file_json(node)
+        if '$select' in query:
+            fields = query['$select'][0].split(',')
+            data = dict((k, v) for k, v in data.items() if k in fields)
+        return 200, {}, data
+
+    def do_value(self, method, groups, query, headers, body):
+        node = self.nodes.get(self.resolve(groups[0]))
+        if node is None or node.is_folder:
+            return error(404, 'File Not Found.')
+        etag = headers.get('If-Match')
+        if etag and etag != '*' and etag != node.etag:
+            return error(412, 'The file has been modified')
+        m = re.match(r'bytes=(\d+)-$', headers.get('Range', ''))
+        if m and 0 < int(m.group(1)) < node.length:
+            offset = int(m.group(1))
+            return 206, { 'Content-Range': 'bytes {}-{}/{}'.format(offset, node.length - 1, node.length) }, \
+                   self.read(node, offset)
+        return 200, {}, self.read(node)
+
+    def do_add_file(self, method, groups, query, headers, body):
+        parent = self.resolve(groups[0])
+        if parent not in self.children:
+            return error(404, 'File Not Found.')
+        path = parent + '/' + unquote_path(groups[1])
+        node = self.nodes.get(path)
+        etag = headers.get('If-Match')
+        if etag and etag != '*' and (node is None or etag != node.etag):
+            return error(412, 'The file has been modified')
+        if node is not None and (node.is_folder or groups[2].lower() != 'true'):
+            return error(409, 'A file with the name {} already exists.'.format(path))
+        return 200, {}, self.file_json(self.add(path, False, body))
+
+    def do_add_folder(self, method, groups, query, headers, body):
+        path = self.resolve(json.loads(body.decode('utf-8'))['ServerRelativeUrl'])
+        if path.rsplit('/', 1)[0] not in self.children:
+            return error(404, 'File Not Found.')
+        node = self.nodes.get(path)
+        if node is not None and not node.is_folder:
+            return error(409, 'A file with the name {} already exists.'.format(path))
+        return 201, {}, { 'd': self.folder_json(self.add(path, True)) }
+
+    def do_upload(self, method, groups, query, headers, body):
+        node = self.nodes.get(self.resolve(groups[0]))
+        if node is None or node.is_folder:
+            return error(404, 'File Not Found.')
+        step, upload_id, offset = groups[1], groups[2], int(groups[3] or 0)
+        etag = headers.get('If-Match')
+        if etag and etag != '*' and etag != node.etag:
+            return error(412, 'The file has been modified')
+        if step == 'StartUpload':
+            node.uploads[upload_id] = bytearray(body)
+        else:
+            session = node.uploads.get(upload_id)
+            if session is None or len(session) != offset:
+                return error(400, 'The upload session was not found or the offset is wrong.')
+            session.extend(body)
+        if step != 'FinishUpload':
+            return 200, {}, { 'value': str(len(node.uploads[upload_id])) }
+        self.add(node.path, False, bytes(node.uploads.pop(upload_id)))
+        return 200, {}, self.file_json(node)
+
+    def do_move(self, method, groups, query, headers, body):
+        path, new_path = self.resolve(groups[0]), self.resolve(groups[1])
+        if path not in self.nodes:
+            return error(404, 'File Not Found.')
+        if new_path in self.nodes:
+            return error(409, 'Destination exists.')
+        if new_path.rsplit('/', 1)[0] not in self.children:
+            return error(404, 'Destination folder not found.')
+        self.move(path, new_path)
+        return 200, {}, {}
+
+    def do_copy(self, method, groups, query, headers, body):
+        path, new_path = self.resolve(groups[0]), self.resolve(groups[1])
+        node = self.nodes.get(path)
+        if node is None or node.is_folder:
+            return error(404, 'File Not Found.')
+        etag = headers.get('If-Match')
+        if etag and etag != '*' and etag != node.etag:
+            return error(412, 'The file has been modified')
+        if new_path.rsplit('/', 1)[0] not in self.children:
+            return error(404, 'Destination folder not found.')
+        existing = self.nodes.get(new_path)
+        if existing is not None and (existing.is_folder or groups[2].lower() != 'true'):
+            return error(409, 'Destination exists.')
+        self.add(new_path, False, self.read(node))
+        return 200, {}, {}
+
+    def do_list(self, method, groups, query, headers, body):
+        return 200, {}, { 'Id': groups[0], 'CurrentChangeToken': { 'StringValue': self.change_token }}
+
+    def do_items(self, method, groups, query, headers, body):
+        top = int(query.get('$top', ['100'])[0])
+        if self.page_size:
+            top = min(top, self.page_size)
+        after = 0
+        m = re.search(r'p_ID=(\d+)', query.get('$skiptoken', [''])[0])
+        if m:
+            after = int(m.group(1))
+        nodes = sorted((n for n in self.nodes.values() if n.item_id > after and n.path != self.root),
+                       key=lambda n: n.item_id)
+        data = { 'value': [self.item_json(n) for n in nodes[:top]] }
+        if len(nodes) > top:
+            next_query = '&'.join('{}={}'.format(k, v[0]) for k, v in query.items() if k != '$skiptoken')
+            data['odata.nextLink'] = 'http://{}{}/_api/web/lists(guid\'{}\')/items?{}&$skiptoken=Paged%3DTRUE%26p_ID%3D{}' \
+                .format(headers.get('Host', 'localhost'), self.site, groups[0], next_query, nodes[top - 1].item_id)
+        return 200, {}, data
+
+    def do_item(self, method, groups, query, headers, body):
+        item_id = int(groups[1])
+        for node in self.nodes.values():
+            if node.item_id == item_id:
+                return 200, {}, self.item_json(node)
+        return error(404, 'Item does not exist.')
+
+    def do_changes(self, method, groups, query, headers, body):
+        token = json.loads(body.decode('utf-8'))['query']['ChangeTokenStart']['StringValue']
+        try:
+            start = int(token.split(';')[3])
+        except (IndexError, ValueError):
+            return 400, {}, { 'error': { 'message': { 'value': 'Invalid change token' }}}
+        results = [{ 'ChangeType': change_type, 'ItemId': item_id,
+                     'ChangeToken': { 'StringValue': '1;3;{};{};-1'.format(self.list_id, start + i + 1) }}
+                   for i, (change_type, item_id) in enumerate(self.changes[start:start + 1000])]
+        return 200, {}, { 'd': { 'results': results }}
+
+    def batch(self, headers, body):
+        # Runs each request in a $batch body in turn, and answers them in
+        # one multipart response
+        responses = []
+        lines = body.decode('utf-8').split('\r\n')
+        i = 0
+        while i < len(lines):
+            m = REQUEST_LINE.match(lines[i])
+            i += 1
+            if not m:
+                continue
+            inner_headers = HTTPMessage()
+            while i < len(lines) and lines[i]:
+                k, _, v = lines[i].partition(':')
+                inner_headers[k.strip()] = v.strip()
+                i += 1
+            content = []
+            while i < len(lines) and not lines[i].startswith('--'):
+                content.append(lines[i])
+                i += 1
+            kind, (status, _, data) = self.dispatch(m.group(1), m.group(2), inner_headers,
+                                                   '\r\n'.join(content).strip().encode('utf-8'))
+            with self.lock:
+                self.requests['batched ' + kind] += 1
+            if not isinstance(data, bytes):
+                data = json.dumps(data).encode('utf-8')
+            responses.append((status, data))
+        boundary = 'batchresponse_{}'.format(uuid4())
+        parts = []
+        for status, data in responses:
+            parts += ['--' + boundary, 'Content-Type: application/http', 'Content-Transfer-Encoding: binary', '',
+                      'HTTP/1.1 {} {}'.format(status, STATUS_TEXT.get(status, '')),
+                      'CONTENT-TYPE: application/json;odata=minimalmetadata;streaming=true;charset=utf-8', '',
+                      data.decode('utf-8')]
+        parts += ['--{}--'.format(boundary), '']
+        return 200, { 'Content-Type': 'multipart/mixed; boundary={}'.format(boundary) }, \
+               '\r\n'.join(parts).encode('utf-8')
+
+class Handler(BaseHTTPRequestHandler):
+    # Keep-alive, as SharePoint does
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, which with Nagle's
+    # algorithm costs a delayed ACK on every request
+    disable_nagle_algorithm = True
+
+    def handle_request(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, headers, data = self.server.mock.request(method, self.path, self.headers, body)
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up, which they do when they give up on a request,
+        # aren't worth a traceback
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            HTTPServer.handle_error(self, request, client_address)
+
+def serve(mock, host='127.0.0.1', port=0):
+    # Starts serving mock in the background.  Returns the server and the
+    # site's URL.
+    server = Server((host, port), Handler)
+    server.mock = mock
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://{}:{}{}/'.format(host, server.server_address[1], mock.site)
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--store', help='Keep file contents in this directory rather than in memory')
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds added to every request')
+    parser.add_argument('--throttle', type=float, default=0, help='Fraction of requests to throttle')
+    parser.add_argument('--errors', type=float, default=0, help='Fraction of requests to fail')
+    parser.add_argument('--page-size', type=int, help='Most items to send in one page of a list query')
+    args = parser.parse_args()
+    mock = MockSharePoint(store=args.store, latency=args.latency / 1000.0,
+                          throttle=args.throttle, errors=args.errors, page_size=args.page_size)
+    server, url = serve(mock, port=args.port)
+    print('Serving {} with library {}'.format(url, mock.root))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
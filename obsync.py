@@ -1,39 +1,140 @@
 #!/usr/bin/env python3
 
+import sys
+import time
 from sharepoint import SharePoint, Folder
 from pathlib import Path
 from argparse import ArgumentParser
 from getpass import getpass
-from db import DB, params
+from db import DB, NS, CONFLICT_POLICIES, params, saved_token, deferred_conflicts
+from roots import Roots
 
 parser = ArgumentParser()
-parser.add_argument('local_path')
+parser.add_argument('local_path', nargs='?')
 parser.add_argument('server', nargs='?')
 parser.add_argument('remote_path', nargs='?')
 parser.add_argument('--username', '-u', nargs='?')
 parser.add_argument('--pw', '-p', type=str)
+parser.add_argument('--bearer', metavar='TOKEN',
+                    help='Send this bearer token instead of logging in (mock_sharepoint.py takes any)')
 parser.add_argument('--dry-run', '-d')
-args = parser.parse_args()
+parser.add_argument('--jobs', '-j', type=int, default=4,
+                    help='Number of transfers to run at once')
+parser.add_argument('--chunk-size', type=int, default=10,
+                    help='Upload files bigger than this many MB in pieces of this size')
+parser.add_argument('--buffer-size', type=int, default=1024,
+                    help='Write downloads to disk this many KB at a time')
+parser.add_argument('--watch', '-w', action='store_true',
+                    help='Keep running, syncing local changes as they happen')
+parser.add_argument('--interval', type=int, default=60,
+                    help='In --watch mode, check the server for changes this often (seconds)')
+parser.add_argument('--quick-scan', action='store_true',
+                    help="Don't look at files in local folders that haven't changed since the last scan")
+parser.add_argument('--quiet', '-q', action='store_true',
+                    help='Only report errors, not what happens to each file')
+parser.add_argument('--stats-json',
+                    help='After each sync, write timings, request counts and bytes transferred to this file as JSON')
+parser.add_argument('--prometheus',
+                    help='After each sync, write the same stats to this file for node_exporter\'s textfile collector')
+# Both go into one list in the order given, since the last pattern to match
+# a path decides it; an --include pattern is kept with a ! in front
+parser.add_argument('--exclude', action='append', dest='rules', default=[], metavar='PATTERN',
+                    help='Leave paths matching this gitignore-style pattern out of the sync from now on')
+parser.add_argument('--include', action='append', dest='rules', type=lambda p: '!' + p, metavar='PATTERN',
+                    help='Bring back paths matching this pattern that an earlier --exclude left out')
+parser.add_argument('--clear-rules', action='store_true',
+                    help='Forget the patterns given before')
+parser.add_argument('--max-size', type=float,
+                    help="From now on, don't sync files bigger than this many MB (0 for no limit)")
+parser.add_argument('--config', '-c',
+                    help='Sync every root listed in this file instead of just local_path')
+parser.add_argument('--parallel-roots', type=int, default=4,
+                    help='With --config, sync this many roots at once')
+parser.add_argument('--conflicts', choices=CONFLICT_POLICIES, default='keep-both',
+                    help='What to do with paths changed both locally and on the server')
 
-if not args.server:
-    ps = params(args.local_path)
-    if ps:
-        args.server = ps[0]
-        args.remote_path = ps[1]
-        args.username = ps[2]
-        args.pw = ps[3]
+# obsync.py conflicts LOCAL_PATH lists the conflicts left for later, and
+# with --take settles them
+conflicts_parser = ArgumentParser(prog='obsync.py conflicts')
+conflicts_parser.add_argument('local_path')
+conflicts_parser.add_argument('paths', nargs='*',
+                              help='Settle only these conflicts, relative to local_path')
+conflicts_parser.add_argument('--take', choices=[p for p in CONFLICT_POLICIES if p != 'defer'],
+                              help='Settle the conflicts this way and sync them')
+conflicts_parser.add_argument('--pw', '-p', type=str)
+conflicts_parser.add_argument('--jobs', '-j', type=int, default=4)
+conflicts_parser.add_argument('--quiet', '-q', action='store_true')
 
-if not args.server:
-    parser.print_help()
+def open_db(local_path, server=None, remote_path=None, username=None, pw=None, jobs=4, bearer=None, **options):
+    if not server:
+        ps = params(local_path)
+        if ps:
+            server, remote_path, username, pw = ps
+    if not server:
+        parser.print_help()
+        exit()
+    token = { 'Authorization': 'Bearer ' + bearer } if bearer else saved_token(local_path)
+    if not pw and not token:
+        pw = getpass()
+    print('Syncing server {}@{}\nLocal path: {}\nRemote path: {}'.format(username, server, local_path, remote_path))
+    sp = SharePoint(server, username, pw, token=token, pool_size=jobs)
+    return DB(local_path, sp.get_folder(remote_path), options.pop('dry_run', None), jobs=jobs, **options)
+
+def describe(tstamp, size, is_folder):
+    when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(tstamp / NS)) if tstamp else '?'
+    return '{} {}'.format('folder' if is_folder else '{} bytes'.format(size), when)
+
+if sys.argv[1:2] == ['conflicts']:
+    args = conflicts_parser.parse_args(sys.argv[2:])
+    listed = deferred_conflicts(args.local_path)
+    if not args.take:
+        for r in listed:
+            print('{}\n    local:  {}\n    remote: {}{}'.format(
+                    r['file_path'], describe(r['local_tstamp'], r['local_size'], r['local_folder']),
+                    describe(r['remote_tstamp'], r['remote_size'], r['remote_folder']),
+                    '\n    to take: {}'.format(r['resolution']) if r['resolution'] else ''))
+        print('{} conflicts left for later'.format(len(listed)))
+        exit()
+    if not listed:
+        print('No conflicts left for later')
+        exit()
+    # Anything else that turns up in conflict stays left for later
+    d = open_db(args.local_path, pw=args.pw, jobs=args.jobs, quiet=args.quiet, conflicts='defer')
+    try:
+        paths = d.resolve_later(args.paths, args.take)
+    except ValueError as e:
+        print(' *** Error: {}'.format(e))
+        exit(1)
+    d.sync(paths)
     exit()
 
-if not args.pw:
-    args.pw = getpass()
+args = parser.parse_args()
+
+if args.config:
+    # Rules belong to one root's database, and each root logs in for itself
+    given = [flag for flag, value in (('--exclude/--include', args.rules), ('--clear-rules', args.clear_rules),
+                                      ('--max-size', args.max_size is not None), ('--bearer', args.bearer))
+             if value]
+    if given:
+        parser.error('{} cannot be used with --config'.format(', '.join(given)))
+    roots = Roots(args.config, jobs=args.jobs, parallel=args.parallel_roots, dry_run=args.dry_run,
+                  chunk_size=args.chunk_size * 1024 * 1024, buffer_size=args.buffer_size * 1024,
+                  quick_scan=args.quick_scan, quiet=args.quiet, stats_json=args.stats_json,
+                  prometheus=args.prometheus, conflicts=args.conflicts)
+    exit(1 if roots.sync(args.watch, args.interval) else 0)
 
-print('Syncing server {username}@{server}\nLocal path: {local_path}\nRemote path: {remote_path}'
-            .format(**vars(args)))
-sp = SharePoint(args.server, args.username, args.pw)
+if not args.local_path:
+    parser.print_help()
+    exit()
 
-f = sp.get_folder(args.remote_path)
-d = DB(args.local_path, f, args.dry_run)
-d.sync()
+d = open_db(args.local_path, args.server, args.remote_path, args.username, args.pw, jobs=args.jobs,
+            bearer=args.bearer, dry_run=args.dry_run, chunk_size=args.chunk_size * 1024 * 1024,
+            buffer_size=args.buffer_size * 1024, quick_scan=args.quick_scan, quiet=args.quiet,
+            stats_json=args.stats_json, prometheus=args.prometheus, conflicts=args.conflicts)
+if args.rules or args.clear_rules or args.max_size is not None:
+    d.change_rules(args.rules, args.clear_rules,
+                   None if args.max_size is None else int(args.max_size * 1024 * 1024))
+if args.watch:
+    d.watch(args.interval)
+else:
+    d.sync()
@@ -0,0 +1,68 @@
+import queue
+import threading
+
+class Prefetch():
+    # Runs a generator on a thread of its own, keeping up to size items
+    # ahead of whoever is iterating over it.  Exceptions the generator
+    # raises are raised again in the thread iterating.
+    def __init__(self, generator, size=10000):
+        self.queue = queue.Queue(size)
+        self.stopped = threading.Event()
+        self.done = False
+        self.thread = threading.Thread(target=self.run, args=(generator,), daemon=True)
+        self.thread.start()
+
+    def put(self, entry):
+        # Returns False if nobody wants it any more
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(entry, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self, generator):
+        try:
+            for item in generator:
+                if not self.put((True, item)):
+                    return
+        except BaseException as e:
+            self.put((False, e))
+        else:
+            self.put((False, None))
+
+    def take(self, ok, item):
+        if ok:
+            return True
+        self.done = True
+        if item is not None:
+            raise item
+        return False
+
+    def __iter__(self):
+        while not self.done:
+            ok, item = self.queue.get()
+            if not self.take(ok, item):
+                return
+            yield item
+
+    def ready(self):
+        # Whatever has arrived so far, without waiting for more
+        while not self.done:
+            try:
+                ok, item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if not self.take(ok, item):
+                return
+            yield item
+
+    def close(self):
+        # Stops the thread if whoever was iterating has given up
+        self.stopped.set()
+        while not self.done:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
@@ -0,0 +1,108 @@
+import configparser
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from getpass import getpass
+from pathlib import Path
+
+from sharepoint import SharePoint
+from scheduler import Scheduler
+from stats import Stats
+from db import DB, params, saved_token
+
+def read_config(path):
+    # Each section of the config file is a root to sync, named for its local
+    # path unless it gives one as local_path.  Settings in [DEFAULT] apply to
+    # every root.  Returns a list of (local path, settings) pairs.
+    config = configparser.ConfigParser(interpolation=None)
+    if not config.read(str(path)):
+        raise FileNotFoundError(path)
+    roots = []
+    for name in config.sections():
+        section = config[name]
+        local_path = section.get('local_path', name)
+        settings = { 'server': section.get('server'),
+                     'remote_path': section.get('remote_path'),
+                     'username': section.get('username'),
+                     'password': section.get('password') }
+        if not settings['server'] and (Path(local_path) / '.sync.db').exists():
+            # Synced before; the database knows where to
+            ps = params(local_path)
+            settings = dict(zip(('server', 'remote_path', 'username', 'password'), ps),
+                            **dict((k, v) for k, v in settings.items() if v))
+        if not settings['server'] or not settings['remote_path']:
+            raise ValueError('{}: no server or remote_path given'.format(name))
+        roots.append((local_path, settings))
+    return roots
+
+class Roots():
+    # Syncs many roots in one go.  Roots on the same site as the same user
+    # share one connection to it; all of them share one scheduler, so the
+    # limit on requests in flight is for all of them together, and one pool
+    # of transfer workers.  Each root keeps its own database.
+    def __init__(self, config, jobs=4, parallel=4, **options):
+        self.parallel = parallel
+        self.scheduler = Scheduler(jobs)
+        self.stats = Stats()
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.options = options
+        self.sites = {}
+        self.dbs = []
+        # Logging in may need a password typed in, so it all happens here,
+        # before any syncing starts.
+        for local_path, settings in read_config(config):
+            sp = self.site(local_path, settings, jobs)
+            self.dbs.append(DB(local_path, sp.get_folder(settings['remote_path']), jobs=jobs,
+                               executor=self.executor, prefix='{}: '.format(local_path), **options))
+
+    def site(self, local_path, settings, jobs):
+        key = (settings['server'], settings['username'])
+        if key not in self.sites:
+            password = settings['password']
+            if not password:
+                password = getpass('Password for {}@{}: '.format(settings['username'], settings['server']))
+            self.sites[key] = SharePoint(settings['server'], settings['username'], password,
+                                         token=saved_token(local_path), pool_size=jobs,
+                                         scheduler=self.scheduler, stats=self.stats)
+        return self.sites[key]
+
+    def sync(self, watch=False, interval=60):
+        # Syncs parallel roots at a time, or with watch, watches them all.
+        # Returns the number that failed.  On Ctrl-C, roots not yet started
+        # are skipped and watches stop once their current sync is done.
+        start = time.time()
+        stop = threading.Event()
+        def run(db):
+            try:
+                if watch:
+                    db.watch(interval, stop)
+                else:
+                    db.sync()
+                return True
+            except Exception as e:
+                print(' *** Error: {}: {}'.format(db.path, e))
+                return False
+        roots = ThreadPoolExecutor(max_workers=len(self.dbs) if watch else self.parallel)
+        futures = [roots.submit(run, db) for db in self.dbs]
+        try:
+            results = [f.result() for f in futures]
+        except KeyboardInterrupt:
+            stop.set()
+            for f in futures:
+                f.cancel()
+            raise
+        finally:
+            roots.shutdown()
+            self.executor.shutdown()
+        failed = results.count(False)
+        stats = self.stats.as_dict(self.scheduler)
+        print('{} roots synced, {} failed, in {:.1f}s: {} requests ({} throttled, {} retried), '
+              '{:.1f}MB up, {:.1f}MB down'.format(
+                len(results) - failed, failed, time.time() - start, stats['scheduler']['requests'],
+                stats['scheduler']['throttled'], stats['scheduler']['retries'],
+                stats['transfers']['up']['bytes'] / 1048576.0, stats['transfers']['down']['bytes'] / 1048576.0))
+        if self.options.get('stats_json'):
+            self.stats.write_json(self.options['stats_json'], self.scheduler)
+        if self.options.get('prometheus'):
+            self.stats.write_prometheus(self.options['prometheus'], self.scheduler)
+        return failed
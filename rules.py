@@ -0,0 +1,77 @@
+import re
+
+class Rules():
+    # gitignore-style patterns saying what to leave out of a sync.  A path
+    # matching a pattern is left out, unless a later pattern starting with !
+    # matches it too and brings it back; the last pattern to match decides.
+    # A pattern with a / other than at the end is matched against the whole
+    # path from the top of the sync (a leading / just says so), otherwise
+    # against the name alone, at any depth.  One ending in / only matches
+    # folders.  * matches anything but /, ** anything at all, ? any one
+    # character and [...] any of the characters listed.  Nothing inside a
+    # folder that is left out is synced, whatever later patterns say.
+    def __init__(self, patterns=()):
+        self.patterns = [p for p in patterns if p.strip() and not p.startswith('#')]
+        self.rules = [compile(p) for p in self.patterns]
+        # Whether each folder looked at so far is left out
+        self.folders = {}
+
+    def matches(self, rel_path, is_folder):
+        # Whether the patterns leave rel_path out, leaving aside the folders
+        # above it
+        excluded = False
+        for include, regex, folder_only in self.rules:
+            if (is_folder or not folder_only) and regex.match(rel_path):
+                excluded = not include
+        return excluded
+
+    def excluded(self, rel_path, is_folder=False):
+        # Whether rel_path, or a folder above it, is left out
+        if not self.rules:
+            return False
+        parent = rel_path.rpartition('/')[0]
+        if parent:
+            if parent not in self.folders:
+                self.folders[parent] = self.excluded(parent, True)
+            if self.folders[parent]:
+                return True
+        return self.matches(rel_path, is_folder)
+
+def compile(pattern):
+    # Returns (whether the pattern brings paths back, a regex for the paths
+    # it matches, whether it only matches folders)
+    include = pattern.startswith('!')
+    if include:
+        pattern = pattern[1:]
+    folder_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex += '[' + chars.replace('\\', '\\\\') + ']'
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    if not anchored:
+        regex = '(?:.*/)?' + regex
+    return include, re.compile(regex + '$'), folder_only
@@ -0,0 +1,118 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+import requests
+
+# Statuses SharePoint uses to tell a client to slow down
+THROTTLED = (429, 503)
+
+# Statuses from a server that may well answer next time.  Only requests
+# that can safely be repeated are retried on these.
+TRANSIENT = (500, 502, 504)
+
+class Throttled(IOError):
+    pass
+
+class Scheduler():
+    # Decides how many requests may be in flight at once, and retries those
+    # the server throttles or drops.  Each time the server throttles us the
+    # limit is halved; it grows back by one for every `limit` requests in a
+    # row that succeed, up to the number we started with.
+    def __init__(self, limit=10, retries=8, backoff=1.0, max_backoff=120.0):
+        self.max_limit = limit
+        self.limit = limit
+        self.retry_limit = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.active = 0
+        self.successes = 0
+        self.cond = threading.Condition()
+        # Counters, for reporting at the end of a run
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+            self.requests += 1
+
+    def release(self, ok, throttled=False):
+        with self.cond:
+            self.active -= 1
+            if throttled:
+                self.throttled += 1
+            if not ok:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+            self.cond.notify_all()
+
+    def delay(self, response, attempt):
+        # Retry-After wins if the server sent one.  Otherwise back off
+        # exponentially, with the wait picked at random so that the workers
+        # don't all come back at the same moment.
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                try:
+                    when = parsedate_to_datetime(retry_after)
+                    return max(0, (when - datetime.now(timezone.utc)).total_seconds())
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def run(self, send, idempotent=False):
+        # Calls send(), which makes one request and returns the response,
+        # until it isn't throttled (or, if idempotent, failing with a
+        # transient error or a dropped connection).  Raises Throttled once
+        # out of retries.  Responses given up on are closed, so that their
+        # connections go back to the pool.
+        retry_on = THROTTLED + TRANSIENT if idempotent else THROTTLED
+        attempt = 0
+        while True:
+            self.acquire()
+            response = None
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout):
+                # A dropped connection is treated like being throttled.  The
+                # server may have acted on the request before it went, so
+                # only requests that can safely be repeated are sent again.
+                self.release(False)
+                if attempt >= self.retry_limit or not idempotent:
+                    raise
+            except BaseException:
+                self.release(True)
+                raise
+            else:
+                throttled = response.status_code in THROTTLED
+                self.release(response.status_code not in retry_on, throttled)
+            if response is not None and response.status_code not in retry_on:
+                return response
+            if attempt >= self.retry_limit:
+                if response is not None and response.status_code in TRANSIENT:
+                    # The caller makes of the last answer what it would have
+                    return response
+                if response is not None:
+                    response.close()
+                raise Throttled('Gave up after {} throttled attempts'.format(attempt + 1))
+            delay = self.delay(response, attempt)
+            if response is not None:
+                # A streamed response holds on to its connection until closed
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+            with self.cond:
+                self.retries += 1
@@ -1,18 +1,111 @@
 import json
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
+from uuid import uuid4
 from pprint import pprint
-from collections import abc
+from requests.adapters import HTTPAdapter
+from requests.utils import requote_uri
+from scheduler import Scheduler
+from stats import Stats
 
 from office365.runtime.auth.authentication_context import AuthenticationContext
-from office365.runtime.client_request import ClientRequest
 from office365.runtime.utilities.request_options import RequestOptions
-from office365.runtime.utilities.http_method import HttpMethod
 
 def quote_file(s):
     if isinstance(s, Path):
         return str(s).replace("'", "''")
     return s.replace("'", "''")
 
+# The fields of a list item needed to build an Entry from it
+list_item_query = ('$select=Id,FileRef,FSObjType,File/TimeLastModified,File/Length,File/ContentTag,'
+                   'File/UniqueId,File/ETag,File/UIVersionLabel,Folder/TimeLastModified,Folder/UniqueId'
+                   '&$expand=File,Folder')
+
+# The same for the files and folders in a folder
+folder_query = ('$select=Folders/ServerRelativeUrl,Folders/TimeLastModified,Folders/UniqueId,'
+                'Files/ServerRelativeUrl,Files/TimeLastModified,Files/Length,Files/ContentTag,'
+                'Files/UniqueId,Files/ETag,Files/UIVersionLabel'
+                '&$expand=Folders,Files')
+
+# SP.ChangeType values meaning the item is no longer in the list
+CHANGE_DELETE = 3
+CHANGE_MOVE_AWAY = 5
+
+# The most operations SharePoint takes in one $batch request
+BATCH_LIMIT = 100
+
+# The most items SharePoint hands back in one page of a list query
+LIST_PAGE_SIZE = 5000
+
+class Changed(IOError):
+    # The item isn't what the request was conditional on: it has changed on
+    # the server since it was listed, or turned up there
+    pass
+
+# Requests are counted in the stats under the name going with the first of
+# these found in their URL, or else under their method
+ENDPOINTS = (
+    ('/$batch', 'batch'),
+    ('/contextinfo', 'contextinfo'),
+    ('/$value', 'download'),
+    ('upload(', 'upload_chunk'),
+    ('/files/add(', 'upload'),
+    ('/moveto(', 'move'),
+    ('/copyto(', 'copy'),
+    ('/getchanges', 'changes'),
+    ('currentchangetoken', 'change_token'),
+    ('/items', 'items'),
+    ('/properties', 'properties'),
+    ('/web/folders', 'create_folder'),
+)
+
+def endpoint(method, url, headers):
+    url = url.lower()
+    for part, name in ENDPOINTS:
+        if part in url:
+            return name
+    return headers.get('X-HTTP-Method', method).lower()
+
+def parse_batch(text):
+    # Returns (status, body) for each response in a $batch reply, in order.
+    # Each response is an HTTP status line, headers, a blank line and the
+    # body, up to the next boundary.
+    results = []
+    lines = text.splitlines()
+    i = 0
+    while i < len(lines):
+        if not lines[i].startswith('HTTP/1.1 '):
+            i += 1
+            continue
+        status = int(lines[i].split()[1])
+        i += 1
+        while i < len(lines) and lines[i].strip():
+            i += 1
+        content = []
+        while i < len(lines) and not lines[i].startswith('--'):
+            content.append(lines[i])
+            i += 1
+        content = '\n'.join(content).strip()
+        try:
+            results.append((status, json.loads(content) if content else {}))
+        except ValueError:
+            results.append((status, {}))
+    return results
+
+def body(data):
+    # Files and raw bytes are sent as they are, anything else as JSON
+    if hasattr(data, 'read') or hasattr(data, 'decode'):
+        return { 'data': data }
+    return { 'json': data }
+
+def digest_expired(response):
+    # SharePoint answers a request with a stale X-RequestDigest with a 403
+    # and this error code
+    return '-2130575251' in response.text
+
 def authenticate(fn):
     def authenticated(self, *args, **kwargs):
         if not self.connected: self.connect()
@@ -27,17 +120,42 @@ class FFItem():
 
     @property
     def parent(self):
-        return self.parent
+        return self.parent_obj
 
     @property
     def timestamp(self):
         return self.data['TimeLastModified']
 
+    @property
+    def content_tag(self):
+        # Changes when the content does, but not for metadata edits
+        return self.data.get('ContentTag')
+
+    @property
+    def item_id(self):
+        # Only known for items that came from a list query
+        return self.data.get('Id')
+
+    @property
+    def unique_id(self):
+        return self.data.get('UniqueId')
+
+    @property
+    def etag(self):
+        # Changes whenever the item does.  Requests that send it back in
+        # If-Match are refused if the item has changed since.  Folders don't
+        # have one.
+        return self.data.get('ETag')
+
+    @property
+    def version(self):
+        return self.data.get('UIVersionLabel')
+
     def relative_to(self, folder):
         return self.path.relative_to(folder.path)
 
     def delete(self):
-        return self.sp.delete(self.path, self.is_folder)
+        return self.sp.delete(self.path, self.is_folder, self.etag)
 
 class File(FFItem):
     def __init__(self, sp, path, parent=None, data=None):
@@ -50,8 +168,6 @@ class File(FFItem):
             self.path = Path(self.data['ServerRelativeUrl'])
         except KeyError:
             raise FileNotFoundError(path)
-        if parent is None:
-            self.parent_obj = Folder(sp, self.path.parent, None)
         self.parent_obj = parent
 
     def __iter__(self):
@@ -61,10 +177,11 @@ class File(FFItem):
     def is_folder(self):
         return False
 
-    def read(self, size=1024):
-        return self.sp.get_raw("GetFileByServerRelativeUrl('{}')/$value?binaryStringResponseBody=true"
-                            .format(quote_file(self.data['ServerRelativeUrl']))
-        ).iter_content(chunk_size=size)
+    def open(self, offset=0):
+        return self.sp.open_file(self.data['ServerRelativeUrl'], offset, self.etag)
+
+    def read(self, size=1024 * 1024):
+        return self.open().iter_content(chunk_size=size)
 
     @property
     def length(self):
@@ -93,6 +210,12 @@ class Folder(FFItem):
                     [File(self.sp, quote_file(f['ServerRelativeUrl']), self, f) for f in data['Files']])
         return children.__iter__()
 
+    def crawl(self, skip=None, jobs=4):
+        return self.sp.crawl(self.path, skip, jobs)
+
+    def list_items(self):
+        return self.sp.list_items(self)
+
     def __getitem__(self, name):
         path = Path(self.data['ServerRelativeUrl']) / name
         data = self.sp.get("GetFolderByServerRelativeUrl('{}')".format(quote_file(path)))
@@ -113,77 +236,159 @@ class Folder(FFItem):
     def is_empty(self):
         return self.data['ItemCount'] == 0
 
+class Entry():
+    # What a listing says about a file or folder: only what a sync needs,
+    # without the rest of the JSON the server sent or a Path.  path is the
+    # server relative URL.  Built from data already to hand, never by asking
+    # the server.
+    __slots__ = ('path', 'is_folder', 'timestamp', 'item_id', 'length', 'content_tag', 'unique_id',
+                 'etag', 'version')
+
+    def __init__(self, path, is_folder, timestamp, item_id=None, length=None, content_tag=None,
+                 unique_id=None, etag=None, version=None):
+        self.path = path
+        self.is_folder = is_folder
+        self.timestamp = timestamp
+        self.item_id = item_id
+        self.length = length
+        self.content_tag = content_tag
+        self.unique_id = unique_id
+        self.etag = etag
+        self.version = version
+
+    @property
+    def name(self):
+        return self.path.rsplit('/', 1)[-1]
+
+    def relative_to(self, folder):
+        # As a string.  Raises ValueError if it isn't under folder.
+        root = str(folder.path).rstrip('/') + '/'
+        if not self.path.startswith(root):
+            raise ValueError('{} is not in {}'.format(self.path, folder.path))
+        return self.path[len(root):]
+
+def folder_entry(data, item_id=None):
+    return Entry(data['ServerRelativeUrl'], True, data['TimeLastModified'], item_id,
+                 unique_id=data.get('UniqueId'))
+
+def file_entry(data, item_id=None):
+    return Entry(data['ServerRelativeUrl'], False, data['TimeLastModified'], item_id, data['Length'],
+                 data.get('ContentTag'), data.get('UniqueId'), data.get('ETag'), data.get('UIVersionLabel'))
+
 class SharePoint():
-    def __init__(self, url, username, password):
+    def __init__(self, url, username, password, token=None, pool_size=10, scheduler=None, stats=None):
         self.site_url = url
         if self.site_url[-1] != '/':
             self.site_url += '/'
         self.username = username
         self.password = password
-        self.connected = False
+        # The headers that authenticate a request.  If we were given some from
+        # a previous run, try them before going to the trouble of logging in.
+        self.token = token
+        self.connected = token is not None
+        self.auth_lock = threading.Lock()
+        # One keep-alive connection per worker thread
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.digest = None
+        self.digest_expires = 0
+        self.digest_lock = threading.Lock()
+        # Connections to several sites may share these
+        self.scheduler = scheduler or Scheduler(pool_size)
+        self.stats = stats or Stats()
 
     def connect(self):
         self.ctx_auth = AuthenticationContext(self.site_url)
         self.connected = self.ctx_auth.acquire_token_for_user(self.username, self.password)
-        self.request = ClientRequest(self.ctx_auth)
+        if self.connected:
+            options = RequestOptions(self.site_url)
+            self.ctx_auth.authenticate_request(options)
+            self.token = options.headers
+            self.digest = None
         print('Authentication was {}successful'.format('not ' if not self.connected else ''))
         return self.connected
 
+    def send(self, method, url, headers = {}, **kwargs):
+        # Every request goes through here, and so through the scheduler.  If
+        # the server turns our token down, log in again and have one more go;
+        # if it turns down our digest, get a new one and do the same.
+        data = kwargs.get('data')
+        start = data.tell() if hasattr(data, 'seek') else None
+        kind = endpoint(method, url, headers)
+        def attempt():
+            if start is not None:
+                # Resending a file starts from where it started the first time
+                data.seek(start)
+            sent = time.time()
+            try:
+                response = self.session.request(method, url, headers=dict(self.token, **headers), **kwargs)
+            except requests.RequestException:
+                self.stats.request(kind, time.time() - sent, None)
+                raise
+            self.stats.request(kind, time.time() - sent, response.status_code)
+            return response
+        token = self.token
+        # Only GETs are sure to do no harm if sent twice
+        response = self.scheduler.run(attempt, method == 'GET')
+        if start is None and hasattr(data, 'read'):
+            # Can't be sent again
+            return response
+        if response.status_code == 401:
+            with self.auth_lock:
+                # Another thread may have logged in again already
+                if self.token is token and not self.connect():
+                    return response
+        elif response.status_code == 403 and 'X-RequestDigest' in headers and digest_expired(response):
+            with self.digest_lock:
+                if self.digest == headers['X-RequestDigest']:
+                    self.digest = None
+        else:
+            return response
+        response.close()
+        if 'X-RequestDigest' in headers:
+            # Logging in again throws the digest away too
+            headers = dict(headers, **{ 'X-RequestDigest': self.get_digest() })
+        return self.scheduler.run(attempt, method == 'GET')
+
     @authenticate
     def get(self, path):
-#        request = ClientRequest(self.ctx_auth)
-        options = RequestOptions('{}_api/web/{}'.format(self.site_url, path))
-        options.set_header('Accept', 'application/json')
-        options.set_header('Content-Type', 'application/json')
-        data = self.request.execute_request_direct(options)
+        if path.startswith('http'):
+            # Paging links come back as absolute URLs
+            url = path
+        else:
+            url = '{}_api/web/{}'.format(self.site_url, path)
+        data = self.send('GET', url, headers = { 'Accept': 'application/json',
+                                                 'Content-Type': 'application/json' })
         if data.status_code == 404:
             raise ValueError('Site does not exist')
         s = json.loads(data.content)
         return s
 
     @authenticate
-    def get_raw(self, path):
-#        request = ClientRequest(self.ctx_auth)
-        options = RequestOptions('{}_api/web/{}'.format(self.site_url, path))
-        data = self.request.execute_request_direct(options)
-        return data
+    def get_raw(self, path, headers = {}):
+        # Streamed, so that big downloads don't have to fit in memory
+        return self.send('GET', '{}_api/web/{}'.format(self.site_url, path), headers, stream=True)
 
     @authenticate
     def post_raw(self, path, headers = {}, data = {}):
-        options = RequestOptions('{}{}'.format(self.site_url, path))
-        options.method = HttpMethod.Post
-        options.set_headers(headers)
-        if isinstance(data, abc.Mapping):
-            options.data.update(data)
-        data = self.request.execute_request_direct(options)
-        if data.status_code == 403:
-            import traceback
-            traceback.print_tb()
-            print(options.url)
-            print(data.content)
-            print(options.headers)
-        return data
+        return self.send('POST', '{}{}'.format(self.site_url, path), headers, **body(data))
 
     @authenticate
     def post(self, path, headers = {}, data = {}):
-#        request = ClientRequest(self.ctx_auth)
-        options = RequestOptions('{}_api/web/{}'.format(self.site_url, path))
-        options.method = HttpMethod.Post
-        options.set_headers(headers)
-        options.data = data
-        data = self.request.execute_request_direct(options)
-        if data.status_code == 403:
-            import traceback
-            traceback.print_tb()
-            print(options.url)
-            print(data.content)
-            print(options.headers)
-        return data
+        return self.send('POST', '{}_api/web/{}'.format(self.site_url, path), headers, **body(data))
 
     def get_digest(self):
-        data = self.post_raw('_api/contextinfo', headers=dict(Accept='application/json; odata=verbose'))
-        data = json.loads(data.content)
-        return data['d']['GetContextWebInformation']['FormDigestValue']
+        # The digest is good for half an hour or so; fetch a new one a minute
+        # before the old one runs out.
+        with self.digest_lock:
+            if self.digest is None or time.time() > self.digest_expires:
+                data = self.post_raw('_api/contextinfo', headers=dict(Accept='application/json; odata=verbose'))
+                data = json.loads(data.content)['d']['GetContextWebInformation']
+                self.digest = data['FormDigestValue']
+                self.digest_expires = time.time() + data['FormDigestTimeoutSeconds'] - 60
+            return self.digest
 
     def lists(self):
         return self.get('lists')
@@ -194,6 +399,114 @@ class SharePoint():
     def get_list_items(self, name):
         return self.get("lists/getbytitle('{}')/Items".format(quote_file(name)))
 
+    def list_id(self, path):
+        data = self.get("GetFolderByServerRelativeUrl('{}')/Properties?$select=vti_x005f_listname"
+                            .format(quote_file(path)))
+        if 'odata.error' in data:
+            raise ValueError(data['odata.error']['message']['value'])
+        return data['vti_x005f_listname'].strip('{}')
+
+    def list_items(self, folder, page_size=LIST_PAGE_SIZE):
+        # Lists every item in the document library holding folder, page_size
+        # at a time, and keeps those under folder.  This is one request per
+        # page rather than one per folder; the server may send smaller pages
+        # than asked for, and links each to the next.  Raises ValueError if
+        # the server refuses the query.
+        root = str(folder.path) + '/'
+        url = "lists(guid'{}')/items?{}&$top={}".format(self.list_id(folder.path), list_item_query, page_size)
+        while url:
+            data = self.get(url)
+            if 'odata.error' in data:
+                raise ValueError(data['odata.error']['message']['value'])
+            for item in data['value']:
+                if item['FileRef'].startswith(root):
+                    yield self.from_list_item(item)
+            url = data.get('odata.nextLink')
+
+    def from_list_item(self, item):
+        if item['FSObjType'] == 1:
+            return folder_entry(dict(item['Folder'], ServerRelativeUrl=item['FileRef']), item['Id'])
+        return file_entry(dict(item['File'], ServerRelativeUrl=item['FileRef']), item['Id'])
+
+    def get_list_item(self, list_id, item_id):
+        # Raises FileNotFoundError only if the server says the item doesn't
+        # exist, and IOError if it fails to answer for any other reason.
+        response = self.get_raw("lists(guid'{}')/items({})?{}".format(list_id, item_id, list_item_query),
+                                { 'Accept': 'application/json' })
+        if response.status_code != 200:
+            response.close()
+            if response.status_code == 404:
+                raise FileNotFoundError(item_id)
+            raise IOError('Fetching item {} failed with status {}'.format(item_id, response.status_code))
+        return self.from_list_item(json.loads(response.content))
+
+    def list_folder(self, path):
+        # Entries for the files and folders in a folder, in one request
+        data = self.get("GetFolderByServerRelativeUrl('{}')?{}".format(quote_file(path), folder_query))
+        if 'odata.error' in data:
+            raise ValueError(data['odata.error']['message']['value'])
+        return ([folder_entry(f) for f in data['Folders']] +
+                [file_entry(f) for f in data['Files']])
+
+    def crawl(self, path, skip=None, jobs=4):
+        # Entries for everything under path, listing up to jobs folders at
+        # once.  Each folder is queued as soon as its parent's listing
+        # arrives, so the tree is listed breadth first, and its entries are
+        # yielded straight away; a folder always comes before what is in it,
+        # but otherwise they come in no particular order.  Entries
+        # skip(entry) is true for are left out, along with everything in them.
+        # skip is only called on the thread iterating.
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            pending = set([executor.submit(self.list_folder, path)])
+            try:
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        for entry in future.result():
+                            if skip is not None and skip(entry):
+                                continue
+                            if entry.is_folder:
+                                pending.add(executor.submit(self.list_folder, entry.path))
+                            yield entry
+            finally:
+                # Given up on, or failed; don't list the rest
+                for future in pending:
+                    future.cancel()
+
+    def change_token(self, list_id):
+        data = self.get("lists(guid'{}')?$select=CurrentChangeToken".format(list_id))
+        if 'odata.error' in data:
+            raise ValueError(data['odata.error']['message']['value'])
+        return data['CurrentChangeToken']['StringValue']
+
+    def get_changes(self, list_id, token):
+        # Yields (change type, item id) for every change to items in the list
+        # since token was current.  Raises ValueError if the token has expired
+        # or is otherwise rejected, or the server fails to answer, so that
+        # the caller lists everything instead.
+        while True:
+            data = self.post("lists(guid'{}')/GetChanges".format(list_id),
+                headers = { 'X-RequestDigest': self.get_digest(),
+                            'accept': 'application/json;odata=verbose',
+                            'content-type': 'application/json;odata=verbose'},
+                data = { 'query': {
+                            '__metadata': { 'type': 'SP.ChangeQuery' },
+                            'Item': True, 'Add': True, 'Update': True, 'DeleteObject': True,
+                            'Rename': True, 'Move': True, 'Restore': True,
+                            'ChangeTokenStart': { '__metadata': { 'type': 'SP.ChangeToken' },
+                                                  'StringValue': token }}})
+            if data.status_code != 200:
+                raise ValueError('GetChanges failed with status {}'.format(data.status_code))
+            try:
+                changes = json.loads(data.content)['d']['results']
+            except (ValueError, KeyError, TypeError):
+                raise ValueError('GetChanges sent back something unexpected')
+            if not changes:
+                return
+            for change in changes:
+                yield change['ChangeType'], change['ItemId']
+            token = changes[-1]['ChangeToken']['StringValue']
+
     def get_folder(self, path):
         return Folder(self, path, None)
 
@@ -206,25 +519,179 @@ class SharePoint():
             file = file[x]
         return file
 
-    def delete(self, path, is_folder=False):
+    def open_file(self, path, offset=0, etag=None):
+        # Returns the streaming response.  If offset is given, asks for the
+        # file from there on; the status is 206 if the server obliged.  If
+        # etag is given, raises IOError if the file no longer has it.
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        if etag:
+            headers['If-Match'] = etag
+        data = self.get_raw("GetFileByServerRelativeUrl('{}')/$value?binaryStringResponseBody=true"
+                            .format(quote_file(path)), headers)
+        if data.status_code in (200, 206):
+            return data
+        # Streamed, so the connection only goes back to the pool once closed
+        data.close()
+        if data.status_code == 412:
+            raise Changed('{} has changed on the server since it was listed'.format(path))
+        raise IOError('Download of {} failed with status {}'.format(path, data.status_code))
+
+    # Operations are (method, path, headers, data) tuples, which can be sent
+    # on their own with send_op or many at once with batch.
+    def delete_op(self, path, is_folder=False, etag=None):
+        return ('DELETE', "Get{}ByServerRelativeUrl('{}')".format('Folder' if is_folder else 'File', quote_file(path)),
+                { 'IF-MATCH': etag or '*' }, None)
+
+    def folder_op(self, path):
+        return ('POST', 'folders',
+                { 'accept': 'application/json;odata=verbose',
+                  'content-type': 'application/json;odata=verbose'},
+                { '__metadata': { 'type': 'SP.Folder' },
+                  'ServerRelativeUrl': str(path)})
+
+    def send_op(self, op):
+        method, path, headers, data = op
+        headers = dict(headers, **{ 'X-RequestDigest': self.get_digest() })
+        if method != 'POST':
+            headers['X-HTTP-Method'] = method
+        return self.post(path, headers=headers, data=data if data is not None else {})
+
+    def batch(self, operations):
+        # Sends operations BATCH_LIMIT at a time as $batch requests, and
+        # returns (status, body) for each of them, in order.  Each operation
+        # is a change set of its own, so one failing doesn't stop the rest.
+        # The server carries them out in order.  Operations it didn't answer
+        # get a status of None.
+        results = []
+        for i in range(0, len(operations), BATCH_LIMIT):
+            chunk = operations[i:i + BATCH_LIMIT]
+            boundary = 'batch_{}'.format(uuid4())
+            parts = []
+            for method, path, headers, data in chunk:
+                changeset = 'changeset_{}'.format(uuid4())
+                request = ['{} {} HTTP/1.1'.format(method, requote_uri('{}_api/web/{}'.format(self.site_url, path)))]
+                request += ['{}: {}'.format(k, v) for k, v in headers.items()]
+                parts += ['--' + boundary,
+                          'Content-Type: multipart/mixed; boundary="{}"'.format(changeset),
+                          '',
+                          '--' + changeset,
+                          'Content-Type: application/http',
+                          'Content-Transfer-Encoding: binary',
+                          ''] + request + ['', json.dumps(data) if data is not None else '',
+                          '--{}--'.format(changeset)]
+            parts += ['--{}--'.format(boundary), '']
+            response = self.post_raw('_api/$batch',
+                headers = { 'X-RequestDigest': self.get_digest(),
+                            'Accept': 'application/json',
+                            'Content-Type': 'multipart/mixed; boundary="{}"'.format(boundary)},
+                data = '\r\n'.join(parts).encode('utf-8'))
+            if response.status_code != 200:
+                raise IOError('Batch request failed with status {}'.format(response.status_code))
+            answers = parse_batch(response.content.decode('utf-8', 'replace'))
+            results += (answers + [(None, {})] * len(chunk))[:len(chunk)]
+        return results
+
+    def delete(self, path, is_folder=False, etag=None):
+        # Raises FileNotFoundError if it's already gone, and IOError if etag
+        # is given and the item no longer has it.
+        data = self.send_op(self.delete_op(path, is_folder, etag))
+        if data.status_code == 404:
+            raise FileNotFoundError(path)
+        if data.status_code == 412:
+            raise Changed('{} has changed on the server since it was listed'.format(path))
+        return data
+
+    def move(self, path, new_path, is_folder=False):
+        # Moves a file or folder within the site, without copying it through
+        # here.  Raises ValueError if the server refuses.
         form_digest = self.get_digest()
-        return self.post("Get{}ByServerRelativeUrl('{}')".format('Folder' if is_folder else 'File', quote_file(path)),
+        data = self.post("Get{}ByServerRelativeUrl('{}')/moveto(newurl='{}'{})".format(
+                            'Folder' if is_folder else 'File', quote_file(path), quote_file(new_path),
+                            '' if is_folder else ',flags=0'),
             headers = { 'X-RequestDigest': form_digest,
-                        'IF-MATCH': 'etag or "*"',
-                        'X-HTTP-Method': 'DELETE'})
+                        'Accept': 'application/json'})
+        if data.status_code >= 300:
+            try:
+                message = json.loads(data.content)['odata.error']['message']['value']
+            except (ValueError, KeyError):
+                message = 'status {}'.format(data.status_code)
+            raise ValueError(message)
+        return data
 
-    def create_file(self, path, f, size):
+    def copy(self, path, new_path, etag=None):
+        # Copies a file within the site, the content going no further than
+        # the server, and returns the copy's ETag, ContentTag and Length.  If
+        # etag is given, raises Changed
+        # if the original no longer has it.  Raises FileNotFoundError if the
+        # original has gone, and ValueError if the server refuses otherwise.
+        headers = { 'X-RequestDigest': self.get_digest(),
+                    'Accept': 'application/json' }
+        if etag:
+            headers['If-Match'] = etag
+        data = self.post("GetFileByServerRelativeUrl('{}')/copyTo(strNewUrl='{}',bOverWrite=true)".format(
+                            quote_file(path), quote_file(new_path)),
+            headers = headers)
+        if data.status_code == 404:
+            raise FileNotFoundError(path)
+        if data.status_code == 412:
+            raise Changed('{} has changed on the server since it was synced'.format(path))
+        if data.status_code >= 300:
+            try:
+                message = json.loads(data.content)['odata.error']['message']['value']
+            except (ValueError, KeyError):
+                message = 'status {}'.format(data.status_code)
+            raise ValueError(message)
+        return self.get("GetFileByServerRelativeUrl('{}')?$select=ETag,ContentTag,Length".format(
+                            quote_file(new_path)))
+
+    def create_file(self, path, f, size, etag=None):
+        # Replaces the file if it has etag, and otherwise only creates it if
+        # there is nothing there.  Raises Changed if the server refuses
+        # either.
         form_digest = self.get_digest()
-        return self.post("GetFolderByServerRelativeUrl('{}')/Files/add(url='{}', overwrite=true)".format(quote_file(path.parent), quote_file(path.name)),
-            headers = { 'X-RequestDigest': form_digest,
-                        'Content-Length': str(size)},
+        headers = { 'X-RequestDigest': form_digest,
+                    'Accept': 'application/json',
+                    'Content-Length': str(size)}
+        if etag:
+            headers['If-Match'] = etag
+        data = self.post("GetFolderByServerRelativeUrl('{}')/Files/add(url='{}', overwrite={})".format(
+                            quote_file(path.parent), quote_file(path.name), 'true' if etag else 'false'),
+            headers = headers,
             data = f)
+        if data.status_code in (409, 412):
+            raise Changed('{} has changed on the server since it was listed'.format(path))
+        data = json.loads(data.content)
+        if 'odata.error' in data:
+            raise ValueError(data['odata.error']['message']['value'])
+        return data
 
     def create_folder(self, path):
+        return self.send_op(self.folder_op(path))
+
+    def upload_chunk(self, path, method, upload_id, offset, chunk, etag=None):
+        # method is one of StartUpload, ContinueUpload or FinishUpload.  The
+        # first two return the offset the server expects the next chunk at.
+        # If etag is given, starting and finishing raise Changed if the file
+        # no longer has it.
         form_digest = self.get_digest()
-        return self.post("folders",
-            headers = { 'X-RequestDigest': form_digest,
-                        'accept': 'application/json;odata=verbose',
-                        'content-type': 'application/json;odata=verbose'},
-            data = { '__metadata': { 'type': 'SP.Folder' },
-                     'ServerRelativeUrl': str(path)})
+        args = "uploadId=guid'{}'".format(upload_id)
+        if method != 'StartUpload':
+            args += ',fileOffset={}'.format(offset)
+        headers = { 'X-RequestDigest': form_digest,
+                    'Accept': 'application/json',
+                    'Content-Length': str(len(chunk))}
+        if etag and method != 'ContinueUpload':
+            headers['If-Match'] = etag
+        data = self.post("GetFileByServerRelativeUrl('{}')/{}({})".format(quote_file(path), method, args),
+            headers = headers,
+            data = chunk)
+        if data.status_code == 412:
+            raise Changed('{} has changed on the server since it was listed'.format(path))
+        data = json.loads(data.content)
+        if 'odata.error' in data:
+            raise ValueError(data['odata.error']['message']['value'])
+        if method != 'FinishUpload':
+            return int(data['value'])
+        return data
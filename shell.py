@@ -2,7 +2,7 @@ from sharepoint import SharePoint, Folder
 from pathlib import Path
 from argparse import ArgumentParser
 from getpass import getpass
-from db import DB, params
+from db import DB, params, saved_token
 
 parser = ArgumentParser()
 parser.add_argument('local_path')
@@ -26,4 +26,4 @@ if not args.server:
 if not args.pw:
     args.pw = getpass()
 
-sp = SharePoint(args.server, args.username, args.pw)
+sp = SharePoint(args.server, args.username, args.pw, token=saved_token(args.local_path))
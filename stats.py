@@ -0,0 +1,181 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from scheduler import THROTTLED
+
+# Upper bounds, in seconds, of the buckets request latencies are counted in
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BOUNDS = [str(b) for b in BUCKETS] + ['+Inf']
+
+class Histogram():
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.statuses = {}
+
+    def observe(self, seconds, status):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        status = str(status) if status is not None else 'failed'
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def cumulative(self):
+        # (upper bound, requests that took no longer), as Prometheus wants
+        total = 0
+        for bound, count in zip(BOUNDS, self.counts):
+            total += count
+            yield bound, total
+
+class Stats():
+    # Where a run's time goes: how long each phase of a sync takes, how
+    # many requests of each kind are made and how long they take, and how
+    # much file content goes each way.  Everything adds up over the life of
+    # the process, so a --watch run reports totals since it started.
+    # Worker threads all record into the one object.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.syncs = 0
+        self.last_sync = None
+        self.last_duration = None
+        self.phases = {}
+        self.requests = {}
+        # 'copied' is content copied on the server rather than uploaded
+        self.transfers = { 'up': [0, 0], 'down': [0, 0], 'copied': [0, 0] }
+        self.actions = {}
+
+    @contextmanager
+    def phase(self, name, start=None):
+        # start, if given, is when the phase got going before the block did
+        if start is None:
+            start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                seconds, runs = self.phases.get(name, (0.0, 0))
+                self.phases[name] = (seconds + time.time() - start, runs + 1)
+
+    def request(self, endpoint, seconds, status):
+        # status is None if no response came back at all
+        with self.lock:
+            if endpoint not in self.requests:
+                self.requests[endpoint] = Histogram()
+            self.requests[endpoint].observe(seconds, status)
+
+    def transferred(self, direction, nbytes, files=0):
+        # direction is 'up', 'down' or 'copied'
+        with self.lock:
+            self.transfers[direction][0] += nbytes
+            self.transfers[direction][1] += files
+
+    def action(self, action):
+        with self.lock:
+            self.actions[action] = self.actions.get(action, 0) + 1
+
+    def synced(self, start):
+        with self.lock:
+            self.syncs += 1
+            self.last_sync = time.time()
+            self.last_duration = self.last_sync - start
+
+    def as_dict(self, scheduler=None):
+        with self.lock:
+            # Throughput is over the time spent transferring, not the whole run
+            transfer_time = self.phases.get('transfers', (0.0, 0))[0]
+            data = {
+                'started': self.started,
+                'elapsed': time.time() - self.started,
+                'syncs': self.syncs,
+                'last_sync': self.last_sync,
+                'last_duration': self.last_duration,
+                'phases': dict((name, { 'seconds': seconds, 'runs': runs })
+                               for name, (seconds, runs) in self.phases.items()),
+                'requests': dict((endpoint, {
+                                    'count': h.count,
+                                    'seconds': h.sum,
+                                    'max': h.max,
+                                    'throttled': sum(h.statuses.get(str(s), 0) for s in THROTTLED),
+                                    'statuses': dict(h.statuses),
+                                    'buckets': list(h.cumulative()) })
+                                 for endpoint, h in self.requests.items()),
+                'transfers': dict((direction, {
+                                    'bytes': nbytes,
+                                    'files': files,
+                                    'bytes_per_second': nbytes / transfer_time if transfer_time else None })
+                                  for direction, (nbytes, files) in self.transfers.items()),
+                'actions': dict(self.actions),
+            }
+        if scheduler is not None:
+            data['scheduler'] = { 'requests': scheduler.requests,
+                                  'throttled': scheduler.throttled,
+                                  'retries': scheduler.retries }
+        return data
+
+    def write_json(self, path, scheduler=None):
+        write_atomically(path, json.dumps(self.as_dict(scheduler), indent=2, sort_keys=True) + '\n')
+
+    def write_prometheus(self, path, scheduler=None, labels=None):
+        # In the text format node_exporter's textfile collector reads.
+        # labels, if given, is added to every sample.
+        data = self.as_dict(scheduler)
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, sample_labels, value in samples:
+                sample_labels = dict(labels or {}, **sample_labels)
+                label_text = ','.join('{}="{}"'.format(k, escape(v)) for k, v in sorted(sample_labels.items()))
+                lines.append('{}{}{} {}'.format(name, suffix, '{' + label_text + '}' if label_text else '',
+                                                 value if value is not None else 'NaN'))
+        metric('obsync_syncs_total', 'counter', 'Syncs finished.', [('', {}, data['syncs'])])
+        metric('obsync_last_sync_timestamp_seconds', 'gauge', 'When the last sync finished.',
+               [('', {}, data['last_sync'])])
+        metric('obsync_last_sync_duration_seconds', 'gauge', 'How long the last sync took.',
+               [('', {}, data['last_duration'])])
+        metric('obsync_phase_seconds_total', 'counter', 'Time spent in each phase of a sync.',
+               [('', { 'phase': name }, p['seconds']) for name, p in sorted(data['phases'].items())])
+        samples = []
+        for endpoint, r in sorted(data['requests'].items()):
+            samples += [('_bucket', { 'endpoint': endpoint, 'le': bound }, count)
+                        for bound, count in r['buckets']]
+            samples += [('_sum', { 'endpoint': endpoint }, r['seconds']),
+                        ('_count', { 'endpoint': endpoint }, r['count'])]
+        metric('obsync_request_duration_seconds', 'histogram', 'Time to the response to each request.', samples)
+        metric('obsync_responses_total', 'counter', 'Responses by endpoint and status.',
+               [('', { 'endpoint': endpoint, 'status': status }, count)
+                for endpoint, r in sorted(data['requests'].items())
+                for status, count in sorted(r['statuses'].items())])
+        metric('obsync_transfer_bytes_total', 'counter', 'File content transferred.',
+               [('', { 'direction': direction }, t['bytes']) for direction, t in sorted(data['transfers'].items())])
+        metric('obsync_transfer_files_total', 'counter', 'Files transferred.',
+               [('', { 'direction': direction }, t['files']) for direction, t in sorted(data['transfers'].items())])
+        metric('obsync_actions_total', 'counter', 'Paths by what the sync did with them.',
+               [('', { 'action': action }, count) for action, count in sorted(data['actions'].items())])
+        if scheduler is not None:
+            metric('obsync_throttled_total', 'counter', 'Requests the server throttled.',
+                   [('', {}, data['scheduler']['throttled'])])
+            metric('obsync_retries_total', 'counter', 'Requests sent again.',
+                   [('', {}, data['scheduler']['retries'])])
+        write_atomically(path, '\n'.join(lines) + '\n')
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def write_atomically(path, text):
+    # So that nothing reading the file ever sees half of it.  Several roots
+    # may be writing the same file at once.
+    path = str(path)
+    temp = '{}.{}.tmp'.format(path, threading.get_ident())
+    with open(temp, 'w') as f:
+        f.write(text)
+    os.replace(temp, path)
@@ -0,0 +1,75 @@
+import io
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mock_sharepoint import MockSharePoint, serve, CHANGE_DELETE
+from sharepoint import SharePoint
+from scheduler import Scheduler
+from db import DB
+
+class Site():
+    # A mock server, and a local folder to sync with it
+    def __init__(self, local, **options):
+        self.mock = MockSharePoint(seed=1, **options)
+        self.server, url = serve(self.mock)
+        # Retries come quickly, so that errors don't hold the tests up
+        self.sp = SharePoint(url, 'test', 'test', token={ 'Authorization': 'Bearer test' }, pool_size=2,
+                             scheduler=Scheduler(2, backoff=0.01))
+        self.local = local
+
+    def db(self, dry_run=None, jobs=2, **options):
+        return DB(str(self.local), self.sp.get_folder(self.mock.root), dry_run, jobs=jobs, **options)
+
+    def sync(self, dry_run=None, **options):
+        # Returns what the sync printed
+        self.mock.reset_stats()
+        out = io.StringIO()
+        with redirect_stdout(out):
+            self.db(dry_run, **options).sync()
+        # Timestamps only go to the second, so changes made in the same
+        # second as a sync are indistinguishable from it
+        time.sleep(1.1)
+        return out.getvalue()
+
+    def put(self, rel_path, data):
+        self.mock.put(self.mock.root + '/' + rel_path, data)
+
+    def edit(self, rel_path, data):
+        self.mock.add(self.mock.root + '/' + rel_path, False, data)
+
+    def remove(self, rel_path):
+        with self.mock.lock:
+            self.mock.change(CHANGE_DELETE, self.mock.remove(self.mock.root + '/' + rel_path))
+
+    def write(self, rel_path, data):
+        p = self.local / rel_path
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p.write_bytes(data)
+
+    def remote_files(self):
+        prefix = self.mock.root + '/'
+        return dict((path[len(prefix):], self.mock.read(node)) for path, node in self.mock.nodes.items()
+                    if path.startswith(prefix) and not node.is_folder)
+
+    def local_files(self):
+        files = {}
+        for folder, dirs, names in os.walk(str(self.local)):
+            for name in names:
+                if name.startswith('.sync.db'):
+                    continue
+                p = Path(folder) / name
+                files[p.relative_to(self.local).as_posix()] = p.read_bytes()
+        return files
+
+@pytest.fixture
+def site(tmp_path):
+    site = Site(tmp_path / 'local')
+    yield site
+    site.server.shutdown()
@@ -0,0 +1,61 @@
+import sharepoint
+
+class Login():
+    # Stands in for logging in with Microsoft, handing out token
+    calls = 0
+
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(self, site_url):
+        Login.calls += 1
+        return self
+
+    def acquire_token_for_user(self, username, password):
+        return True
+
+    def authenticate_request(self, options):
+        options.headers['Authorization'] = 'Bearer ' + self.token
+
+def test_digest_is_cached(site):
+    digest = site.sp.get_digest()
+    assert site.sp.get_digest() == digest
+    assert site.mock.requests['contextinfo'] == 1
+    # Fetched again once it is about to run out
+    site.sp.digest_expires = 0
+    assert site.sp.get_digest() != digest
+    assert site.mock.requests['contextinfo'] == 2
+
+def test_stale_digest_fetched_again(site):
+    site.write('a', b'a')
+    site.sync()
+    site.sync()
+    site.mock.expire_digests()
+    site.write('b', b'b')
+    out = site.sync()
+    assert 'Error' not in out
+    assert site.mock.requests['stale digest'] == 1
+    assert site.mock.requests['contextinfo'] == 1
+    assert site.mock.requests['POST add_file'] == 1
+    assert site.remote_files() == { 'a': b'a', 'b': b'b' }
+
+def test_expired_token_logs_in_again(site, monkeypatch):
+    site.mock.token = 'test'
+    site.write('a', b'a')
+    site.sync()
+    site.sync()
+    site.mock.token = 'renewed'
+    login = Login('renewed')
+    Login.calls = 0
+    monkeypatch.setattr(sharepoint, 'AuthenticationContext', login)
+    site.write('b', b'b')
+    out = site.sync()
+    assert 'Error' not in out
+    assert Login.calls == 1
+    assert site.mock.requests['unauthorized'] == 1
+    assert site.mock.requests['POST add_file'] == 1
+    assert site.remote_files() == { 'a': b'a', 'b': b'b' }
+    # The new token is used from then on
+    site.sync()
+    assert Login.calls == 1
+    assert site.mock.requests['unauthorized'] == 0
@@ -0,0 +1,33 @@
+def test_folders_are_created_in_a_batch(site):
+    for i in range(5):
+        (site.local / 'd{}'.format(i) / 'sub').mkdir(parents=True)
+    site.sync()
+    assert site.mock.requests['$batch'] == 1
+    for i in range(5):
+        for path in ('d{}', 'd{}/sub'):
+            assert site.mock.nodes[site.mock.root + '/' + path.format(i)].is_folder
+
+def test_deletes_are_batched(site):
+    for i in range(5):
+        site.write('d{}/f'.format(i), b'x')
+    site.write('keep', b'x')
+    site.sync()
+    for i in range(5):
+        for name in ('f', ''):
+            p = site.local / 'd{}'.format(i) / name
+            if p.is_dir():
+                p.rmdir()
+            else:
+                p.unlink()
+    site.sync()
+    assert site.mock.requests['$batch'] == 1
+    assert site.remote_files() == { 'keep': b'x' }
+
+def test_folders_with_files_are_created_in_a_batch(site):
+    files = dict(('d{}/sub/f'.format(i), 'f{}'.format(i).encode()) for i in range(20))
+    for rel_path, data in files.items():
+        site.write(rel_path, data)
+    site.sync()
+    # The files wait for their folders' batch rather than each sending it
+    assert site.mock.requests['$batch'] == 1
+    assert site.remote_files() == files
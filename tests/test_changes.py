@@ -0,0 +1,110 @@
+import sqlite3
+
+import pytest
+
+import db
+from mock_sharepoint import error
+from test_resume import interrupt_after
+
+def test_incremental_changes(site):
+    for name in ('a', 'b', 'c', 'd'):
+        site.write(name, b'v1 ' + name.encode())
+    site.sync()
+    site.sync()
+    site.write('a', b'local edit')
+    site.edit('b', b'remote edit')
+    site.remove('c')
+    (site.local / 'd').unlink()
+    site.write('e', b'new')
+    site.sync()
+    # Only what changed on the server was asked for
+    assert site.mock.requests['POST changes'] > 0
+    assert site.mock.requests['GET items'] == 0
+    expected = { 'a': b'local edit', 'b': b'remote edit', 'e': b'new' }
+    assert site.remote_files() == expected
+    assert site.local_files() == expected
+
+def test_failed_item_fetch_keeps_local_files(site):
+    site.write('a', b'v1')
+    site.write('b', b'v1')
+    site.sync()
+    site.sync()
+    site.edit('a', b'remote edit')
+    do_item = site.mock.do_item
+    site.mock.do_item = lambda *args: error(500, 'Injected error')
+    with pytest.raises(IOError):
+        site.sync()
+    assert site.local_files() == { 'a': b'v1', 'b': b'v1' }
+    site.mock.do_item = do_item
+    site.sync()
+    assert site.local_files() == { 'a': b'remote edit', 'b': b'v1' }
+
+def state(site, key):
+    conn = sqlite3.connect(str(site.local / '.sync.db'))
+    try:
+        r = conn.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return r[0] if r else None
+    finally:
+        conn.close()
+
+def test_dry_run_leaves_the_change_token(site):
+    site.write('a', b'v1')
+    site.sync()
+    site.sync()
+    token = state(site, 'change_token')
+    site.edit('a', b'remote edit')
+    out = site.sync(dry_run=True)
+    assert 'a' in out
+    assert state(site, 'change_token') == token
+    assert site.local_files() == { 'a': b'v1' }
+    # The edit is still there for the next sync to find
+    site.sync()
+    assert site.mock.requests['GET items'] == 0
+    assert site.local_files() == { 'a': b'remote edit' }
+
+def test_dry_run_leaves_an_unfinished_sync(site, monkeypatch):
+    for i in range(10):
+        site.put('f{:02}'.format(i), b'remote')
+    interrupt_after(monkeypatch, 5)
+    with pytest.raises(KeyboardInterrupt):
+        site.sync()
+    monkeypatch.undo()
+    token = state(site, 'plan_token')
+    site.put('g', b'remote')
+    site.sync(dry_run=True)
+    site.sync(dry_run=True)
+    assert state(site, 'plan_token') == token
+    assert len(site.local_files()) == 5
+    out = site.sync()
+    assert 'Carrying on with an interrupted sync, 5 paths left' in out
+    assert site.local_files() == site.remote_files()
+
+def test_edit_then_folder_move_keeps_the_file(site):
+    site.write('F/file', b'v1')
+    site.sync()
+    site.sync()
+    site.edit('F/file', b'remote edit')
+    site.mock.move(site.mock.root + '/F', site.mock.root + '/G')
+    out = site.sync()
+    assert 'Deleted' not in out
+    assert site.remote_files() == { 'G/file': b'remote edit' }
+    assert site.local_files() == { 'G/file': b'remote edit' }
+    # And it stays that way
+    site.sync()
+    assert site.local_files() == { 'G/file': b'remote edit' }
+
+def test_many_changes_listed_in_full(site, monkeypatch):
+    monkeypatch.setattr(db, 'CHANGES_LIMIT', 5)
+    for i in range(10):
+        site.write('f{}'.format(i), b'v1')
+    site.sync()
+    # The uploads come back as changes, too many to fetch one by one
+    site.sync()
+    assert site.mock.requests['GET item'] == 0
+    assert site.mock.requests['GET items'] == 1
+    for i in range(3):
+        site.edit('f{}'.format(i), b'remote edit')
+    site.sync()
+    assert site.mock.requests['GET item'] == 3
+    assert site.mock.requests['GET items'] == 0
+    assert site.local_files() == site.remote_files()
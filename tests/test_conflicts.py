@@ -0,0 +1,56 @@
+from conftest import Site
+
+def edit_both(site):
+    site.write('f', b'v1')
+    site.sync()
+    site.write('f', b'local edit')
+    site.edit('f', b'remote edit')
+
+def test_conflict_keeps_both(site):
+    edit_both(site)
+    site.sync()
+    site.sync()
+    remote = site.remote_files()
+    assert remote['f'] == b'remote edit'
+    assert sorted(remote.values()) == [b'local edit', b'remote edit']
+    assert site.local_files() == remote
+
+def test_conflict_policies(tmp_path):
+    for policy, content in (('remote', b'remote edit'), ('local', b'local edit')):
+        site = Site(tmp_path / policy)
+        try:
+            edit_both(site)
+            site.sync(conflicts=policy)
+            assert site.remote_files() == { 'f': content }
+            assert site.local_files() == { 'f': content }
+        finally:
+            site.server.shutdown()
+
+def test_deferred_conflict_settled_later(site):
+    edit_both(site)
+    out = site.sync(conflicts='defer')
+    assert 'Conflict, left for later: f' in out
+    assert site.remote_files() == { 'f': b'remote edit' }
+    assert site.local_files() == { 'f': b'local edit' }
+    # Still left alone by the next sync
+    site.sync(conflicts='defer')
+    assert site.local_files() == { 'f': b'local edit' }
+    d = site.db(conflicts='defer')
+    d.sync(d.resolve_later([], 'local'))
+    assert site.remote_files() == { 'f': b'local edit' }
+    assert site.local_files() == { 'f': b'local edit' }
+
+def test_deferred_conflict_compared_once(site):
+    site.write('f', b'v1')
+    site.sync()
+    # The same size, so the copies are compared before the conflict is
+    # deferred
+    site.write('f', b'local')
+    site.edit('f', b'remot')
+    out = site.sync(conflicts='defer')
+    assert 'Conflict, left for later: f' in out
+    assert site.mock.requests['GET value'] == 1
+    out = site.sync(conflicts='defer')
+    assert 'Conflict, left for later: f' in out
+    assert site.mock.requests['GET value'] == 0
+    assert site.local_files() == { 'f': b'local' }
@@ -0,0 +1,46 @@
+import db
+
+BIG = b'x' * db.COPY_MIN_SIZE
+
+def test_copy_made_on_server(site):
+    site.write('a', BIG)
+    site.sync()
+    site.write('b', BIG)
+    before = site.sp.stats.transfers['copied'][0]
+    out = site.sync()
+    assert 'Copied on the server from a' in out
+    assert site.mock.requests['POST copy'] == 1
+    assert site.mock.requests['POST add_file'] == 0
+    assert site.mock.requests['POST upload'] == 0
+    assert site.sp.stats.transfers['copied'][0] - before == len(BIG)
+    assert site.remote_files() == { 'a': BIG, 'b': BIG }
+    # Synced with the copy's tags, so the next sync leaves it be
+    node = site.mock.nodes[site.mock.root + '/b']
+    d = site.db()
+    synced = d.conn.execute("SELECT ctag, etag FROM sync WHERE file_path = 'b'").fetchone()
+    assert synced == (node.content_tag, node.etag)
+    d.conn.close()
+    site.sync()
+    assert site.mock.requests['GET value'] == 0
+
+def test_copy_refused_for_original_changed_on_server(site):
+    site.write('a', BIG)
+    site.sync()
+    site.write('b', BIG)
+    do_copy = site.mock.do_copy
+    def edited_first(*args):
+        # The original changes after the listing
+        site.edit('a', b'remote edit')
+        return do_copy(*args)
+    site.mock.do_copy = edited_first
+    out = site.sync()
+    assert 'Not copying a' in out
+    assert site.remote_files() == { 'a': b'remote edit', 'b': BIG }
+
+def test_small_files_uploaded(site):
+    site.write('a', b'small')
+    site.sync()
+    site.write('b', b'small')
+    site.sync()
+    assert site.mock.requests['POST copy'] == 0
+    assert site.remote_files() == { 'a': b'small', 'b': b'small' }
@@ -0,0 +1,75 @@
+import threading
+import time
+
+import pytest
+
+from mock_sharepoint import error
+
+def put_tree(site):
+    for path in ('a', 'd1/b', 'd1/sub/c', 'd2/e', 'd3/f', 'd4/g'):
+        site.put(path, path.encode())
+
+def test_crawl_lists_everything(site):
+    put_tree(site)
+    f = site.sp.get_folder(site.mock.root)
+    seen = []
+    for entry in f.crawl(jobs=4):
+        rel_path = entry.relative_to(f)
+        if '/' in rel_path:
+            # Folders come before what is in them
+            assert rel_path.rsplit('/', 1)[0] in seen
+        seen.append(rel_path)
+    assert sorted(seen) == sorted(['a', 'd1', 'd1/b', 'd1/sub', 'd1/sub/c', 'd2', 'd2/e', 'd3', 'd3/f',
+                                   'd4', 'd4/g'])
+
+def test_crawl_skips_folders(site):
+    put_tree(site)
+    f = site.sp.get_folder(site.mock.root)
+    seen = [entry.relative_to(f) for entry in f.crawl(lambda entry: entry.relative_to(f) == 'd1')]
+    assert sorted(seen) == ['a', 'd2', 'd2/e', 'd3', 'd3/f', 'd4', 'd4/g']
+
+def test_crawl_lists_folders_at_once(site):
+    put_tree(site)
+    lock = threading.Lock()
+    active = [0, 0]
+    list_folder = site.sp.list_folder
+    def slow(path):
+        with lock:
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.1)
+        try:
+            return list_folder(path)
+        finally:
+            with lock:
+                active[0] -= 1
+    site.sp.list_folder = slow
+    f = site.sp.get_folder(site.mock.root)
+    assert len(list(f.crawl(jobs=4))) == 11
+    assert active[1] > 1
+
+def test_crawl_failure_raised(site):
+    put_tree(site)
+    do_folder = site.mock.do_folder
+    def failing(method, groups, *args):
+        if groups[0].endswith('/d2'):
+            return error(404, 'File Not Found.')
+        return do_folder(method, groups, *args)
+    site.mock.do_folder = failing
+    f = site.sp.get_folder(site.mock.root)
+    with pytest.raises(ValueError):
+        list(f.crawl(jobs=4))
+
+def test_sync_falls_back_to_crawl(site):
+    put_tree(site)
+    site.mock.do_items = lambda *args: error(500, 'Injected error')
+    out = site.sync()
+    assert 'enumerating folders' in out
+    assert site.local_files() == site.remote_files()
+    site.remove('d1/sub/c')
+    site.edit('a', b'remote edit')
+    site.write('new', b'local')
+    site.sync()
+    assert 'd1/sub/c' not in site.local_files()
+    assert site.local_files() == site.remote_files()
+    assert site.remote_files()['a'] == b'remote edit'
@@ -0,0 +1,62 @@
+import os
+
+class Cut():
+    # A download that breaks off after the first chunks
+    def __init__(self, response, chunks):
+        self.response = response
+        self.status_code = response.status_code
+        self.chunks = chunks
+
+    def iter_content(self, chunk_size):
+        for i, chunk in enumerate(self.response.iter_content(chunk_size=chunk_size)):
+            if i == self.chunks:
+                raise IOError('Injected error')
+            yield chunk
+
+    def close(self):
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def cut_downloads(site, monkeypatch, chunks):
+    open_file = site.sp.open_file
+    monkeypatch.setattr(site.sp, 'open_file', lambda *args: Cut(open_file(*args), chunks))
+
+def test_interrupted_download_resumes(site, monkeypatch):
+    site.put('f', b'a' * 5000)
+    site.sync()
+    site.edit('f', b'b' * 5000)
+    cut_downloads(site, monkeypatch, 2)
+    site.sync(buffer_size=1000)
+    monkeypatch.undo()
+    # Not touched until the whole file has arrived
+    assert site.local_files()['f'] == b'a' * 5000
+    out = site.sync(buffer_size=1000)
+    assert 'Resuming download at 2000 of 5000 bytes' in out
+    assert site.local_files() == { 'f': b'b' * 5000 }
+
+def test_partial_download_of_changed_file_starts_again(site, monkeypatch):
+    site.put('f', b'a' * 5000)
+    cut_downloads(site, monkeypatch, 2)
+    site.sync(buffer_size=1000)
+    monkeypatch.undo()
+    site.edit('f', b'b' * 5000)
+    out = site.sync(buffer_size=1000)
+    assert 'Resuming download' not in out
+    assert site.local_files() == { 'f': b'b' * 5000 }
+
+def test_complete_partial_download_is_finished(site, monkeypatch):
+    site.put('f', b'x' * 5000)
+    def fail(src, dst):
+        raise OSError('Injected error')
+    monkeypatch.setattr(os, 'replace', fail)
+    site.sync()
+    monkeypatch.undo()
+    assert os.path.getsize(str(site.local / 'f.obsync-part')) == 5000
+    site.sync()
+    assert site.mock.requests['GET value'] == 0
+    assert site.local_files() == { 'f': b'x' * 5000 }
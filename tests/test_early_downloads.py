@@ -0,0 +1,90 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+from conftest import Site
+from mock_sharepoint import error
+
+class Pool(ThreadPoolExecutor):
+    # Remembers what was run on it
+    def __init__(self):
+        super().__init__(max_workers=2)
+        self.ran = []
+
+    def submit(self, fn, *args):
+        self.ran.append(getattr(fn, '__name__', None))
+        return super().submit(fn, *args)
+
+def edit_remotely(site):
+    for i in range(4):
+        site.put('f{}'.format(i), b'v1')
+    site.sync()
+    for i in range(4):
+        site.edit('f{}'.format(i), b'remote edit')
+
+def test_early_downloads_use_the_shared_pool(site):
+    edit_remotely(site)
+    pool = Pool()
+    try:
+        site.sync(executor=pool)
+    finally:
+        pool.shutdown()
+    assert pool.ran.count('fetch_part') == 4
+    # Each put in place without being downloaded again
+    assert site.mock.requests['GET value'] == 4
+    assert site.local_files() == dict(('f{}'.format(i), b'remote edit') for i in range(4))
+
+def test_early_downloads_count_as_transfers(site, monkeypatch):
+    edit_remotely(site)
+    find_moves = db.DB.find_moves
+    def slow(self):
+        time.sleep(0.5)
+        return find_moves(self)
+    monkeypatch.setattr(db.DB, 'find_moves', slow)
+    before = site.sp.stats.phases['transfers'][0]
+    site.sync()
+    # The downloads were under way from before the moves were looked for
+    assert site.sp.stats.phases['transfers'][0] - before >= 0.5
+
+def test_failed_listing_deletes_nothing(tmp_path, monkeypatch):
+    site = Site(tmp_path / 'local', page_size=100)
+    try:
+        files = dict(('d{}/f{}'.format(i % 10, i), b'v1') for i in range(1200))
+        for rel_path, data in files.items():
+            site.write(rel_path, data)
+        site.sync(quiet=True)
+        site.sync(quiet=True)
+        # A full listing, slow enough that the local scan stores some of it
+        do_changes = site.mock.do_changes
+        site.mock.do_changes = lambda *args: error(400, 'Invalid change token')
+        site.mock.latency = 0.02
+        from_fs = db.DB.from_fs
+        def scan_once_listing_started(self, paths=None, remote=None):
+            while remote.queue.qsize() < 50:
+                time.sleep(0.01)
+            return from_fs(self, paths, remote)
+        monkeypatch.setattr(db.DB, 'from_fs', scan_once_listing_started)
+        from_sp = db.DB.from_sp
+        def failing(self, remote):
+            def events():
+                for i, event in enumerate(remote):
+                    if i >= 5:
+                        raise IOError('Connection dropped')
+                    yield event
+            return from_sp(self, events())
+        monkeypatch.setattr(db.DB, 'from_sp', failing)
+        try:
+            site.sync(quiet=True)
+        except IOError:
+            pass
+        else:
+            assert False, 'the listing should have failed'
+        monkeypatch.undo()
+        site.mock.do_changes = do_changes
+        site.mock.latency = 0
+        out = site.sync()
+        assert 'Deleted' not in out
+        assert site.local_files() == files
+        assert site.remote_files() == files
+    finally:
+        site.server.shutdown()
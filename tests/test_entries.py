@@ -0,0 +1,48 @@
+import pytest
+
+from sharepoint import Entry
+
+def put_tree(site):
+    site.put('a', b'content a')
+    site.put('d/sub/b', b'content b')
+
+def listed(site, how):
+    f = site.sp.get_folder(site.mock.root)
+    entries = f.list_items() if how == 'list' else f.crawl(jobs=2)
+    return dict((entry.relative_to(f), entry) for entry in entries)
+
+@pytest.mark.parametrize('how', ['list', 'crawl'])
+def test_entries_are_compact(site, how):
+    put_tree(site)
+    entries = listed(site, how)
+    assert sorted(entries) == ['a', 'd', 'd/sub', 'd/sub/b']
+    for rel_path, entry in entries.items():
+        assert isinstance(entry, Entry)
+        # Only the fields a sync needs, and no room for more
+        assert not hasattr(entry, '__dict__')
+        node = site.mock.nodes[site.mock.root + '/' + rel_path]
+        assert entry.path == node.path
+        assert entry.is_folder == node.is_folder
+        assert entry.unique_id == node.unique_id
+        if not node.is_folder:
+            assert int(entry.length) == node.length
+            assert entry.etag == node.etag
+            assert entry.content_tag == node.content_tag
+            assert entry.version == '{}.0'.format(node.version)
+    if how == 'list':
+        assert all(entry.item_id == site.mock.nodes[entry.path].item_id for entry in entries.values())
+
+@pytest.mark.parametrize('how', ['list', 'crawl'])
+def test_listings_select_fields(site, monkeypatch, how):
+    put_tree(site)
+    urls = []
+    get = site.sp.get
+    def recording(path):
+        urls.append(path)
+        return get(path)
+    monkeypatch.setattr(site.sp, 'get', recording)
+    listed(site, how)
+    # Every query the listing makes asks only for what it uses
+    queries = [url for url in urls if '?' in url]
+    assert len(queries) >= 2
+    assert all('$select=' in url for url in queries)
@@ -0,0 +1,52 @@
+import hashlib
+import os
+
+import pytest
+
+import db
+
+def test_touch_not_uploaded(site):
+    site.write('a', b'v1')
+    site.sync()
+    later = os.stat(str(site.local / 'a')).st_mtime + 60
+    os.utime(str(site.local / 'a'), (later, later))
+    out = site.sync()
+    assert 'Up to Date (same content): a' in out
+    assert site.mock.requests['POST add_file'] == 0
+
+def test_same_content_on_both_sides_not_a_conflict(site):
+    site.write('new', b'same')
+    site.put('new', b'same')
+    site.write('f', b'v1')
+    site.sync()
+    site.write('f', b'v2')
+    site.edit('f', b'v2')
+    out = site.sync()
+    assert 'Conflict' not in out
+    assert site.remote_files() == { 'new': b'same', 'f': b'v2' }
+    assert site.local_files() == site.remote_files()
+
+def test_same_size_different_content_is_a_conflict(site):
+    site.write('f', b'v1')
+    site.sync()
+    site.write('f', b'v2')
+    site.edit('f', b'v3')
+    out = site.sync()
+    assert 'Conflict, keeping both: f' in out
+    assert sorted(site.remote_files().values()) == [b'v2', b'v3']
+
+@pytest.mark.parametrize('chunk_size', [None, 4])
+def test_uploaded_file_hashed_as_it_is_sent(site, monkeypatch, chunk_size):
+    def refused(self, rel_path):
+        raise AssertionError('{} read just to hash it'.format(rel_path))
+    monkeypatch.setattr(db.DB, 'local_hash', refused)
+    site.write('a', b'new content')
+    options = { 'chunk_size': chunk_size } if chunk_size else {}
+    out = site.sync(**options)
+    assert 'Error' not in out
+    monkeypatch.undo()
+    d = site.db()
+    hash = hashlib.sha256(b'new content').hexdigest()
+    assert d.conn.execute("SELECT hash FROM sync WHERE file_path = 'a'").fetchone()[0] == hash
+    assert d.local_hash('a') == hash
+    d.conn.close()
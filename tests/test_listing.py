@@ -0,0 +1,22 @@
+from conftest import Site
+
+def test_listing_follows_pages(tmp_path):
+    site = Site(tmp_path / 'local', page_size=3)
+    try:
+        files = dict(('d{}/f{}'.format(i % 2, i), 'remote {}'.format(i).encode()) for i in range(8))
+        for rel_path, data in files.items():
+            site.put(rel_path, data)
+        site.sync()
+        # Ten items, three to a page
+        assert site.mock.requests['GET items'] == 4
+        assert site.local_files() == files
+    finally:
+        site.server.shutdown()
+
+def test_listing_keeps_only_the_synced_folder(site):
+    site.put('a', b'a')
+    # Another library, as far as the mock's single list is concerned
+    site.mock.add(site.mock.site + '/Elsewhere', True)
+    site.mock.add(site.mock.site + '/Elsewhere/b', False, b'b')
+    folder = site.sp.get_folder(site.mock.root)
+    assert [item.relative_to(folder) for item in site.sp.list_items(folder, page_size=1)] == ['a']
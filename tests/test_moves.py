@@ -0,0 +1,44 @@
+import os
+
+def test_local_rename_moved_on_server(site):
+    site.write('a', b'content a')
+    site.sync()
+    os.rename(str(site.local / 'a'), str(site.local / 'b'))
+    out = site.sync()
+    assert 'Moved Locally: a -> b' in out
+    assert site.mock.requests['POST move'] == 1
+    assert site.mock.requests['POST add_file'] == 0
+    assert site.remote_files() == { 'b': b'content a' }
+
+def test_local_folder_moved_into_new_folder(site):
+    site.write('d/a', b'a')
+    site.write('d/sub/b', b'b')
+    site.sync()
+    (site.local / 'new').mkdir()
+    os.rename(str(site.local / 'd'), str(site.local / 'new' / 'd'))
+    site.sync()
+    # The folder is moved with everything in it, nothing uploaded again
+    assert site.mock.requests['POST move'] == 1
+    assert site.mock.requests['POST add_file'] == 0
+    assert site.remote_files() == { 'new/d/a': b'a', 'new/d/sub/b': b'b' }
+    assert site.local_files() == site.remote_files()
+
+def test_remote_move_renamed_locally(site):
+    site.put('d/a', b'a')
+    site.sync()
+    inode = os.stat(str(site.local / 'd' / 'a')).st_ino
+    site.mock.add(site.mock.root + '/e', True)
+    site.mock.move(site.mock.root + '/d/a', site.mock.root + '/e/b')
+    out = site.sync()
+    assert 'Moved on Remote: d/a -> e/b' in out
+    assert site.mock.requests['GET value'] == 0
+    assert site.local_files() == { 'e/b': b'a' }
+    assert os.stat(str(site.local / 'e' / 'b')).st_ino == inode
+
+def test_moved_and_edited_locally(site):
+    site.write('a', b'v1')
+    site.sync()
+    os.rename(str(site.local / 'a'), str(site.local / 'b'))
+    site.write('b', b'v2')
+    site.sync()
+    assert site.remote_files() == { 'b': b'v2' }
@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+import db
+
+def test_downloads_use_the_listing(site):
+    site.put('a', b'remote a')
+    site.put('d/b', b'remote b')
+    site.sync()
+    # Straight to each file's content, without asking about it first
+    assert site.mock.requests['GET file'] == 0
+    assert site.mock.requests['GET value'] == 2
+    assert site.local_files() == { 'a': b'remote a', 'd/b': b'remote b' }
+
+class Refused():
+    # A streamed response the server said no with
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+@pytest.mark.parametrize('status', [404, 412, 500])
+def test_refused_download_is_closed(site, monkeypatch, status):
+    response = Refused(status)
+    monkeypatch.setattr(site.sp, 'get_raw', lambda *args: response)
+    with pytest.raises(IOError):
+        site.sp.open_file('/sites/bench/Shared Documents/f', 0, '"{etag},1"')
+    # Otherwise its connection never goes back to the pool
+    assert response.closed
+
+@pytest.mark.parametrize('status', [404, 500])
+def test_refused_item_fetch_is_closed(site, monkeypatch, status):
+    response = Refused(status)
+    monkeypatch.setattr(site.sp, 'get_raw', lambda *args: response)
+    with pytest.raises(IOError):
+        site.sp.get_list_item(site.mock.list_id, 1)
+    assert response.closed
+
+def test_download_refused_for_file_changed_since_listed(site):
+    site.put('f', b'v1')
+    site.sync()
+    stale = site.mock.nodes[site.mock.root + '/f'].etag
+    site.edit('f', b'v2')
+    with pytest.raises(IOError):
+        site.sp.open_file(site.mock.root + '/f', 0, stale)
+
+def test_deleted_folder_kept_for_remote_edit(site):
+    site.write('d/a', b'v1')
+    site.write('d/sub/b', b'v1')
+    site.sync()
+    for p in ('d/sub/b', 'd/a'):
+        (site.local / p).unlink()
+    for p in ('d/sub', 'd'):
+        (site.local / p).rmdir()
+    site.edit('d/sub/b', b'remote edit')
+    site.sync()
+    assert site.remote_files() == { 'd/sub/b': b'remote edit' }
+    assert site.local_files() == { 'd/sub/b': b'remote edit' }
+
+def test_remote_delete_keeps_local_edit(site):
+    site.write('a', b'v1')
+    site.write('b', b'v1')
+    site.sync()
+    site.remove('a')
+    site.remove('b')
+    site.write('a', b'local edit')
+    # Only touched, so the delete stands
+    os.utime(str(site.local / 'b'))
+    out = site.sync()
+    assert 'Deleted from Remote: a' not in out
+    assert site.remote_files() == { 'a': b'local edit' }
+    assert site.local_files() == { 'a': b'local edit' }
+
+def test_remote_deleted_folder_kept_for_new_local_file(site):
+    site.write('d/a', b'v1')
+    site.write('d/sub/b', b'v1')
+    site.sync()
+    site.remove('d')
+    site.write('d/new', b'new')
+    site.write('d/sub/c', b'new')
+    out = site.sync()
+    assert 'Error' not in out
+    expected = { 'd/new': b'new', 'd/sub/c': b'new' }
+    assert site.remote_files() == expected
+    assert site.local_files() == expected
+
+@pytest.mark.parametrize('chunk_size', [None, 4])
+def test_upload_refused_for_file_changed_since_listed(site, monkeypatch, chunk_size):
+    site.write('f', b'v1')
+    site.sync()
+    site.write('f', b'local edit')
+    sync_to_sp = db.DB.sync_to_sp
+    def edited_first(self, row):
+        if row[0] == 'f' and site.remote_files()['f'] == b'v1':
+            site.edit('f', b'remote edit')
+        sync_to_sp(self, row)
+    monkeypatch.setattr(db.DB, 'sync_to_sp', edited_first)
+    options = { 'chunk_size': chunk_size } if chunk_size else {}
+    out = site.sync(**options)
+    assert "Conflict, keeping both" in out
+    remote = site.remote_files()
+    assert remote.pop('f') == b'remote edit'
+    assert list(remote.values()) == [b'local edit']
+    assert site.local_files() == site.remote_files()
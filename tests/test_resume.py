@@ -0,0 +1,51 @@
+from concurrent.futures import wait
+
+import pytest
+
+import db
+from mock_sharepoint import error
+
+def interrupt_after(monkeypatch, transfers):
+    # Stops the sync the way Ctrl-C would, once transfers have been done
+    submit = db.DB.submit
+    submitted = []
+    def interrupting(self, action, row):
+        if len(submitted) >= transfers:
+            wait(self.pending)
+            raise KeyboardInterrupt
+        submitted.append(row[0])
+        submit(self, action, row)
+    monkeypatch.setattr(db.DB, 'submit', interrupting)
+
+def test_resume_carries_on_with_what_was_left(site, monkeypatch):
+    for i in range(10):
+        site.put('f{:02}'.format(i), b'remote')
+    interrupt_after(monkeypatch, 5)
+    with pytest.raises(KeyboardInterrupt):
+        site.sync()
+    monkeypatch.undo()
+    assert len(site.local_files()) == 5
+    out = site.sync()
+    assert 'Carrying on with an interrupted sync, 5 paths left' in out
+    assert site.mock.requests['GET items'] == 0
+    assert site.local_files() == site.remote_files()
+    assert len(site.remote_files()) == 10
+
+@pytest.mark.parametrize('refused', ['changes', 'items'])
+def test_resume_with_full_listing_keeps_what_was_done(site, monkeypatch, refused):
+    # The resumed sync lists everything: either the server no longer takes
+    # the token the plan was made with, or there never was one because the
+    # library is walked folder by folder
+    for i in range(10):
+        site.put('f{:02}'.format(i), b'remote')
+    if refused == 'items':
+        site.mock.do_items = lambda *args: error(500, 'Injected error')
+    interrupt_after(monkeypatch, 5)
+    with pytest.raises(KeyboardInterrupt):
+        site.sync()
+    monkeypatch.undo()
+    site.mock.do_changes = lambda *args: error(400, 'Invalid change token')
+    out = site.sync()
+    assert 'Deleted' not in out
+    assert len(site.remote_files()) == 10
+    assert site.local_files() == site.remote_files()
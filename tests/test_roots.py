@@ -0,0 +1,99 @@
+import signal
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from db import DB
+from roots import Roots, read_config
+
+def write_config(tmp_path, text):
+    path = tmp_path / 'roots.conf'
+    path.write_text(text)
+    return path
+
+def test_read_config(tmp_path):
+    path = write_config(tmp_path, '''
+[DEFAULT]
+server = https://example.com/sites/a/
+username = me
+
+[/srv/one]
+remote_path = One
+
+[two]
+local_path = /srv/two
+server = https://example.com/sites/b/
+remote_path = Two
+password = secret
+''')
+    assert read_config(path) == [
+        ('/srv/one', { 'server': 'https://example.com/sites/a/', 'remote_path': 'One',
+                       'username': 'me', 'password': None }),
+        ('/srv/two', { 'server': 'https://example.com/sites/b/', 'remote_path': 'Two',
+                       'username': 'me', 'password': 'secret' })]
+
+def test_read_config_refuses_incomplete_roots(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        read_config(tmp_path / 'missing.conf')
+    path = write_config(tmp_path, '[/srv/one]\nserver = https://example.com/sites/a/\n')
+    with pytest.raises(ValueError):
+        read_config(path)
+
+def add_roots(site, tmp_path, names):
+    # Folders on the server, each synced once to a local path of its own so
+    # that its database knows where it goes and has a token to log in with
+    for name in names:
+        site.mock.add(site.mock.root + '/' + name, True)
+        DB(str(tmp_path / name), site.sp.get_folder(site.mock.root + '/' + name), None).sync()
+    return write_config(tmp_path, ''.join('[{}]\n'.format(tmp_path / name) for name in names))
+
+def test_roots_synced_together(site, tmp_path, capsys):
+    config = add_roots(site, tmp_path, ['one', 'two'])
+    (tmp_path / 'one' / 'a').write_bytes(b'local a')
+    site.put('two/b', b'remote b')
+    roots = Roots(config, jobs=2, parallel=2, dry_run=False)
+    # Both are on the same site as the same user
+    assert len(roots.sites) == 1
+    assert roots.sync() == 0
+    assert '2 roots synced, 0 failed' in capsys.readouterr().out
+    assert site.remote_files() == { 'one/a': b'local a', 'two/b': b'remote b' }
+    assert (tmp_path / 'two' / 'b').read_bytes() == b'remote b'
+
+def test_failed_root_leaves_the_others(site, tmp_path, capsys):
+    config = add_roots(site, tmp_path, ['one', 'two'])
+    (tmp_path / 'two' / 'a').write_bytes(b'local a')
+    roots = Roots(config, jobs=2, parallel=2, dry_run=False)
+    def fail(changes=None):
+        raise IOError('Injected error')
+    roots.dbs[0].sync = fail
+    assert roots.sync() == 1
+    assert '1 roots synced, 1 failed' in capsys.readouterr().out
+    assert site.remote_files() == { 'two/a': b'local a' }
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is Linux only')
+def test_watch_stops_on_ctrl_c(site, tmp_path):
+    config = add_roots(site, tmp_path, ['one', 'two'])
+    roots = Roots(config, jobs=2, parallel=2, dry_run=False)
+    # Once both are waiting for changes
+    ctrl_c = lambda: signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+    threading.Timer(2, ctrl_c).start()
+    start = time.time()
+    with pytest.raises(KeyboardInterrupt):
+        roots.sync(watch=True, interval=60)
+    # Both watches have stopped by the time it returns
+    assert time.time() - start < 10
+
+@pytest.mark.parametrize('flag', [['--exclude', 'a'], ['--include', 'a'], ['--clear-rules'],
+                                  ['--max-size', '1'], ['--bearer', 'x']])
+def test_root_settings_refused_with_config(tmp_path, flag):
+    config = write_config(tmp_path, '[{}]\n'.format(tmp_path / 'one'))
+    obsync = Path(__file__).parent.parent / 'obsync.py'
+    p = subprocess.run([sys.executable, str(obsync), '--config', str(config)] + flag,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert p.returncode == 2
+    assert flag[0] in p.stderr
+    assert 'cannot be used with --config' in p.stderr
@@ -0,0 +1,89 @@
+import subprocess
+import sys
+from pathlib import Path
+
+from mock_sharepoint import error
+from rules import Rules
+
+def test_patterns():
+    rules = Rules(['archive/', '/Forms/', '*.tmp', '!keep.tmp', 'docs/**/draft?.txt', '# a comment'])
+    assert rules.excluded('archive', True)
+    assert rules.excluded('a/b/archive', True)
+    assert not rules.excluded('archive', False)
+    assert rules.excluded('Forms', True)
+    assert not rules.excluded('a/Forms', True)
+    assert rules.excluded('a/b.tmp')
+    assert not rules.excluded('a/keep.tmp')
+    assert rules.excluded('docs/draft1.txt')
+    assert rules.excluded('docs/a/b/draft2.txt')
+    assert not rules.excluded('docs/draft10.txt')
+    assert not rules.excluded('# a comment')
+
+def test_nothing_brought_back_inside_excluded_folder():
+    rules = Rules(['archive/', '!keep'])
+    assert not rules.excluded('keep')
+    assert rules.excluded('archive/keep')
+
+def test_excluded_paths_left_alone_on_both_sides(site):
+    site.write('a', b'a')
+    site.write('b.tmp', b'local')
+    site.write('archive/c', b'local')
+    site.put('d.tmp', b'remote')
+    site.put('archive/e', b'remote')
+    site.db().change_rules(['*.tmp', 'archive/'])
+    site.sync()
+    assert site.remote_files() == { 'a': b'a', 'd.tmp': b'remote', 'archive/e': b'remote' }
+    assert site.local_files() == { 'a': b'a', 'b.tmp': b'local', 'archive/c': b'local' }
+    # Missing from the other side isn't taken as deleted
+    site.sync()
+    assert set(site.remote_files()) == { 'a', 'd.tmp', 'archive/e' }
+    assert set(site.local_files()) == { 'a', 'b.tmp', 'archive/c' }
+
+def test_excluded_folders_not_listed(site):
+    site.put('archive/sub/f', b'remote')
+    site.put('a', b'a')
+    site.mock.do_items = lambda *args: error(500, 'Injected error')
+    listed = []
+    do_folder = site.mock.do_folder
+    def listing(method, groups, *args):
+        listed.append(groups[0])
+        return do_folder(method, groups, *args)
+    site.mock.do_folder = listing
+    site.db().change_rules(['archive/'])
+    site.sync()
+    # Walked folder by folder, without going into archive
+    assert listed and not [path for path in listed if 'archive' in path]
+    assert site.local_files() == { 'a': b'a' }
+
+def test_changed_rules_look_at_everything_again(site):
+    site.write('b.tmp', b'local')
+    site.db().change_rules(['*.tmp'])
+    site.sync()
+    assert site.remote_files() == {}
+    site.db().change_rules(clear=True)
+    site.sync()
+    assert site.remote_files() == { 'b.tmp': b'local' }
+
+def test_max_size(site):
+    site.write('small', b'x' * 100)
+    site.write('big', b'x' * 5000)
+    site.put('remote_big', b'x' * 5000)
+    site.db().change_rules(max_size=1000)
+    site.sync()
+    assert site.remote_files() == { 'small': b'x' * 100, 'remote_big': b'x' * 5000 }
+    assert set(site.local_files()) == { 'small', 'big' }
+    site.db().change_rules(max_size=0)
+    site.sync()
+    assert set(site.remote_files()) == set(site.local_files()) == { 'small', 'big', 'remote_big' }
+
+def test_command_line_patterns_kept_in_order(site):
+    site.write('a.tmp', b'a')
+    site.write('keep.tmp', b'k')
+    site.write('b', b'b')
+    obsync = Path(__file__).parent.parent / 'obsync.py'
+    # The --exclude after the --include wins
+    subprocess.run([sys.executable, str(obsync), str(site.local), site.sp.site_url, site.mock.root,
+                    '--username', 'test', '--bearer', 'test', '--include', 'keep.tmp', '--exclude', '*.tmp'],
+                   stdout=subprocess.PIPE, check=True)
+    assert site.remote_files() == { 'b': b'b' }
+    assert [r[0] for r in site.db().conn.execute('SELECT pattern FROM rules ORDER BY rowid')] == ['!keep.tmp', '*.tmp']
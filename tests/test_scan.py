@@ -0,0 +1,37 @@
+import os
+
+import db
+
+def scanned_dirs(monkeypatch):
+    # Records the directories the local scan lists
+    scandir = os.scandir
+    dirs = []
+    def recording(path):
+        dirs.append(path)
+        return scandir(path)
+    monkeypatch.setattr(db.os, 'scandir', recording)
+    return dirs
+
+def test_quick_scan_finds_deep_change(site):
+    site.write('a/b/c/d/f', b'v1')
+    site.write('x/g', b'v1')
+    site.sync(quick_scan=True)
+    site.write('a/b/c/d/new', b'new')
+    site.sync(quick_scan=True)
+    assert site.remote_files() == { 'a/b/c/d/f': b'v1', 'a/b/c/d/new': b'new', 'x/g': b'v1' }
+
+def test_quick_scan_skips_untouched_dirs(site, monkeypatch):
+    site.write('a/b/f', b'v1')
+    site.write('x/g', b'v1')
+    site.sync(quick_scan=True)
+    site.write('a/b/new', b'new')
+    # Edited in place, which leaves the directory as it was
+    site.write('x/g', b'local edit')
+    dirs = scanned_dirs(monkeypatch)
+    site.sync(quick_scan=True)
+    assert sorted(os.path.relpath(d, str(site.local)) for d in dirs) == ['.', 'a/b']
+    assert site.remote_files() == { 'a/b/f': b'v1', 'a/b/new': b'new', 'x/g': b'v1' }
+    # A full scan finds the edit
+    monkeypatch.undo()
+    site.sync()
+    assert site.remote_files()['x/g'] == b'local edit'
@@ -0,0 +1,126 @@
+import threading
+import time
+from email.utils import formatdate
+
+import pytest
+import requests
+
+import scheduler
+from scheduler import Scheduler, Throttled
+
+class Response():
+    def __init__(self, status_code, retry_after=None):
+        self.status_code = status_code
+        self.headers = { 'Retry-After': retry_after } if retry_after is not None else {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+def sender(*answers):
+    # Gives each answer in turn, raising those that are exceptions, and
+    # keeps what it gave
+    sent = []
+    def send():
+        answer = answers[min(len(sent), len(answers) - 1)]
+        sent.append(answer)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+    send.sent = sent
+    return send
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(scheduler.time, 'sleep', slept.append)
+    return slept
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_throttled_request_retried(sleeps, status):
+    s = Scheduler(4, backoff=0.01)
+    send = sender(Response(status), Response(200))
+    assert s.run(send).status_code == 200
+    assert len(send.sent) == 2
+    assert send.sent[0].closed
+    assert (s.requests, s.throttled, s.retries) == (2, 1, 1)
+
+def test_retry_after_seconds(sleeps):
+    s = Scheduler(4)
+    s.run(sender(Response(429, '3'), Response(200)))
+    assert sleeps == [3.0]
+
+def test_retry_after_date(sleeps):
+    s = Scheduler(4)
+    s.run(sender(Response(503, formatdate(time.time() + 30, usegmt=True)), Response(200)))
+    assert 28 <= sleeps[0] <= 30
+
+def test_backoff_without_retry_after(sleeps):
+    s = Scheduler(4, backoff=1.0, max_backoff=5.0)
+    s.run(sender(*[Response(429)] * 6 + [Response(200)]))
+    for attempt, delay in enumerate(sleeps):
+        assert 0 <= delay <= min(5.0, 2 ** attempt)
+
+def test_gives_up_after_retry_limit(sleeps):
+    s = Scheduler(4, retries=3, backoff=0.01)
+    send = sender(*[Response(429) for i in range(4)])
+    with pytest.raises(Throttled):
+        s.run(send)
+    assert len(send.sent) == 4
+    assert all(response.closed for response in send.sent)
+
+@pytest.mark.parametrize('status', [500, 502, 504])
+def test_transient_errors_retried_only_if_idempotent(sleeps, status):
+    s = Scheduler(4, backoff=0.01)
+    send = sender(Response(status), Response(200))
+    assert s.run(send, idempotent=True).status_code == 200
+    assert send.sent[0].closed
+    send = sender(Response(status), Response(200))
+    assert s.run(send).status_code == status
+    assert len(send.sent) == 1
+
+def test_last_transient_error_returned(sleeps):
+    s = Scheduler(4, retries=2, backoff=0.01)
+    send = sender(Response(500), Response(500), Response(500))
+    response = s.run(send, idempotent=True)
+    assert response.status_code == 500
+    assert not response.closed
+    assert len(send.sent) == 3
+
+def test_dropped_connection_retried_only_if_idempotent(sleeps):
+    s = Scheduler(4, backoff=0.01)
+    send = sender(requests.ConnectionError(), Response(200))
+    assert s.run(send, idempotent=True).status_code == 200
+    for error in (requests.ConnectionError(), requests.Timeout()):
+        send = sender(error, Response(200))
+        with pytest.raises(type(error)):
+            s.run(send)
+        # The server may have acted on it already
+        assert len(send.sent) == 1
+
+def test_limit_halved_when_throttled_and_grows_back(sleeps):
+    s = Scheduler(8, backoff=0.01)
+    s.run(sender(Response(429), Response(200)))
+    assert s.limit == 4
+    s.run(sender(Response(429), Response(200)))
+    assert s.limit == 2
+    # Back up by one for every `limit` successes in a row
+    for i in range(2):
+        s.run(sender(Response(200)))
+    assert s.limit == 3
+    for i in range(100):
+        s.run(sender(Response(200)))
+    assert s.limit == 8
+
+def test_limit_caps_requests_in_flight():
+    s = Scheduler(2)
+    s.acquire()
+    s.acquire()
+    started = []
+    t = threading.Thread(target=lambda: (s.acquire(), started.append(True)))
+    t.start()
+    t.join(0.2)
+    assert not started
+    s.release(True)
+    t.join(1)
+    assert started
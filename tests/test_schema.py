@@ -0,0 +1,61 @@
+import sqlite3
+import time
+
+import pytest
+
+import db
+
+def write_first_version(site, last_sync):
+    # A database as the first version of the tool left it, with a file
+    # synced at last_sync
+    site.local.mkdir()
+    conn = sqlite3.connect(str(site.local / '.sync.db'))
+    conn.execute('CREATE TABLE params (server_url text, remote_path text, username text, password text)')
+    conn.execute('INSERT INTO params VALUES (?, ?, ?, ?)', (site.sp.site_url, site.mock.root, 'test', 'test'))
+    conn.execute('CREATE TABLE sync (file_path text primary key, is_folder boolean, synced boolean, '
+                 'last_sync timestamp)')
+    conn.execute('CREATE TABLE sp (file_path text primary key, is_folder boolean, tstamp timestamp)')
+    conn.execute('CREATE TABLE fs (file_path text primary key, is_folder boolean, tstamp timestamp)')
+    conn.execute('INSERT INTO sync VALUES (?, 0, 1, ?)',
+                 ('a', time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_sync))))
+    conn.execute('INSERT INTO sp VALUES (?, 0, ?)', ('a', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(last_sync))))
+    conn.execute('INSERT INTO fs VALUES (?, 0, ?)', ('a', last_sync + 0.5))
+    conn.commit()
+    conn.close()
+
+def test_first_version_brought_up_to_date(site):
+    last_sync = int(time.time()) - 60
+    write_first_version(site, last_sync)
+    d = site.db()
+    c = d.conn.cursor()
+    assert c.execute('PRAGMA user_version').fetchone()[0] == db.SCHEMA_VERSION
+    assert c.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    for table, columns in db.tables:
+        names = [r[1] for r in c.execute('PRAGMA table_info({})'.format(table))]
+        assert sorted(names) == sorted(line.split()[0] for line in columns.split(','))
+    indexes = set(r[0] for r in c.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+    assert set(['sp_item_id', 'sp_unique_id', 'fs_inode', 'sync_hash']) <= indexes
+    # Timestamps are now integer nanoseconds
+    assert c.execute('SELECT last_sync FROM sync').fetchone()[0] == last_sync * 1000000000
+    assert c.execute('SELECT tstamp FROM sp').fetchone()[0] == last_sync * 1000000000
+    assert c.execute('SELECT tstamp FROM fs').fetchone()[0] == last_sync * 1000000000 + 500000000
+    d.conn.close()
+
+def test_synced_after_migration(site):
+    site.put('a', b'same')
+    site.put('b', b'remote')
+    time.sleep(1.1)
+    write_first_version(site, int(time.time()))
+    site.write('a', b'same')
+    out = site.sync()
+    assert 'Conflict' not in out
+    assert site.local_files() == site.remote_files() == { 'a': b'same', 'b': b'remote' }
+
+def test_newer_version_refused(site):
+    site.write('a', b'a')
+    site.sync()
+    conn = sqlite3.connect(str(site.local / '.sync.db'))
+    conn.execute('PRAGMA user_version = {}'.format(db.SCHEMA_VERSION + 1))
+    conn.close()
+    with pytest.raises(ValueError):
+        site.db()
@@ -0,0 +1,52 @@
+import json
+
+from stats import Histogram, Stats, escape
+
+def test_histogram():
+    h = Histogram()
+    for seconds, status in ((0.01, 200), (0.3, 200), (0.3, 429), (100, None)):
+        h.observe(seconds, status)
+    assert h.count == 4
+    assert h.max == 100
+    assert h.statuses == { '200': 2, '429': 1, 'failed': 1 }
+    buckets = dict(h.cumulative())
+    assert buckets['0.05'] == 1
+    assert buckets['0.25'] == 1
+    assert buckets['0.5'] == 3
+    assert buckets['60'] == 3
+    assert buckets['+Inf'] == 4
+
+def test_throughput_over_transfer_time():
+    stats = Stats()
+    with stats.phase('transfers', stats.started - 2):
+        stats.transferred('up', 1000, files=1)
+    data = stats.as_dict()
+    assert data['phases']['transfers']['runs'] == 1
+    assert 2 <= data['phases']['transfers']['seconds'] < 3
+    assert data['transfers']['up'] == { 'bytes': 1000, 'files': 1,
+                                        'bytes_per_second': 1000 / data['phases']['transfers']['seconds'] }
+    assert data['transfers']['down']['bytes_per_second'] == 0
+
+def test_sync_writes_stats(site, tmp_path):
+    site.write('a', b'x' * 1000)
+    site.put('b', b'y' * 500)
+    stats_json = tmp_path / 'stats.json'
+    prometheus = tmp_path / 'obsync.prom'
+    site.sync(stats_json=str(stats_json), prometheus=str(prometheus))
+    data = json.loads(stats_json.read_text())
+    assert data['syncs'] == 1
+    assert set(['from_fs', 'from_sp', 'find_moves', 'plan', 'transfers']) <= set(data['phases'])
+    assert data['transfers']['up']['bytes'] == 1000
+    assert data['transfers']['up']['files'] == 1
+    assert data['transfers']['down']['bytes'] == 500
+    assert data['transfers']['down']['files'] == 1
+    assert sum(r['count'] for r in data['requests'].values()) == data['scheduler']['requests']
+    lines = prometheus.read_text().splitlines()
+    assert 'obsync_syncs_total 1' in lines
+    assert 'obsync_transfer_bytes_total{direction="up"} 1000' in lines
+    assert '# TYPE obsync_request_duration_seconds histogram' in lines
+    assert any(line.startswith('obsync_request_duration_seconds_bucket{') and 'le="+Inf"' in line
+               for line in lines)
+
+def test_escape():
+    assert escape('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
@@ -0,0 +1,35 @@
+from conftest import Site
+
+def test_first_sync_uploads_and_downloads(site):
+    site.write('a.txt', b'local a')
+    site.write('d/b.txt', b'local b')
+    site.put('r/c.txt', b'remote c')
+    site.sync()
+    expected = { 'a.txt': b'local a', 'd/b.txt': b'local b', 'r/c.txt': b'remote c' }
+    assert site.remote_files() == expected
+    assert site.local_files() == expected
+
+def test_injected_errors_never_lose_local_files(tmp_path):
+    site = Site(tmp_path / 'local', errors=0.2)
+    try:
+        files = dict(('d{}/f{}'.format(i % 3, i), 'v1 {}'.format(i).encode()) for i in range(30))
+        for rel_path, data in files.items():
+            site.write(rel_path, data)
+        for i in range(3):
+            site.sync()
+            assert site.local_files() == files
+        for i in range(0, 30, 3):
+            rel_path = 'd{}/f{}'.format(i % 3, i)
+            if site.mock.nodes.get(site.mock.root + '/' + rel_path):
+                site.edit(rel_path, b'remote edit')
+                files[rel_path] = b'remote edit'
+        for i in range(3):
+            site.sync()
+            assert set(site.local_files()) == set(files)
+        # Once the server behaves, everything settles
+        site.mock.errors = 0
+        site.sync()
+        assert site.local_files() == files
+        assert site.remote_files() == files
+    finally:
+        site.server.shutdown()
@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+
+import db
+from mock_sharepoint import error
+
+def count_active(monkeypatch, name):
+    # Slows DB.name down and records the most calls to it at once
+    lock = threading.Lock()
+    active = [0, 0]
+    method = getattr(db.DB, name)
+    def slow(self, *args, **kwargs):
+        with lock:
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.05)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            with lock:
+                active[0] -= 1
+    monkeypatch.setattr(db.DB, name, slow)
+    return active
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_downloads_run_jobs_at_once(site, monkeypatch, jobs):
+    files = dict(('d{}/f{}'.format(i % 2, i), 'f{}'.format(i).encode()) for i in range(8))
+    for rel_path, data in files.items():
+        site.put(rel_path, data)
+    active = count_active(monkeypatch, 'download')
+    site.sync(jobs=jobs)
+    assert active[1] == 1 if jobs == 1 else active[1] > 1
+    assert site.local_files() == files
+
+def test_uploads_run_at_once(site, monkeypatch):
+    files = dict(('f{}'.format(i), b'local') for i in range(8))
+    for rel_path, data in files.items():
+        site.write(rel_path, data)
+    active = count_active(monkeypatch, 'sync_to_sp')
+    site.sync(jobs=4)
+    assert active[1] > 1
+    assert site.remote_files() == files
+
+def test_failed_transfer_doesnt_stop_the_rest(site):
+    for name in ('a', 'b', 'c'):
+        site.put(name, name.encode())
+    do_value = site.mock.do_value
+    def failing(method, groups, *args):
+        if groups[0].endswith('/b'):
+            return error(404, 'File Not Found.')
+        return do_value(method, groups, *args)
+    site.mock.do_value = failing
+    out = site.sync()
+    assert '*** Error: b' in out
+    assert site.local_files() == { 'a': b'a', 'c': b'c' }
+    site.mock.do_value = do_value
+    site.sync()
+    assert site.local_files() == { 'a': b'a', 'b': b'b', 'c': b'c' }
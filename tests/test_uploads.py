@@ -0,0 +1,54 @@
+import hashlib
+
+from mock_sharepoint import error
+
+def fail_upload_after(site, offset):
+    # Makes chunked uploads fail from offset on; returns the undo
+    do_upload = site.mock.do_upload
+    def failing(method, groups, *args):
+        if groups[1] == 'ContinueUpload' and int(groups[3]) >= offset:
+            return error(400, 'Injected error')
+        return do_upload(method, groups, *args)
+    site.mock.do_upload = failing
+    return lambda: setattr(site.mock, 'do_upload', do_upload)
+
+def test_interrupted_upload_resumes(site):
+    site.write('big', b'a' * 5000)
+    undo = fail_upload_after(site, 2000)
+    site.sync(chunk_size=1000)
+    undo()
+    out = site.sync(chunk_size=1000)
+    assert 'Resuming upload at 2000 of 5000 bytes' in out
+    assert site.remote_files() == { 'big': b'a' * 5000 }
+    # The hash takes in what the first sync sent too
+    d = site.db()
+    hash = d.conn.execute("SELECT hash FROM sync WHERE file_path = 'big'").fetchone()[0]
+    assert hash == hashlib.sha256(b'a' * 5000).hexdigest()
+    d.conn.close()
+
+def test_interrupted_upload_not_resumed_over_remote_edit(site):
+    site.write('big', b'a' * 5000)
+    site.sync(chunk_size=1000)
+    site.write('big', b'b' * 5000)
+    undo = fail_upload_after(site, 2000)
+    site.sync(chunk_size=1000)
+    undo()
+    site.edit('big', b'remote edit')
+    out = site.sync(chunk_size=1000)
+    assert 'Resuming upload' not in out
+    remote = site.remote_files()
+    assert remote['big'] == b'remote edit'
+    assert sorted(remote.values()) == [b'b' * 5000, b'remote edit']
+    assert site.local_files() == remote
+
+def test_abandoned_upload_leaves_nothing_behind(site):
+    site.write('big', b'a' * 5000)
+    undo = fail_upload_after(site, 2000)
+    site.sync(chunk_size=1000)
+    undo()
+    # The empty file uploaded into is on the server
+    assert site.remote_files() == { 'big': b'' }
+    (site.local / 'big').unlink()
+    site.sync(chunk_size=1000)
+    assert site.remote_files() == {}
+    assert site.local_files() == {}
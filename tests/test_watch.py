@@ -0,0 +1,106 @@
+import os
+import sys
+import threading
+
+import pytest
+
+import db
+from mock_sharepoint import error
+from watch import Watcher
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is Linux only')
+
+def test_watcher_sees_changes(tmp_path):
+    (tmp_path / 'd').mkdir()
+    (tmp_path / 'd' / 'old').write_bytes(b'x')
+    watcher = Watcher(tmp_path, lambda rel_path: rel_path.endswith('.tmp'))
+    try:
+        (tmp_path / 'a').write_bytes(b'x')
+        (tmp_path / 'b.tmp').write_bytes(b'x')
+        (tmp_path / 'd' / 'old').unlink()
+        (tmp_path / 'new' / 'sub').mkdir(parents=True)
+        (tmp_path / 'new' / 'sub' / 'c').write_bytes(b'x')
+        os.rename(str(tmp_path / 'd'), str(tmp_path / 'e'))
+        assert watcher.wait(1, settle=0.2) == set(['a', 'd/old', 'new', 'new/sub', 'new/sub/c', 'd', 'e'])
+        # The moved folder is watched under its new name
+        (tmp_path / 'e' / 'f').write_bytes(b'x')
+        assert watcher.wait(1, settle=0.2) == set(['e/f'])
+        assert watcher.wait(0.2, settle=0.2) == set()
+    finally:
+        watcher.close()
+
+def watch(site, monkeypatch, rounds, interval=0.5):
+    # Runs a watch until it has started rounds syncs.  before(n), if a round
+    # has one, is called before round n.  Returns the paths each round was
+    # given.
+    d = site.db()
+    given = []
+    sync = d.sync
+    def counted(changes=None):
+        given.append(changes)
+        n = len(given)
+        if n > len(rounds):
+            raise KeyboardInterrupt
+        if rounds[n - 1] is not None:
+            rounds[n - 1]()
+        return sync(changes)
+    monkeypatch.setattr(d, 'sync', counted)
+    with pytest.raises(KeyboardInterrupt):
+        d.watch(interval)
+    return given
+
+def later(action):
+    # Does action once the watch is waiting for changes
+    return lambda: threading.Timer(0.3, action).start()
+
+def test_local_change_synced(site, monkeypatch):
+    site.write('a', b'a')
+    site.sync()
+    given = watch(site, monkeypatch, [later(lambda: site.write('b', b'b')), None])
+    assert given[1] == set(['b'])
+    assert site.remote_files() == { 'a': b'a', 'b': b'b' }
+
+def test_remote_change_synced(site, monkeypatch):
+    site.write('a', b'a')
+    site.sync()
+    given = watch(site, monkeypatch, [None, lambda: site.edit('a', b'remote edit')])
+    # Nothing changed locally, but the server is asked all the same
+    assert given[1] == set()
+    assert site.local_files() == { 'a': b'remote edit' }
+
+def test_failed_transfer_tried_again(site, monkeypatch, capsys):
+    site.sync()
+    do_add_file = site.mock.do_add_file
+    def failing(*args):
+        site.mock.do_add_file = do_add_file
+        return error(400, 'Injected error')
+    def write():
+        site.mock.do_add_file = failing
+        site.write('b', b'b')
+    given = watch(site, monkeypatch, [later(write), None, None])
+    assert 'Error' in capsys.readouterr().out
+    assert given[1] == set(['b'])
+    # Nothing more happened to b, but it failed last time
+    assert given[2] == set(['b'])
+    assert site.remote_files() == { 'b': b'b' }
+
+def test_failed_round_tried_again_later(site, monkeypatch, capsys):
+    monkeypatch.setattr(db, 'WATCH_BACKOFF', 0.01)
+    site.sync()
+    do_changes = site.mock.do_changes
+    def fail_listing():
+        site.mock.do_changes = lambda *args: error(500, 'Injected error')
+        site.mock.do_items = lambda *args: error(500, 'Injected error')
+        site.mock.do_folder = lambda *args: error(500, 'Injected error')
+    def write():
+        fail_listing()
+        site.write('b', b'b')
+    def recover():
+        site.mock.do_changes = do_changes
+        del site.mock.do_items
+        del site.mock.do_folder
+    given = watch(site, monkeypatch, [later(write), None, recover])
+    assert 'trying again in 0.01s' in capsys.readouterr().out
+    # The failed round's paths aren't forgotten
+    assert 'b' in given[2]
+    assert site.remote_files() == { 'b': b'b' }
@@ -1,17 +1,47 @@
-from sharepoint import SharePoint, Folder
-from pathlib import Path
+from sharepoint import SharePoint
 from argparse import ArgumentParser
 from getpass import getpass
-from db import DB, params
+
+# Lists everything under a folder on the server, as it is found, with each
+# file's size, then sums up the folders down to --depth.
 
 parser = ArgumentParser()
 parser.add_argument('server', nargs='?')
+parser.add_argument('remote_path', nargs='?', default='')
 parser.add_argument('--username', '-u', nargs='?')
+parser.add_argument('--pw', '-p', type=str)
+parser.add_argument('--jobs', '-j', type=int, default=8,
+                    help='Number of folders to list at once')
+parser.add_argument('--depth', type=int, default=1,
+                    help='Sum up each folder this many levels down')
 args = parser.parse_args()
 
-args.pw = getpass()
+if not args.pw:
+    args.pw = getpass()
+
+sp = SharePoint(args.server, args.username, args.pw, pool_size=args.jobs)
+f = sp.get_folder(args.remote_path)
+# Files, folders and bytes under each folder down to --depth, '' being the top
+totals = { '': [0, 0, 0] }
+for entry in f.crawl(jobs=args.jobs):
+    rel_path = entry.relative_to(f)
+    parts = rel_path.split('/')
+    if entry.is_folder:
+        print('{:>15}  {}/'.format('', rel_path))
+        if len(parts) <= args.depth:
+            totals.setdefault(rel_path, [0, 0, 0])
+    else:
+        print('{:>15,}  {}'.format(int(entry.length), rel_path))
+    for depth in range(min(len(parts) - 1, args.depth) + 1):
+        t = totals.setdefault('/'.join(parts[:depth]), [0, 0, 0])
+        if entry.is_folder:
+            t[1] += 1
+        else:
+            t[0] += 1
+            t[2] += int(entry.length)
 
-sp = SharePoint(args.server, args.username, args.pw)
-f = sp.get_folder('')
-for ff in f:
-    print(ff.name)
+print()
+for rel_path in sorted(totals):
+    files, folders, size = totals[rel_path]
+    print('{:>9,} files {:>7,} folders {:>15,} bytes  {}'.format(
+            files, folders, size, rel_path + '/' if rel_path else str(f.path)))
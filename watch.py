@@ -0,0 +1,137 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_ONLYDIR)
+
+EVENT = struct.Struct('iIII')
+
+# How often a wait looks to see whether it has been told to stop
+STOP_POLL = 1
+
+class Watcher():
+    # Collects the paths (relative to root) of everything that changes under
+    # root, using inotify.  Linux only.
+    def __init__(self, root, ignore):
+        self.root = str(root)
+        # ignore(rel_path) says whether changes to a path are of no interest
+        self.ignore = ignore
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify is not available on this system')
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+        self.dirty = set()
+        self.overflowed = False
+        self.add_tree('', mark=False)
+
+    def close(self):
+        os.close(self.fd)
+
+    def join(self, rel_dir, name):
+        return rel_dir + '/' + name if rel_dir else name
+
+    def add_tree(self, rel_dir, mark=True):
+        # Watches rel_dir and everything under it.  Anything found in it is
+        # marked dirty, since it may have arrived before the watch did.
+        dirs = [rel_dir]
+        while dirs:
+            rel_dir = dirs.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(self.root, rel_dir)),
+                                             WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == 28:
+                    raise OSError(err, 'Out of inotify watches; raise fs.inotify.max_user_watches')
+                # Gone already
+                continue
+            self.watches[wd] = rel_dir
+            try:
+                with os.scandir(os.path.join(self.root, rel_dir)) as entries:
+                    for entry in entries:
+                        rel_path = self.join(rel_dir, entry.name)
+                        if self.ignore(rel_path):
+                            continue
+                        if mark:
+                            self.dirty.add(rel_path)
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(rel_path)
+            except OSError:
+                pass
+
+    def remove_tree(self, rel_dir):
+        # A directory moved elsewhere keeps its watches, which would now
+        # report the wrong paths.
+        prefix = rel_dir + '/'
+        for wd, path in list(self.watches.items()):
+            if path == rel_dir or path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read_events(self):
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        i = 0
+        while i < len(buf):
+            wd, mask, cookie, length = EVENT.unpack_from(buf, i)
+            name = buf[i + EVENT.size:i + EVENT.size + length].rstrip(b'\0')
+            i += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            if wd not in self.watches or not name:
+                continue
+            rel_path = self.join(self.watches[wd], os.fsdecode(name))
+            if self.ignore(rel_path):
+                continue
+            self.dirty.add(rel_path)
+            if mask & IN_ISDIR:
+                if mask & (IN_MOVED_FROM | IN_DELETE):
+                    self.remove_tree(rel_path)
+                elif mask & (IN_MOVED_TO | IN_CREATE):
+                    self.add_tree(rel_path)
+
+    def wait(self, timeout, settle=2, stop=None):
+        # Waits up to timeout seconds for something to change, then for
+        # things to go quiet for settle seconds, and returns the set of
+        # changed paths.  Returns None if the kernel dropped events, in which
+        # case everything needs looking at.  If stop (a threading.Event) is
+        # set, returns what has changed so far within STOP_POLL seconds.
+        stopped = lambda: stop is not None and stop.is_set()
+        # Whatever has happened already
+        while select.select([self.fd], [], [], 0)[0]:
+            self.read_events()
+        deadline = time.time() + timeout
+        while not self.dirty and not self.overflowed and time.time() < deadline and not stopped():
+            if select.select([self.fd], [], [], min(STOP_POLL, max(0, deadline - time.time())))[0]:
+                self.read_events()
+        # A long copy could keep things busy forever; give up waiting
+        # for quiet after another timeout.
+        deadline = time.time() + timeout
+        while time.time() < deadline and not stopped() and select.select([self.fd], [], [], settle)[0]:
+            self.read_events()
+        dirty, self.dirty = self.dirty, set()
+        if self.overflowed:
+            self.overflowed = False
+            return None
+        return dirty